@@ -0,0 +1,302 @@
+"""
+Admission control and load shedding.
+
+Every request is admitted into one of the pools 'query', 'stream' and 'evaluate', each with its own
+concurrency limit, and into a global in-flight limit shared by all pools. A request that cannot get
+both slots within the queue-time limit is shed with `ServiceOverloaded`, answered with a 503 and a
+Retry-After header.
+
+Before queueing, the backlog of the pool (waiting requests relative to its limit) selects a
+degradation level:
+    NORMAL: every model is queried.
+    REDUCED_MODELS: only the cheapest and fastest models are queried.
+    RETRIEVAL_ONLY: no model is queried; the contexts are returned with a cached answer if there is one.
+Retrieval-only requests do not wait for the model pools or the global limit; they are admitted into a
+small 'retrieval' pool of their own, sized for the retrieval threads, with a short queue-time limit, and
+shed like the others beyond it.
+
+The limits apply per worker process. Configuration (environment):
+    ADMISSION_GLOBAL_LIMIT, ADMISSION_QUERY_LIMIT, ADMISSION_STREAM_LIMIT, ADMISSION_EVALUATE_LIMIT,
+    ADMISSION_RETRIEVAL_LIMIT, ADMISSION_MAX_QUEUE_SECONDS, ADMISSION_RETRIEVAL_QUEUE_SECONDS,
+    ADMISSION_DEGRADE_BACKLOG, ADMISSION_RETRIEVAL_ONLY_BACKLOG, ADMISSION_DEGRADED_MODELS.
+"""
+import asyncio
+import math
+import os
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional
+from backend_service.custom_exceptions import ServiceOverloaded
+
+NORMAL, REDUCED_MODELS, RETRIEVAL_ONLY = 0, 1, 2
+LEVEL_NAMES = {NORMAL: None, REDUCED_MODELS: 'reduced-models', RETRIEVAL_ONLY: 'retrieval-only'}
+# Relative price per request, used together with the observed latency to pick the models to drop
+MODEL_COST_WEIGHTS = {'gpt-4-turbo': 10.0, 'gpt-3.5-turbo': 1.0, 'llama-2-70b-chat': 2.0, 'falcon-40b-instruct': 2.0}
+
+
+class ModelLatencyTracker:
+    """
+    Exponentially weighted moving average of the generation time of every model.
+
+    Attributes:
+        alpha (float): The weight of the newest sample.
+        default (float): The latency assumed for a model without samples.
+    """
+    def __init__(self, alpha: float = 0.2, default: float = 5.0):
+        self.alpha = alpha
+        self.default = default
+        self.latencies: Dict[str, float] = {}
+
+    def record(self, model_name: str, seconds: float):
+        previous = self.latencies.get(model_name)
+        self.latencies[model_name] = seconds if previous is None else previous + self.alpha * (seconds - previous)
+
+    def get(self, model_name: str) -> float:
+        return self.latencies.get(model_name, self.default)
+
+
+MODEL_LATENCY = ModelLatencyTracker()
+
+
+class _Pool:
+    """
+    A concurrency limit that knows how many requests are waiting for it.
+    """
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = limit
+        self.in_flight = 0
+        self.waiting = 0
+        self.service_time = 1.0
+        self._semaphore = asyncio.Semaphore(limit)
+
+    @property
+    def backlog(self) -> float:
+        return self.waiting / self.limit
+
+    async def acquire(self, timeout: float) -> bool:
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), max(timeout, 0))
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        return True
+
+    def release(self, seconds: Optional[float] = None):
+        self.in_flight -= 1
+        self._semaphore.release()
+        if seconds is not None:
+            self.service_time += 0.2 * (seconds - self.service_time)
+
+    def retry_after(self) -> int:
+        """
+        Estimates in how many seconds a slot is likely free: the queue drained at the observed service rate.
+        """
+        return max(1, math.ceil(self.service_time * (self.waiting + 1) / self.limit))
+
+    def as_dict(self) -> Dict:
+        return {'limit': self.limit, 'in_flight': self.in_flight, 'waiting': self.waiting,
+                'service_time': round(self.service_time, 3)}
+
+
+class Ticket:
+    """
+    An admitted request. `release` must be called exactly once when the request is done.
+
+    Attributes:
+        pool (str): The pool the request was admitted to.
+        level (int): The degradation level, NORMAL, REDUCED_MODELS or RETRIEVAL_ONLY.
+        models (Optional[List[str]]): The models to query, None for all.
+        queue_time (float): Seconds spent waiting for admission.
+    """
+    def __init__(self, controller: 'AdmissionController', pool: Optional[_Pool], level: int,
+                 models: Optional[List[str]], queue_time: float = 0.0, global_slot: bool = True):
+        self._controller = controller
+        self._pool = pool
+        self._global_slot = global_slot
+        self._admitted_at = time.monotonic()
+        self._released = False
+        self.pool = pool.name if pool else None
+        self.level = level
+        self.models = models
+        self.queue_time = queue_time
+
+    @property
+    def degraded(self) -> Optional[str]:
+        return LEVEL_NAMES[self.level]
+
+    def release(self):
+        if self._released:
+            return
+        self._released = True
+        if self._pool is not None:
+            self._pool.release(time.monotonic() - self._admitted_at)
+            if self._global_slot:
+                self._controller._global.release(time.monotonic() - self._admitted_at)
+
+
+class AdmissionController:
+    """
+    Admits requests into concurrency pools, degrades the fan-out under backlog and sheds what cannot
+    be admitted in time.
+
+    Attributes:
+        global_limit (int): The maximum number of requests in flight across all pools.
+        max_queue_time (float): Seconds a request may wait for admission before it is shed.
+        retrieval_queue_time (float): Seconds a retrieval-only request may wait for the retrieval pool.
+        degrade_backlog (float): The pool backlog, waiting requests per slot, from which models are dropped.
+        retrieval_only_backlog (float): The pool backlog from which no model is queried.
+        degraded_models (int): The number of models kept in REDUCED_MODELS.
+    """
+    def __init__(self, global_limit: int = 64, pool_limits: Optional[Dict[str, int]] = None,
+                 max_queue_time: float = 5.0, degrade_backlog: float = 0.5, retrieval_only_backlog: float = 2.0,
+                 degraded_models: int = 2, latency: ModelLatencyTracker = MODEL_LATENCY,
+                 retrieval_limit: int = 8, retrieval_queue_time: float = 1.0):
+        pool_limits = pool_limits or {'query': 16, 'stream': 32, 'evaluate': 4}
+        self.global_limit = global_limit
+        self.max_queue_time = max_queue_time
+        self.retrieval_queue_time = retrieval_queue_time
+        self.degrade_backlog = degrade_backlog
+        self.retrieval_only_backlog = retrieval_only_backlog
+        self.degraded_models = degraded_models
+        self.latency = latency
+        self.shed = 0
+        self._global = _Pool('global', global_limit)
+        self._pools = {name: _Pool(name, limit) for name, limit in pool_limits.items()}
+        self._retrieval = _Pool('retrieval', retrieval_limit)
+
+    @classmethod
+    def from_env(cls) -> 'AdmissionController':
+        """
+        Creates a controller configured by the ADMISSION_* environment variables.
+        """
+        env = os.environ.get
+        return cls(global_limit=int(env('ADMISSION_GLOBAL_LIMIT', 64)),
+                   pool_limits={'query': int(env('ADMISSION_QUERY_LIMIT', 16)),
+                                'stream': int(env('ADMISSION_STREAM_LIMIT', 32)),
+                                'evaluate': int(env('ADMISSION_EVALUATE_LIMIT', 4))},
+                   max_queue_time=float(env('ADMISSION_MAX_QUEUE_SECONDS', 5.0)),
+                   degrade_backlog=float(env('ADMISSION_DEGRADE_BACKLOG', 0.5)),
+                   retrieval_only_backlog=float(env('ADMISSION_RETRIEVAL_ONLY_BACKLOG', 2.0)),
+                   degraded_models=int(env('ADMISSION_DEGRADED_MODELS', 2)),
+                   retrieval_limit=int(env('ADMISSION_RETRIEVAL_LIMIT', 8)),
+                   retrieval_queue_time=float(env('ADMISSION_RETRIEVAL_QUEUE_SECONDS', 1.0)))
+
+    def select_models(self, level: int, models: List[str]) -> Optional[List[str]]:
+        """
+        Picks the models to query at a degradation level, dropping the slowest and most expensive first.
+
+        Args:
+            level (int): The degradation level.
+            models (List[str]): All model names.
+
+        Returns:
+            Optional[List[str]]: The models to query, None for all of them.
+        """
+        if level == NORMAL:
+            return None
+        if level == RETRIEVAL_ONLY:
+            return []
+        ranked = sorted(models, key=lambda name: self.latency.get(name) * MODEL_COST_WEIGHTS.get(name, 1.0))
+        kept = set(ranked[:self.degraded_models])
+        return [name for name in models if name in kept]
+
+    def _level(self, pool: _Pool, degradable: bool) -> int:
+        if not degradable:
+            return NORMAL
+        backlog = max(pool.backlog, self._global.backlog)
+        if backlog >= self.retrieval_only_backlog:
+            return RETRIEVAL_ONLY
+        if backlog >= self.degrade_backlog:
+            return REDUCED_MODELS
+        return NORMAL
+
+    async def acquire(self, pool_name: str, models: Optional[List[str]] = None) -> Ticket:
+        """
+        Waits for a slot in the pool and in the global limit.
+
+        Args:
+            pool_name (str): 'query', 'stream' or 'evaluate'.
+            models (List[str], optional): All models the request would fan out to. Requests without
+                models are never degraded, only queued or shed.
+
+        Returns:
+            Ticket: The admitted request.
+
+        Raises:
+            ServiceOverloaded: If no slot became free within the queue-time limit.
+        """
+        pool = self._pools[pool_name]
+        level = self._level(pool, bool(models))
+        start = time.monotonic()
+        if level == RETRIEVAL_ONLY:
+            if not await self._retrieval.acquire(self.retrieval_queue_time):
+                self.shed += 1
+                raise ServiceOverloaded("The service is saturated", retry_after=max(pool.retry_after(),
+                                                                                    self._retrieval.retry_after()))
+            return Ticket(self, self._retrieval, level, [], queue_time=time.monotonic() - start, global_slot=False)
+        if not await pool.acquire(self.max_queue_time):
+            self.shed += 1
+            raise ServiceOverloaded(f"The {pool_name} pool is saturated", retry_after=pool.retry_after())
+        if not await self._global.acquire(self.max_queue_time - (time.monotonic() - start)):
+            pool.release()
+            self.shed += 1
+            raise ServiceOverloaded("The service is saturated", retry_after=self._global.retry_after())
+        return Ticket(self, pool, level, self.select_models(level, models) if models else None,
+                      queue_time=time.monotonic() - start)
+
+    @asynccontextmanager
+    async def admit(self, pool_name: str, models: Optional[List[str]] = None):
+        """
+        Context manager version of `acquire` that releases the slot on exit.
+        """
+        ticket = await self.acquire(pool_name, models)
+        try:
+            yield ticket
+        finally:
+            ticket.release()
+
+    def stats(self) -> Dict:
+        pools = {name: pool.as_dict() for name, pool in self._pools.items()}
+        pools['retrieval'] = self._retrieval.as_dict()
+        return {'global': self._global.as_dict(), 'pools': pools,
+                'shed': self.shed, 'model_latency': {name: round(seconds, 3)
+                                                     for name, seconds in self.latency.latencies.items()}}
+
+
+class ResponseCache:
+    """
+    LRU cache of complete answers, served when the service only has capacity for retrieval.
+
+    Attributes:
+        max_entries (int): The maximum number of cached queries.
+        ttl (float): Seconds an answer stays valid.
+    """
+    def __init__(self, max_entries: int = 1024, ttl: float = 3600.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: OrderedDict = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        stored_at, value = entry
+        if time.monotonic() - stored_at > self.ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self._entries[key] = (time.monotonic(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
@@ -1,12 +1,44 @@
-from fastapi import APIRouter, WebSocket
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect, HTTPException, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+from starlette.websockets import WebSocketState
 import os
+import json
+import uuid
+import hmac
+import ipaddress
+import asyncio
 import logging
-from typing import List
-from backend_service.helper_functions import perform_semantic_search, query_models_async, generate_prompt, evaluate_responses
-from backend_service.schema import QueryRequest, ModelEvalRequest, ModelEvalResponse, QueryResponse
+from typing import Dict, Hashable, List, Optional, Sequence, Tuple
+from backend_service.helper_functions import query_models_async, evaluate_responses, stream_models_async, format_sse, coalesce_deltas, retrieve_and_build_prompt_async, query_and_evaluate, retrieval_executor_stats, normalize_query, QUERY_MODELS, STREAM_MODELS
+from backend_service.schema import QueryRequest, ModelEvalRequest, ModelEvalResponse, QueryResponse, ModelResponse
+from backend_service.admission import AdmissionController, ResponseCache, Ticket, RETRIEVAL_ONLY
+from backend_service.custom_exceptions import ServiceOverloaded, UnknownShard
+from backend_service.shards import select_shards
+from backend_service.coalescing import SingleFlight, StreamCoalescer, flight_key
+from backend_service.loop_monitor import EventLoopLagMonitor
+from backend_service.index_versions import IndexSwapper
 
 CHROMADB_COLLECTION = {}
 GENERATIVE_MODELS = {}
+ADMISSION = AdmissionController.from_env()
+# Complete answers of all models, served instead of nothing when only retrieval can be afforded
+RESPONSE_CACHE = ResponseCache()
+# Identical concurrent queries share one retrieval and one set of model calls
+QUERY_FLIGHTS = SingleFlight()
+STREAM_FLIGHTS = StreamCoalescer()
+LOOP_MONITOR = EventLoopLagMonitor(warn_threshold=float(os.environ.get('LOOP_LAG_WARN_MS', 100)) / 1000)
+# Swaps new versions of the index in under live traffic; answers of the replaced version are dropped
+INDEX_SWAPPER = IndexSwapper()
+INDEX_SWAPPER.add_listener(lambda version: RESPONSE_CACHE.clear())
+# Required to roll the index back; without it only requests from the local machine may
+INDEX_ADMIN_TOKEN = os.environ.get('INDEX_ADMIN_TOKEN')
+# WebSocket deltas are buffered per model and sent at most every WS_FLUSH_MS, or once WS_FLUSH_BYTES are buffered
+WS_FLUSH_WINDOW = float(os.environ.get('WS_FLUSH_MS', 30)) / 1000
+WS_FLUSH_BYTES = int(os.environ.get('WS_FLUSH_BYTES', 1024))
+# Compact frames name a model by its index in this list
+WS_MODEL_INDEX = {model_name: index for index, model_name in enumerate(STREAM_MODELS)}
 
 REPLICATE_API_TOKEN = os.environ["REPLICATE_API_TOKEN"] 
 
@@ -27,46 +59,348 @@ async def app_root():
     return {"Hello": "Backend Service"}
 
 
+@router.get("/admission")
+async def admission_stats():
+    """
+    Reports the in-flight and waiting requests of every admission pool, the number of shed requests,
+    the observed latency of every model and how many requests joined an identical one in flight.
+
+    Returns:
+        dict: The admission controller and coalescing statistics.
+    """
+    return {**ADMISSION.stats(), 'coalescing': {'query': QUERY_FLIGHTS.stats(), 'stream': STREAM_FLIGHTS.stats()}}
+
+
+@router.get("/metrics")
+async def runtime_metrics():
+    """
+    Reports the event-loop lag of this worker and the load of its retrieval executor.
+
+    Returns:
+        dict: The lag percentiles in milliseconds and the executor statistics.
+    """
+    return {'event_loop_lag': LOOP_MONITOR.stats(), 'retrieval_executor': retrieval_executor_stats()}
+
+
+@router.get("/index")
+async def index_version():
+    """
+    Reports the version of the index served, the one kept for rollback and when it was last swapped.
+
+    Returns:
+        dict: The index version statistics.
+    """
+    return INDEX_SWAPPER.stats()
+
+
+def _require_index_admin(request: Request):
+    """
+    Allows changing the served index with the `INDEX_ADMIN_TOKEN` bearer token or, when no token is
+    configured, from the local machine only.
+
+    Raises:
+        HTTPException: 403 if the request is not allowed.
+    """
+    if INDEX_ADMIN_TOKEN:
+        authorization = request.headers.get('Authorization', '')
+        if hmac.compare_digest(authorization.encode(), f"Bearer {INDEX_ADMIN_TOKEN}".encode()):
+            return
+    else:
+        try:
+            if request.client is not None and ipaddress.ip_address(request.client.host).is_loopback:
+                return
+        except ValueError:
+            pass  # Not an IP address, e.g. a test client
+    raise HTTPException(status_code=403, detail="Changing the index needs the INDEX_ADMIN_TOKEN")
+
+
+@router.post("/index/rollback")
+async def rollback_index(request: Request):
+    """
+    Swaps the previous version of the index recorded in the pointer file back in at once and
+    republishes it for the other workers. Needs the admin token, see `_require_index_admin`.
+
+    Returns:
+        dict: The index version statistics after the rollback.
+    """
+    _require_index_admin(request)
+    try:
+        await INDEX_SWAPPER.rollback()
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return INDEX_SWAPPER.stats()
+
+
+def _resolve_shards(shards: Optional[Sequence[str]], language: Optional[str]) -> Optional[Tuple[str, ...]]:
+    """
+    Resolves the shards a request searches. None stands for the default shards, so that requests of the
+    default selection share cache entries and in-flight work however they selected it.
+
+    Raises:
+        UnknownShard: If a selected shard or language is not available.
+    """
+    if not shards and language is None:
+        return None
+    configs = {name: shard['config'] for name, shard in CHROMADB_COLLECTION.get('shards', {}).items()}
+    selected = select_shards(configs, shards, language)
+    return None if selected == select_shards(configs) else selected
+
+
+def _query_key(query: str, shards: Optional[Tuple[str, ...]]) -> Hashable:
+    """
+    The cache and coalescing key of a query: its normalized text, the shards if they are not the default
+    ones, and the index version once a versioned index is served.
+    """
+    key = normalize_query(query) if shards is None else (normalize_query(query), shards)
+    return key if INDEX_SWAPPER.version is None else (INDEX_SWAPPER.version, key)
+
+
+@router.get("/shards")
+async def list_shards():
+    """
+    Lists the shards queries can select by name or language.
+
+    Returns:
+        dict: The name, collection, language and embedding model of every shard, and whether it is searched by default.
+    """
+    return {'shards': [{'name': name, 'collection': shard['config'].collection, 'language': shard['config'].language,
+                        'embedding_model': shard['config'].embedding_model, 'default': shard['config'].default}
+                       for name, shard in CHROMADB_COLLECTION.get('shards', {}).items()]}
+
+
+def _cached_responses(query: str, ticket: Ticket,
+                      shards: Optional[Tuple[str, ...]] = None) -> Tuple[List[ModelResponse], Optional[str]]:
+    """
+    Returns the cached answers to serve with a retrieval-only response and the degradation to report.
+    """
+    cached = RESPONSE_CACHE.get(_query_key(query, shards))
+    return (cached, 'cached') if cached else ([], ticket.degraded)
+
+
+async def _admit_stream(pool: str, kind: str, query: str, models: List[str],
+                        shards: Optional[Tuple[str, ...]] = None) -> Tuple[Optional[Ticket], Hashable]:
+    """
+    Admits a streamed request, unless an identical stream of all models is in flight: joining it costs
+    no upstream work, so it needs no admission and the returned ticket is None.
+
+    Raises:
+        ServiceOverloaded: If the request must be admitted and could not be in time.
+    """
+    key = flight_key(kind, _query_key(query, shards), None)
+    if key in STREAM_FLIGHTS:
+        return None, key
+    ticket = await ADMISSION.acquire(pool, models)
+    return ticket, flight_key(kind, _query_key(query, shards), ticket.models)
+
+
+def _release(ticket: Optional[Ticket]):
+    if ticket is not None:
+        ticket.release()
+
+
+async def _query_stream_events(query: str, model_names: Optional[List[str]], shards: Optional[Tuple[str, ...]] = None):
+    """
+    Produces the events of a streamed query, shared by the SSE and WebSocket endpoints and by all
+    subscribers coalesced on it: {"type": "contexts", "contexts"}, then the {"model", "type", ...}
+    delta, done and error events of every model. When all models answered, the answers are cached
+    for retrieval-only responses.
+    """
+    # Keyed before the retrieval, so that an answer from a replaced index version is never served after the swap
+    cache_key = _query_key(query, shards)
+    contexts, prompt = await retrieve_and_build_prompt_async(query, CHROMADB_COLLECTION, shards)
+    yield {'type': 'contexts', 'contexts': contexts}
+    texts: Dict[str, List[str]] = {}
+    failed = False
+    async for model_name, event in stream_models_async(prompt, GENERATIVE_MODELS, model_names):
+        if event['type'] == 'delta':
+            texts.setdefault(model_name, []).append(event['text'])
+        elif event['type'] == 'error':
+            failed = True
+        yield {'model': model_name, **event}
+    if model_names is None and not failed:
+        response_names = {key: model_name for model_name, key in QUERY_MODELS.items()}
+        RESPONSE_CACHE.put(cache_key, [ModelResponse(model_name=response_names[model_name], response=''.join(text))
+                                                    for model_name, text in texts.items()])
+
+
+def _parse_ws_message(message: str) -> Optional[Dict]:
+    """
+    Parses a session message, returning None for a plain-text query of the original protocol.
+    """
+    try:
+        request = json.loads(message)
+    except ValueError:
+        return None
+    if not isinstance(request, dict) or request.get('type') not in ('query', 'cancel'):
+        return None
+    return request
+
+
+async def _send_deltas(websocket: WebSocket, query_id: Optional[str], deltas: List[Tuple[str, str]], compact: bool):
+    """
+    Sends a batch of coalesced deltas: one {model: text} frame per model without a query id, one compact
+    {"id", "d": [[model index, text], ...]} frame, or one delta event per model.
+    """
+    if query_id is None:
+        for model_name, text in deltas:
+            await websocket.send_json({model_name: text})
+    elif compact:
+        await websocket.send_json({'id': query_id, 'd': [[WS_MODEL_INDEX[model_name], text] for model_name, text in deltas]})
+    else:
+        for model_name, text in deltas:
+            await websocket.send_json({'id': query_id, 'type': 'delta', 'model': model_name, 'text': text})
+
+
+async def _stream_ws_query(websocket: WebSocket, query_id: Optional[str], user_query: str,
+                           compact: bool = False, window: float = WS_FLUSH_WINDOW,
+                           shards: Optional[Tuple[str, ...]] = None):
+    """
+    Streams the answers of all models to one query over the WebSocket.
+
+    The contexts are retrieved and the prompt is built once, as for `/query`, and shared by all model
+    streams, and by every client asking the same question at the same time. With a query id the events of the session protocol are sent, starting with the contexts,
+    and the socket stays open. Without one (a plain-text query) every delta is sent as {model: text}
+    and the socket is closed at the end, as the endpoint originally did.
+
+    Unless `window` is 0 the deltas are coalesced per model for up to `window` seconds or WS_FLUSH_BYTES,
+    which sends a frame per flush instead of one per token. `compact` selects the compact delta frames.
+    `shards` are the shards searched, the default ones when None.
+    """
+    try:
+        ticket, key = await _admit_stream('stream', 'stream', user_query, list(STREAM_MODELS), shards)
+    except ServiceOverloaded as e:
+        if query_id is None:
+            await websocket.close(code=1013, reason=str(e))  # Try Again Later
+        else:
+            await websocket.send_json({'id': query_id, 'type': 'error', 'error': str(e), 'retry_after': e.retry_after})
+        return
+    try:
+        if ticket is not None and ticket.level == RETRIEVAL_ONLY:
+            contexts, _ = await retrieve_and_build_prompt_async(user_query, CHROMADB_COLLECTION, shards)
+            cached, degraded = _cached_responses(user_query, ticket, shards)
+            if query_id is None:
+                for response in cached:
+                    await websocket.send_json({response.model_name: response.response})
+                await websocket.close()
+            else:
+                await websocket.send_json({'id': query_id, 'type': 'contexts', 'contexts': contexts})
+                await websocket.send_json({'id': query_id, 'type': 'degraded', 'mode': degraded,
+                                           'model_responses': jsonable_encoder(cached)})
+                await websocket.send_json({'id': query_id, 'type': 'end'})
+            return
+        if query_id is not None and ticket is not None and ticket.degraded:
+            await websocket.send_json({'id': query_id, 'type': 'degraded', 'mode': ticket.degraded, 'models': ticket.models})
+        if query_id is not None and compact:
+            await websocket.send_json({'id': query_id, 'type': 'models', 'models': list(WS_MODEL_INDEX)})
+        model_names = None if ticket is None else ticket.models
+        events = STREAM_FLIGHTS.subscribe(key, lambda: _query_stream_events(user_query, model_names, shards))
+        if window > 0:
+            events = coalesce_deltas(events, window, WS_FLUSH_BYTES)
+        async for event in events:
+            if event['type'] == 'deltas':
+                await _send_deltas(websocket, query_id, event['deltas'], compact)
+            elif event['type'] == 'delta':
+                await _send_deltas(websocket, query_id, [(event['model'], event['text'])], compact)
+            elif query_id is not None:
+                await websocket.send_json({'id': query_id, **event})
+        if query_id is None:
+            await websocket.close()
+        else:
+            await websocket.send_json({'id': query_id, 'type': 'end'})
+    except asyncio.CancelledError:
+        if query_id is not None and websocket.client_state == WebSocketState.CONNECTED:
+            try:
+                await websocket.send_json({'id': query_id, 'type': 'cancelled'})
+            except Exception:
+                pass
+        raise
+    except Exception as e:
+        logger.exception(f"Streaming query {query_id} failed")
+        if query_id is not None and websocket.client_state == WebSocketState.CONNECTED:
+            try:
+                await websocket.send_json({'id': query_id, 'type': 'error', 'error': str(e)})
+            except Exception:
+                pass
+    finally:
+        _release(ticket)
+
+
+def _flush_window(flush_ms) -> float:
+    """
+    Returns the coalescing window in seconds requested by a query message, WS_FLUSH_WINDOW if none or an
+    invalid one is given. It is capped at one second, so that a client cannot make the server hold tokens back.
+    """
+    try:
+        return min(max(float(flush_ms), 0.0), 1000.0) / 1000
+    except (TypeError, ValueError):
+        return WS_FLUSH_WINDOW
+
+
 @router.websocket("/ws/model-output")
 async def query_websocket_endpoint(websocket: WebSocket):
     """
     WebSocket endpoint to stream model outputs based on user queries.
 
-    This endpoint accepts a WebSocket connection, receives a user query, and streams the output
-    from multiple generative models back to the client.
+    A connection is a session that carries any number of queries. Every client message is JSON:
+        {"id": "q1", "type": "query", "query": "...", "compact"?: true, "flush_ms"?: 30, "shards"?: [...], "language"?: "ar"}:
+            starts a query, cancelling the one in flight. `shards` and `language` select the corpora searched.
+        {"id": "q1", "type": "cancel"}: cancels a query (the one in flight if no id is given).
+    The server answers with events tagged with the query id:
+        {"id", "type": "contexts", "contexts"}, {"id", "type": "delta", "model", "text"}, {"id", "type": "done", "model", "usage", ...},
+        {"id", "type": "error", "model"?, "error", "retry_after"?}, {"id", "type": "end"} and {"id", "type": "cancelled"}.
+    The deltas of a model are coalesced for up to `flush_ms` milliseconds (WS_FLUSH_MS by default, 0 sends
+    every token). With `compact` a {"id", "type": "models", "models"} event lists the models first, and the
+    deltas of all models of a flush are sent in one {"id", "d": [[model index, text], ...]} frame.
+    Frames are compressed with permessage-deflate when the client supports it.
+    Under load a {"id", "type": "degraded", "mode", "models" | "model_responses"} event announces that only some
+    models are streamed, or that only the contexts and possibly cached answers are sent. A query that
+    cannot be admitted gets an error event with `retry_after` seconds.
+
+    A plain-text message is handled as before: the outputs are sent as {model: text} and the socket is
+    closed when all models finished. Cancelling a query, or the client disconnecting, cancels the
+    upstream provider streams at once.
 
     Args:
         websocket (WebSocket): The WebSocket connection instance.
-
-    Raises:
-        Exception: If an error occurs during the WebSocket communication.
     """
     await websocket.accept()  # Accept the WebSocket connection
+    in_flight: Optional[Tuple[Optional[str], asyncio.Task]] = None
+
+    async def cancel_in_flight():
+        nonlocal in_flight
+        if in_flight is not None and not in_flight[1].done():
+            in_flight[1].cancel()
+            await asyncio.gather(in_flight[1], return_exceptions=True)
+        in_flight = None
+
     try:
-        user_query = await websocket.receive_text()  # Receive the entire user input at once
-        data = [{"role": "system", "content": user_query}]  # Format the user query for the models
-        # Stream output from the 'gpt-3.5-turbo-stream' model
-        model_output_stream = GENERATIVE_MODELS['gpt-3.5-turbo-stream'].generate(data)
-        for chunk in model_output_stream:
-            if chunk.choices[0].delta.content is not None:
-                await websocket.send_json({'gpt-3.5-turbo': chunk.choices[0].delta.content})
-        # Stream output from the 'gpt-4-turbo-stream' model
-        model_output_stream = GENERATIVE_MODELS['gpt-4-turbo-stream'].generate(data)
-        for chunk in model_output_stream:
-            if chunk.choices[0].delta.content is not None:
-                await websocket.send_json({'gpt-4-turbo': chunk.choices[0].delta.content})
-        # Stream output from the 'llama-2-70b-chat-stream' model
-        for text_chunk in GENERATIVE_MODELS['llama-2-70b-chat-stream'].generate(user_query):
-            await websocket.send_json({'llama-2-70b-chat': text_chunk})
-        # Stream output from the 'falcon-40b-instruct-stream' model
-        for text_chunk in GENERATIVE_MODELS['falcon-40b-instruct-stream'].generate(user_query):
-            await websocket.send_json({'falcon-40b-instruct': text_chunk})
-    except Exception as e:
-        print(f"Error: {e}")  # Log any errors that occur
+        while True:
+            # Receiving concurrently with the streaming task is what detects a disconnect immediately
+            message = await websocket.receive_text()
+            request = _parse_ws_message(message)
+            if request is None:
+                await cancel_in_flight()
+                in_flight = (None, asyncio.create_task(_stream_ws_query(websocket, None, message)))
+            elif request['type'] == 'cancel':
+                if in_flight is not None and request.get('id') in (None, in_flight[0]):
+                    await cancel_in_flight()
+            else:
+                await cancel_in_flight()
+                query_id = str(request.get('id') or uuid.uuid4().hex)
+                window = _flush_window(request.get('flush_ms'))
+                try:
+                    shards = _resolve_shards(request.get('shards'), request.get('language'))
+                except UnknownShard as e:
+                    await websocket.send_json({'id': query_id, 'type': 'error', 'error': str(e)})
+                    continue
+                in_flight = (query_id, asyncio.create_task(_stream_ws_query(websocket, query_id, request.get('query', ''),
+                                                                            bool(request.get('compact')), window, shards)))
+    except WebSocketDisconnect:
+        logger.info("WebSocket client disconnected")
     finally:
-        await websocket.close()  # Close the connection after streaming all words
+        await cancel_in_flight()
+
 
-    
 @router.post("/query")
 async def query_models(request: QueryRequest) -> QueryResponse:
     """
@@ -75,16 +409,185 @@ async def query_models(request: QueryRequest) -> QueryResponse:
     This endpoint performs a semantic search based on the user's query, generates a prompt,
     and queries multiple generative models asynchronously.
 
+    Under load the slowest and most expensive models are skipped, and past a larger backlog only the
+    contexts are returned, with a cached answer if the query was answered before; `degraded` tells
+    which. Requests that cannot be admitted in time get a 503 with a Retry-After header. Concurrent
+    requests with the same normalized query share one retrieval and one call per model.
+
+    `shards` and `language` select the corpora searched, see `backend_service.shards`; an unknown one
+    is answered with a 400.
+
     Args:
         request (QueryRequest): The request object containing the user's query.
 
     Returns:
         QueryResponse: The response object containing model responses and retrieved contexts.
     """
-    retrieved_summaries = perform_semantic_search(query=request.query, collection=CHROMADB_COLLECTION)
-    prompt = generate_prompt(question=request.query, summaries=retrieved_summaries)
-    model_responses = await query_models_async(user_query=prompt, generative_models=GENERATIVE_MODELS)
-    return QueryResponse(model_responses=model_responses, contexts=retrieved_summaries[0])
+    shards = _resolve_shards(request.shards, request.language)
+    query_key = _query_key(request.query, shards)
+    key = flight_key('query', query_key, None)
+    if key in QUERY_FLIGHTS:
+        # An identical query is being answered, joining it costs no upstream work
+        contexts, model_responses = await QUERY_FLIGHTS.do(key, lambda: _run_query(request.query, None, shards))
+        return QueryResponse(model_responses=model_responses, contexts=contexts)
+    async with ADMISSION.admit('query', list(QUERY_MODELS.values())) as ticket:
+        if ticket.level == RETRIEVAL_ONLY:
+            contexts, _ = await retrieve_and_build_prompt_async(request.query, CHROMADB_COLLECTION, shards)
+            cached, degraded = _cached_responses(request.query, ticket, shards)
+            return QueryResponse(model_responses=cached, contexts=contexts, degraded=degraded)
+        contexts, model_responses = await QUERY_FLIGHTS.do(flight_key('query', query_key, ticket.models),
+                                                           lambda: _run_query(request.query, ticket.models, shards))
+    return QueryResponse(model_responses=model_responses, contexts=contexts, degraded=ticket.degraded)
+
+
+async def _run_query(query: str, model_names: Optional[List[str]],
+                     shards: Optional[Tuple[str, ...]] = None) -> Tuple[List[str], List[ModelResponse]]:
+    """
+    Retrieves the contexts and queries the models once for all coalesced `/query` requests. The answers
+    of all models are cached for retrieval-only responses.
+    """
+    cache_key = _query_key(query, shards)
+    contexts, prompt = await retrieve_and_build_prompt_async(query, CHROMADB_COLLECTION, shards)
+    model_responses = await query_models_async(user_query=prompt, generative_models=GENERATIVE_MODELS,
+                                               model_names=model_names)
+    if model_names is None:
+        RESPONSE_CACHE.put(cache_key, model_responses)
+    return contexts, model_responses
+
+
+async def _query_event_stream(query: str, ticket: Optional[Ticket], key: Hashable,
+                              shards: Optional[Tuple[str, ...]] = None):
+    """
+    Produces the Server-Sent Events of a streamed query: the contexts, the interleaved token deltas of
+    every model, one completion or error event per model, and a final end event.
+
+    The events come from the stream shared by all concurrent identical queries. The admission ticket,
+    if any, is released when the stream ends.
+    """
+    try:
+        if ticket is not None and ticket.level == RETRIEVAL_ONLY:
+            contexts, _ = await retrieve_and_build_prompt_async(query, CHROMADB_COLLECTION, shards)
+            cached, degraded = _cached_responses(query, ticket, shards)
+            yield format_sse('contexts', {'contexts': contexts})
+            yield format_sse('degraded', {'mode': degraded, 'model_responses': jsonable_encoder(cached)})
+            yield format_sse('end', {})
+            return
+        if ticket is not None and ticket.degraded:
+            yield format_sse('degraded', {'mode': ticket.degraded, 'models': ticket.models})
+        model_names = None if ticket is None else ticket.models
+        async for event in STREAM_FLIGHTS.subscribe(key, lambda: _query_stream_events(query, model_names, shards)):
+            yield format_sse(event['type'], {field: value for field, value in event.items() if field != 'type'})
+        yield format_sse('end', {})
+    finally:
+        _release(ticket)
+
+
+@router.get("/query/stream")
+@router.post("/query/stream")
+async def query_models_stream(request: QueryRequest = None, query: str = None, language: str = None,
+                              shards: str = None) -> StreamingResponse:
+    """
+    Server-Sent Events variant of `/query`.
+
+    The retrieved contexts are sent as soon as the semantic search finishes, followed by the token
+    deltas of all models as they arrive. Accepts a JSON body like `/query` (POST) or a `query`
+    parameter, with optional `language` and comma-separated `shards` (GET, for `EventSource`). Concurrent requests for the same query receive the tokens of
+    one shared set of model streams, which is cancelled when the last of their clients disconnects.
+
+    Events:
+        contexts: {"contexts": [...]}
+        delta: {"model": ..., "text": ...}
+        done: {"model": ..., "usage": {...} | null, "first_token_ms": ..., "total_ms": ...}
+        error: {"model": ..., "error": ...}
+        degraded: {"mode": ..., "models": [...]} or, without any model, {"mode": ..., "model_responses": [...]}
+        end: {}
+
+    Args:
+        request (QueryRequest): The request object containing the user's query (POST).
+        query (str): The user's query (GET).
+        language (str): The language of the shards searched (GET).
+        shards (str): The comma-separated names of the shards searched (GET).
+
+    Returns:
+        StreamingResponse: The event stream.
+    """
+    user_query, selected = _stream_request(request, query, language, shards)
+    # Admitted before the response starts, so that a shed request still gets its 503
+    ticket, key = await _admit_stream('stream', 'stream', user_query, list(STREAM_MODELS), selected)
+    return StreamingResponse(_query_event_stream(user_query, ticket, key, selected), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+                             background=BackgroundTask(_release, ticket))
+
+
+def _stream_request(request: Optional[QueryRequest], query: Optional[str], language: Optional[str],
+                    shards: Optional[str]) -> Tuple[str, Optional[Tuple[str, ...]]]:
+    """
+    Reads the query and the shard selection of a streaming request from its JSON body (POST) or its
+    query parameters (GET).
+    """
+    if request is not None:
+        user_query, selected = request.query, _resolve_shards(request.shards, request.language)
+    else:
+        user_query = query
+        selected = _resolve_shards([name for name in (shards or '').split(',') if name], language)
+    if not user_query:
+        raise HTTPException(status_code=422, detail="A query is required")
+    return user_query, selected
+
+
+async def _query_and_evaluate_event_stream(query: str, ticket: Optional[Ticket], key: Hashable,
+                                           shards: Optional[Tuple[str, ...]] = None):
+    try:
+        if ticket is not None and ticket.degraded:
+            yield format_sse('degraded', {'mode': ticket.degraded, 'models': ticket.models})
+        model_names = None if ticket is None else ticket.models
+        async for event, data in STREAM_FLIGHTS.subscribe(
+                key, lambda: query_and_evaluate(query, CHROMADB_COLLECTION, GENERATIVE_MODELS, model_names, shards)):
+            yield format_sse(event, data)
+        yield format_sse('end', {})
+    except Exception as e:
+        logger.exception("Query and evaluate stream failed")
+        yield format_sse('error', {'stage': 'pipeline', 'error': str(e)})
+        yield format_sse('end', {})
+    finally:
+        _release(ticket)
+
+
+@router.get("/query/evaluate/stream")
+@router.post("/query/evaluate/stream")
+async def query_and_evaluate_stream(request: QueryRequest = None, query: str = None, language: str = None,
+                                    shards: str = None) -> StreamingResponse:
+    """
+    Server-Sent Events endpoint combining `/query` and `/evaluate`.
+
+    Every model answer is sent as soon as it is complete and its faithfulness and relevance scoring
+    starts right away, in parallel with the models still generating. Accepts a JSON body like
+    `/query` (POST) or `query`, `language` and `shards` parameters (GET). Concurrent requests for the same query share the
+    generations and evaluations.
+
+    Events:
+        contexts: {"contexts": [...]}
+        answer: {"model": ..., "response": ...}
+        evaluation: {"model": ..., "faithfulness": ..., "relevance": ...}
+        error: {"model": ..., "stage": "generate" | "evaluate", "error": ...}
+        best: {"best_model": ..., "model_evaluations": [...]}
+        degraded: {"mode": ..., "models": [...]}, sent first when models are skipped under load
+        end: {}
+
+    Args:
+        request (QueryRequest): The request object containing the user's query (POST).
+        query (str): The user's query (GET).
+        language (str): The language of the shards searched (GET).
+        shards (str): The comma-separated names of the shards searched (GET).
+
+    Returns:
+        StreamingResponse: The event stream.
+    """
+    user_query, selected = _stream_request(request, query, language, shards)
+    ticket, key = await _admit_stream('evaluate', 'evaluate', user_query, list(QUERY_MODELS.values()), selected)
+    return StreamingResponse(_query_and_evaluate_event_stream(user_query, ticket, key, selected), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+                             background=BackgroundTask(_release, ticket))
 
 
 @router.post("/evaluate")
@@ -100,5 +603,7 @@ async def evaluate_model_responses(request: ModelEvalRequest) -> ModelEvalRespon
     Returns:
         ModelEvalResponse: The response object containing the evaluation results.
     """
-    evaluated_responses = evaluate_responses(GENERATIVE_MODELS,request)
+    async with ADMISSION.admit('evaluate'):
+        # ragas blocks while it scores, so it runs in a thread
+        evaluated_responses = await asyncio.to_thread(evaluate_responses, GENERATIVE_MODELS, request)
     return evaluated_responses
\ No newline at end of file
@@ -1,15 +1,116 @@
 """Application routing endpoints will be managed here"""
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
 import os
+import dataclasses
 from contextlib import asynccontextmanager
-from backend_service.api import router, CHROMADB_COLLECTION, GENERATIVE_MODELS, REPLICATE_API_TOKEN
-from backend_service.helper_functions import get_chromadb_collection
+from backend_service.api import router, CHROMADB_COLLECTION, GENERATIVE_MODELS, REPLICATE_API_TOKEN, LOOP_MONITOR, INDEX_SWAPPER
+from backend_service.helper_functions import get_chromadb_collection, get_titles_collection, setup_logger, RETRIEVAL_MODE, configure_retrieval_executor, shutdown_retrieval_executor
+from backend_service.embedding_service import RemoteCollection
+from backend_service.tracing import TracingMiddleware
+from backend_service.custom_exceptions import ServiceOverloaded, UnknownShard
+from backend_service.shards import load_shard_configs, estimate_similarity_floor
+from backend_service.index_versions import read_index_pointer
 from backend_service.generation_models import OpenAIStream, OpenAIReg, Replicate, ReplicateReg
 from langchain.chat_models import ChatOpenAI
 
 
 COLLECTION_NAME = 'info-services-index'
 OPENAI_API_KEY = os.environ["OPENAI_API_KEY"]
+# Optional overrides, e.g. to point the providers at the local stand-ins of the load-test harness
+OPENAI_BASE_URL = os.environ.get("OPENAI_BASE_URL")
+REPLICATE_BASE_URL = os.environ.get("REPLICATE_BASE_URL")
+# Set by `main.py --production`: the workers share the model and collection of the embedding service
+EMBEDDING_SERVICE_SOCKET = os.environ.get("EMBEDDING_SERVICE_SOCKET")
+
+def _open_local_shard(config, embedding_function):
+    """
+    Opens the collection of a shard, and its title index in hierarchical mode.
+
+    Raises:
+        ValueError: If the collection does not exist.
+    """
+    shard = {'config': config, 'chromadb_collection': get_chromadb_collection(config.collection, embedding_function),
+             'embedding_function': embedding_function}
+    if RETRIEVAL_MODE == 'hierarchical':
+        shard['titles_collection'] = get_titles_collection(config.collection, embedding_function)
+    return shard
+
+
+def _open_local_shards(shard_configs, logger):
+    """
+    Opens the collection of every shard with its embedding model, loading each model once. A missing
+    collection is skipped with a warning, unless it is the primary shard's.
+    """
+    # Imported here so that API workers served by the shared embedding service never load torch
+    from backend_service.embedding_func import CustomEmbeddingFunction
+    embedding_functions, shards = {}, {}
+    for index, config in enumerate(shard_configs):
+        if config.embedding_model not in embedding_functions:
+            embedding_functions[config.embedding_model] = CustomEmbeddingFunction(model_name=config.embedding_model)
+        try:
+            shards[config.name] = _open_local_shard(config, embedding_functions[config.embedding_model])
+        except ValueError:
+            if index == 0:
+                raise
+            logger.warning(f"Collection {config.collection} of shard {config.name} does not exist, skipping the shard")
+    return shards
+
+
+def _calibrate_shards(shards, logger, samples: int = 200):
+    """
+    Measures the similarity floor of the shards that do not configure one when the shards use different
+    embedding models, so that their results can be merged, see `shards.merge_shard_results`.
+    """
+    if len({shard['config'].embedding_model for shard in shards.values()}) < 2:
+        return
+    for shard in shards.values():
+        config = shard['config']
+        if config.similarity_floor is not None:
+            continue
+        if EMBEDDING_SERVICE_SOCKET:
+            logger.warning(f"Shard {config.name} has no similarity_floor in shards.json; its results are merged "
+                           f"by raw similarity with those of other embedding models")
+            continue
+        embeddings = shard['chromadb_collection'].get(include=['embeddings'], limit=samples)['embeddings']
+        shard['config'] = dataclasses.replace(config, similarity_floor=estimate_similarity_floor(embeddings))
+        logger.info(f"Similarity floor of shard {config.name}: {shard['config'].similarity_floor}")
+
+
+def _swap_primary_shard(shard):
+    """
+    Serves a new version of the primary shard and returns the one it replaced. Nothing is awaited in
+    between, so every request sees either the old or the new version.
+    """
+    shards = dict(CHROMADB_COLLECTION['shards'])
+    replaced = shards[shard['config'].name]
+    shards[shard['config'].name] = shard
+    CHROMADB_COLLECTION.clear()
+    CHROMADB_COLLECTION.update({**shard, 'shards': shards})
+    return replaced
+
+
+def _open_remote_shards(shard_configs, logger):
+    """
+    Connects to the shards served by the embedding service: the primary shard is its main collection,
+    the others are served as 'shard:<name>'.
+    """
+    primary = RemoteCollection(EMBEDDING_SERVICE_SOCKET)
+    served = primary.collections()
+    shards = {}
+    for index, config in enumerate(shard_configs):
+        if index == 0:
+            collection = primary
+        elif f"shard:{config.name}" in served:
+            collection = RemoteCollection(EMBEDDING_SERVICE_SOCKET, collection=f"shard:{config.name}")
+        else:
+            logger.warning(f"The embedding service does not serve shard {config.name}, skipping it")
+            continue
+        shards[config.name] = {'config': config, 'chromadb_collection': collection, 'embedding_function': collection.embed}
+    if RETRIEVAL_MODE == 'hierarchical' and 'titles' in served:
+        shards[shard_configs[0].name]['titles_collection'] = RemoteCollection(EMBEDDING_SERVICE_SOCKET, collection='titles')
+    return shards
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -25,20 +126,79 @@ async def lifespan(app: FastAPI):
     Yields:
         None: This function yields control back to the caller after setting up the resources.
     """
-    CHROMADB_COLLECTION['chromadb_collection'] = get_chromadb_collection(COLLECTION_NAME)
-    GENERATIVE_MODELS['gpt-3.5-turbo-stream'] = OpenAIStream(api_key=OPENAI_API_KEY, model="gpt-3.5-turbo")
-    GENERATIVE_MODELS['gpt-4-turbo-stream'] = OpenAIStream(api_key=OPENAI_API_KEY, model="gpt-3.5-turbo")
-    GENERATIVE_MODELS['llama-2-70b-chat-stream'] = Replicate(model="meta/llama-2-70b-chat", api_token=REPLICATE_API_TOKEN)
-    GENERATIVE_MODELS['falcon-40b-instruct-stream'] = Replicate(model="meta/meta-llama-3-70b-instruct", api_token=REPLICATE_API_TOKEN)
-    GENERATIVE_MODELS['gpt-3.5-turbo'] = OpenAIReg(api_key=OPENAI_API_KEY, model="gpt-3.5-turbo")
-    GENERATIVE_MODELS['gpt-4-turbo'] = OpenAIReg(api_key=OPENAI_API_KEY, model="gpt-4-turbo")  # 
-    GENERATIVE_MODELS['falcon-40b-instruct'] = ReplicateReg(model="meta/meta-llama-3-70b-instruct", api_token=REPLICATE_API_TOKEN)
-    GENERATIVE_MODELS['llama-2-70b-chat'] = ReplicateReg(model="meta/llama-2-70b-chat", api_token=REPLICATE_API_TOKEN)
-    GENERATIVE_MODELS['gpt-3.5-turbo-eval'] = ChatOpenAI(model_name="gpt-4-turbo")
+    # Every worker process needs its own listener thread; in the parent process this is a no-op
+    logger = setup_logger('backend_service_logger')
+    # The primary shard is `COLLECTION_NAME` unless chromadb_data/shards.json lists other corpora
+    shard_configs = load_shard_configs(default_collection=COLLECTION_NAME)
+    base_collection = shard_configs[0].collection
+    # Serve the latest version published by web_scrapper/reindex.py, if any
+    pointer = read_index_pointer(base_collection)
+    if pointer is not None:
+        shard_configs[0] = dataclasses.replace(shard_configs[0], collection=pointer['collection'])
+    if EMBEDDING_SERVICE_SOCKET:
+        shards = _open_remote_shards(shard_configs, logger)
+    else:
+        shards = _open_local_shards(shard_configs, logger)
+    _calibrate_shards(shards, logger)
+    CHROMADB_COLLECTION.update(shards[shard_configs[0].name])
+    CHROMADB_COLLECTION['shards'] = shards
+    logger.info(f"Searching shards {', '.join(shards)}")
+    if EMBEDDING_SERVICE_SOCKET:
+        # The embedding service swaps the collection itself, the workers only follow the version
+        INDEX_SWAPPER.configure(base_collection, shard_configs[0].collection, pointer and pointer['version'],
+                                open_version=lambda name: None, apply=lambda handle: None)
+    else:
+        primary = shards[shard_configs[0].name]['config']
+        embedding_function = shards[primary.name]['embedding_function']
+        INDEX_SWAPPER.configure(base_collection, primary.collection, pointer and pointer['version'],
+                                open_version=lambda name: _open_local_shard(dataclasses.replace(primary, collection=name),
+                                                                            embedding_function),
+                                apply=_swap_primary_shard)
+    INDEX_SWAPPER.start()
+    if RETRIEVAL_MODE == 'hierarchical' and CHROMADB_COLLECTION.get('titles_collection') is None:
+        logger.warning("RETRIEVAL_MODE=hierarchical but there is no title index, searching all chunks. "
+                       "Build it with web_scrapper/chromadb_upload.py.")
+    # After the model is loaded, so that the torch threads are sized for the retrieval threads
+    configure_retrieval_executor()
+    LOOP_MONITOR.start()
+    GENERATIVE_MODELS['gpt-3.5-turbo-stream'] = OpenAIStream(api_key=OPENAI_API_KEY, model="gpt-3.5-turbo", base_url=OPENAI_BASE_URL)
+    GENERATIVE_MODELS['gpt-4-turbo-stream'] = OpenAIStream(api_key=OPENAI_API_KEY, model="gpt-3.5-turbo", base_url=OPENAI_BASE_URL)
+    GENERATIVE_MODELS['llama-2-70b-chat-stream'] = Replicate(model="meta/llama-2-70b-chat", api_token=REPLICATE_API_TOKEN, base_url=REPLICATE_BASE_URL)
+    GENERATIVE_MODELS['falcon-40b-instruct-stream'] = Replicate(model="meta/meta-llama-3-70b-instruct", api_token=REPLICATE_API_TOKEN, base_url=REPLICATE_BASE_URL)
+    GENERATIVE_MODELS['gpt-3.5-turbo'] = OpenAIReg(api_key=OPENAI_API_KEY, model="gpt-3.5-turbo", base_url=OPENAI_BASE_URL)
+    GENERATIVE_MODELS['gpt-4-turbo'] = OpenAIReg(api_key=OPENAI_API_KEY, model="gpt-4-turbo", base_url=OPENAI_BASE_URL)  # 
+    GENERATIVE_MODELS['falcon-40b-instruct'] = ReplicateReg(model="meta/meta-llama-3-70b-instruct", api_token=REPLICATE_API_TOKEN, base_url=REPLICATE_BASE_URL)
+    GENERATIVE_MODELS['llama-2-70b-chat'] = ReplicateReg(model="meta/llama-2-70b-chat", api_token=REPLICATE_API_TOKEN, base_url=REPLICATE_BASE_URL)
+    if OPENAI_BASE_URL:
+        GENERATIVE_MODELS['gpt-3.5-turbo-eval'] = ChatOpenAI(model_name="gpt-4-turbo", openai_api_base=OPENAI_BASE_URL)
+    else:
+        GENERATIVE_MODELS['gpt-3.5-turbo-eval'] = ChatOpenAI(model_name="gpt-4-turbo")
     yield
+    await INDEX_SWAPPER.stop()
+    await LOOP_MONITOR.stop()
+    shutdown_retrieval_executor()
     CHROMADB_COLLECTION.clear()
     GENERATIVE_MODELS.clear()
     
     
 app = FastAPI(lifespan=lifespan)
+app.add_middleware(TracingMiddleware)
+
+
+@app.exception_handler(ServiceOverloaded)
+async def service_overloaded_handler(request: Request, exc: ServiceOverloaded):
+    """
+    Answers requests shed by the admission controller with a 503 and a Retry-After header.
+    """
+    return JSONResponse(status_code=503, content={"detail": str(exc)}, headers={"Retry-After": str(exc.retry_after)})
+
+
+@app.exception_handler(UnknownShard)
+async def unknown_shard_handler(request: Request, exc: UnknownShard):
+    """
+    Answers queries selecting a shard or language that is not available with a 400.
+    """
+    return JSONResponse(status_code=400, content={"detail": str(exc)})
+
+
 app.include_router(router)
\ No newline at end of file
@@ -0,0 +1,167 @@
+"""
+Single-flight coalescing of identical concurrent requests.
+
+`SingleFlight` runs one computation per key and hands its result to every caller that asks for the
+same key while it runs. `StreamCoalescer` does the same for event streams: one producer consumes the
+upstream stream and every subscriber receives all of its events, from the first one, however late it
+joined. In both cases the shared computation is cancelled when the last caller leaves, so a
+disconnecting client still stops the provider calls nobody waits for anymore.
+
+Entries only live while their computation runs; a request arriving afterwards starts a new one.
+"""
+import asyncio
+from typing import AsyncIterator, Awaitable, Callable, Dict, Hashable, List, Optional
+
+
+def flight_key(kind: str, normalized_query: Hashable, model_names: Optional[List[str]]) -> Hashable:
+    """
+    Builds the coalescing key of a request.
+
+    Args:
+        kind (str): The kind of computation, e.g. 'query' or 'stream'. Only requests of the same kind share work.
+        normalized_query (Hashable): The normalized user query, with the shards searched unless they are the default ones.
+        model_names (Optional[List[str]]): The models queried, None for all of them.
+
+    Returns:
+        Hashable: The key.
+    """
+    return kind, normalized_query, None if model_names is None else tuple(sorted(model_names))
+
+
+class SingleFlight:
+    """
+    Deduplicates concurrent calls of the same computation.
+    """
+    def __init__(self):
+        self._flights: Dict[Hashable, List] = {}
+        self.started = 0
+        self.joined = 0
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._flights
+
+    async def do(self, key: Hashable, factory: Callable[[], Awaitable]):
+        """
+        Returns the result of the computation running for the key, starting it with `factory` if there is none.
+
+        Args:
+            key (Hashable): The coalescing key.
+            factory (Callable[[], Awaitable]): Creates the computation.
+
+        Returns:
+            The result of the shared computation. Its exception is raised to every caller.
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            task = asyncio.create_task(factory())
+            flight = self._flights[key] = [task, 0]
+            task.add_done_callback(lambda _: self._flights.pop(key, None) if self._flights.get(key) is flight else None)
+            self.started += 1
+        else:
+            self.joined += 1
+        flight[1] += 1
+        try:
+            return await asyncio.shield(flight[0])
+        finally:
+            flight[1] -= 1
+            if flight[1] == 0 and not flight[0].done():
+                # A request arriving from now on must not join the cancelled computation
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+                flight[0].cancel()
+
+    def stats(self) -> Dict:
+        return {'in_flight': len(self._flights), 'started': self.started, 'joined': self.joined}
+
+
+class _Broadcast:
+    """
+    One upstream stream and the events it produced so far.
+    """
+    def __init__(self, source: AsyncIterator):
+        self.events: List = []
+        self.finished = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self._changed = asyncio.Condition()
+        self.task = asyncio.create_task(self._pump(source))
+
+    async def _pump(self, source: AsyncIterator):
+        try:
+            async for event in source:
+                self.events.append(event)
+                async with self._changed:
+                    self._changed.notify_all()
+        except asyncio.CancelledError:
+            self.error = asyncio.CancelledError()
+            raise
+        except Exception as e:
+            self.error = e
+        finally:
+            if hasattr(source, 'aclose'):
+                await source.aclose()
+            self.finished = True
+            async with self._changed:
+                self._changed.notify_all()
+
+    async def subscribe(self) -> AsyncIterator:
+        position = 0
+        while True:
+            while position < len(self.events):
+                yield self.events[position]
+                position += 1
+            if self.finished:
+                if self.error is not None:
+                    raise self.error
+                return
+            async with self._changed:
+                if position == len(self.events) and not self.finished:
+                    await self._changed.wait()
+
+
+class StreamCoalescer:
+    """
+    Fans out one upstream event stream to every concurrent subscriber with the same key.
+    """
+    def __init__(self):
+        self._broadcasts: Dict[Hashable, _Broadcast] = {}
+        self.started = 0
+        self.joined = 0
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._broadcasts
+
+    async def subscribe(self, key: Hashable, factory: Callable[[], AsyncIterator]) -> AsyncIterator:
+        """
+        Streams the events of the stream running for the key, starting it with `factory` if there is none.
+        Events already produced are replayed first. Closing the last subscriber cancels the stream.
+
+        Args:
+            key (Hashable): The coalescing key.
+            factory (Callable[[], AsyncIterator]): Creates the upstream stream.
+
+        Yields:
+            Every event of the shared stream. Its exception is raised to every subscriber.
+        """
+        broadcast = self._broadcasts.get(key)
+        if broadcast is None:
+            broadcast = self._broadcasts[key] = _Broadcast(factory())
+            broadcast.task.add_done_callback(
+                lambda _: self._broadcasts.pop(key, None) if self._broadcasts.get(key) is broadcast else None)
+            self.started += 1
+        else:
+            self.joined += 1
+        broadcast.subscribers += 1
+        try:
+            async for event in broadcast.subscribe():
+                yield event
+        finally:
+            broadcast.subscribers -= 1
+            if broadcast.subscribers == 0 and not broadcast.task.done():
+                if self._broadcasts.get(key) is broadcast:
+                    del self._broadcasts[key]
+                broadcast.task.cancel()
+                await asyncio.gather(broadcast.task, return_exceptions=True)
+
+    def stats(self) -> Dict:
+        return {'in_flight': len(self._broadcasts), 'started': self.started, 'joined': self.joined}
@@ -10,4 +10,21 @@ class RetryAttemptsFailed(Exception):
 
 class MaximumContextLengthReached(Exception):
     """Maximum context length breach error"""
-    pass
\ No newline at end of file
+    pass
+
+
+class EmbeddingServiceError(Exception):
+    """The shared embedding service failed or could not be reached"""
+    pass
+
+
+class ServiceOverloaded(Exception):
+    """No capacity to admit the request within the queue-time limit"""
+    def __init__(self, message: str, retry_after: int = 1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class UnknownShard(Exception):
+    """A query selected a shard or language that is not available"""
+    pass
@@ -0,0 +1,373 @@
+"""
+Shared embedding and retrieval process for multi-worker serving.
+
+The gte model and the ChromaDB client are loaded once in this process. API workers reach it over a
+Unix socket through `RemoteCollection`, which exposes the subset of the ChromaDB collection API the
+service uses. Requests arriving while a batch is being embedded are grouped into the next batch, so
+concurrent queries from all workers share one forward pass.
+
+Messages are JSON documents prefixed with their length as a 4 byte big-endian integer.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import socket
+import struct
+import threading
+from typing import Dict, List, Optional
+from backend_service.custom_exceptions import EmbeddingServiceError
+
+DEFAULT_SOCKET_PATH = '/tmp/emirates-rag-embedding.sock'
+HEADER = struct.Struct('>I')
+logger = logging.getLogger("backend_service_logger")
+
+
+def encode_message(message: Dict) -> bytes:
+    payload = json.dumps(message).encode('utf-8')
+    return HEADER.pack(len(payload)) + payload
+
+
+async def read_message(reader: asyncio.StreamReader) -> Optional[Dict]:
+    """
+    Reads one message, returning None when the peer closed the connection.
+    """
+    try:
+        header = await reader.readexactly(HEADER.size)
+        return json.loads(await reader.readexactly(HEADER.unpack(header)[0]))
+    except asyncio.IncompleteReadError:
+        return None
+
+
+class EmbeddingService:
+    """
+    Serves embedding and collection queries over a Unix socket with micro-batching.
+
+    Attributes:
+        collection: The ChromaDB collection to query.
+        embedding_function: The embedding function of the collection.
+        socket_path (str): The Unix socket to listen on.
+        max_batch_size (int): The maximum number of requests embedded together.
+        max_wait (float): Seconds to wait for more requests before running a batch that is not full.
+        extra_collections (Dict[str, object]): Further collections, queried by name, e.g. the title index.
+        embedding_functions (Dict[str, object]): The embedding functions of extra collections embedded with
+            another model than `embedding_function`, e.g. the shards of another language.
+    """
+    def __init__(self, collection, embedding_function, socket_path: str = DEFAULT_SOCKET_PATH,
+                 max_batch_size: int = 32, max_wait: float = 0.002, extra_collections: Optional[Dict] = None,
+                 embedding_functions: Optional[Dict] = None):
+        self.collection = collection
+        self.collections = {None: collection, **(extra_collections or {})}
+        self.embedding_function = embedding_function
+        self.embedding_functions = embedding_functions or {}
+        self.socket_path = socket_path
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = None
+
+    def swap_primary(self, handle):
+        """
+        Serves a new version of the main collection and its title index, see `index_versions.IndexSwapper`.
+
+        Args:
+            handle (Tuple): The collection and its title index, which may be None.
+
+        Returns:
+            Tuple: The collection and title index replaced.
+        """
+        collection, titles_collection = handle
+        replaced = (self.collection, self.collections.get('titles'))
+        collections = {**self.collections, None: collection}
+        collections.pop('titles', None)
+        if titles_collection is not None:
+            collections['titles'] = titles_collection
+        self.collection, self.collections = collection, collections
+        return replaced
+
+    async def serve(self, ready=None):
+        """
+        Listens on the socket until cancelled.
+
+        Args:
+            ready (optional): A threading or multiprocessing event set once the socket accepts connections.
+        """
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self._queue = asyncio.Queue()
+        server = await asyncio.start_unix_server(self._handle_connection, path=self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        batcher = asyncio.create_task(self._batch_loop())
+        logger.info(f"Embedding service listening on {self.socket_path}")
+        if ready is not None:
+            ready.set()
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request = await read_message(reader)
+                if request is None:
+                    break
+                if request.get('op') == 'ping':
+                    response = {'ok': True, 'collections': [name for name in self.collections if name is not None]}
+                else:
+                    future = asyncio.get_running_loop().create_future()
+                    await self._queue.put((request, future))
+                    try:
+                        response = {'result': await future}
+                    except Exception as e:
+                        logger.error(f"Embedding service request failed: {e}")
+                        response = {'error': f"{type(e).__name__}: {e}"}
+                writer.write(encode_message(response))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0 and self._queue.empty():
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), max(timeout, 0)))
+                except asyncio.TimeoutError:
+                    break
+            # Requests arriving while this batch runs in the thread are grouped into the next one
+            try:
+                results = await asyncio.to_thread(self.run_batch, [request for request, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def run_batch(self, requests: List[Dict]) -> List:
+        """
+        Embeds the texts of all requests in one call per embedding model and runs one collection query per
+        distinct set of query parameters.
+
+        Args:
+            requests (List[Dict]): 'embed' requests with 'texts', or 'query' requests with 'query_texts' or
+                'query_embeddings', 'n_results' and optional 'where', 'include' and 'collection'. Texts are
+                embedded with the model of the request's 'collection'.
+
+        Returns:
+            List: The embeddings or query result of every request, in order.
+        """
+        pending, slices = {}, []
+        for request in requests:
+            texts = [] if request.get('query_embeddings') else request.get('texts') or request.get('query_texts') or []
+            function = self.embedding_functions.get(request.get('collection'), self.embedding_function)
+            batch = pending.setdefault(id(function), (function, []))[1]
+            slices.append((id(function), len(batch), len(texts)))
+            batch.extend(texts)
+        embeddings = {key: function(texts) if texts else [] for key, (function, texts) in pending.items()}
+        # Read once: a new index version may be swapped in while the batch runs
+        collections = self.collections
+        results, groups = [None] * len(requests), {}
+        for index, request in enumerate(requests):
+            if request.get('query_embeddings'):
+                request_embeddings = request['query_embeddings']
+            else:
+                key, start, count = slices[index]
+                request_embeddings = embeddings[key][start:start + count]
+            if request['op'] == 'embed':
+                results[index] = request_embeddings
+                continue
+            key = json.dumps([request.get('collection'), request.get('n_results', 10), request.get('where'),
+                              request.get('include')], sort_keys=True)
+            groups.setdefault(key, []).append((index, request_embeddings))
+        for key, members in groups.items():
+            collection_name, n_results, where, include = json.loads(key)
+            if collection_name not in collections:
+                raise ValueError(f"Unknown collection: {collection_name}")
+            query_embeddings = [embedding for _, request_embeddings in members for embedding in request_embeddings]
+            kwargs = {'query_embeddings': query_embeddings, 'n_results': n_results, 'where': where}
+            if include is not None:
+                kwargs['include'] = include
+            result = collections[collection_name].query(**kwargs)
+            offset = 0
+            for index, request_embeddings in members:
+                count = len(request_embeddings)
+                results[index] = {field: value[offset:offset + count] if field != 'included'
+                                  and isinstance(value, list) else value
+                                  for field, value in result.items()}
+                offset += count
+        return results
+
+
+class RemoteCollection:
+    """
+    Client of the `EmbeddingService`, usable wherever the service expects a ChromaDB collection.
+
+    Each thread keeps its own connection, so the client is safe to use from executor threads.
+
+    Attributes:
+        socket_path (str): The Unix socket of the embedding service.
+        timeout (float): Seconds to wait for a response.
+        collection (Optional[str]): The extra collection of the service to query, None for the main one.
+    """
+    def __init__(self, socket_path: str = DEFAULT_SOCKET_PATH, timeout: float = 30.0, collection: Optional[str] = None):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.collection = collection
+        self._local = threading.local()
+
+    def _connection(self) -> socket.socket:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            connection.settimeout(self.timeout)
+            connection.connect(self.socket_path)
+            self._local.connection = connection
+        return connection
+
+    def _close(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    def _receive_exactly(self, connection: socket.socket, size: int) -> bytes:
+        data = bytearray()
+        while len(data) < size:
+            chunk = connection.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("Embedding service closed the connection")
+            data.extend(chunk)
+        return bytes(data)
+
+    def _request(self, message: Dict):
+        # A connection broken by a restart of the service is re-established once
+        for attempt in range(2):
+            try:
+                connection = self._connection()
+                connection.sendall(encode_message(message))
+                header = self._receive_exactly(connection, HEADER.size)
+                response = json.loads(self._receive_exactly(connection, HEADER.unpack(header)[0]))
+                break
+            except (OSError, ConnectionError) as e:
+                self._close()
+                if attempt:
+                    raise EmbeddingServiceError(f"Embedding service at {self.socket_path} unavailable: {e}")
+        if 'error' in response:
+            raise EmbeddingServiceError(response['error'])
+        return response.get('result', response)
+
+    def ping(self) -> bool:
+        """
+        Returns whether the service answers.
+        """
+        try:
+            self._request({'op': 'ping'})
+            return True
+        except EmbeddingServiceError:
+            return False
+
+    def collections(self) -> List[str]:
+        """
+        Returns the names of the extra collections the service serves.
+        """
+        return self._request({'op': 'ping'}).get('collections', [])
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embeds texts with the shared model of the collection.
+        """
+        return self._request({'op': 'embed', 'texts': list(texts), 'collection': self.collection})
+
+    def query(self, query_texts: Optional[List[str]] = None, n_results: int = 10, where: Optional[Dict] = None,
+              include: Optional[List[str]] = None, query_embeddings: Optional[List[List[float]]] = None) -> Dict:
+        """
+        Queries the shared collection, like `chromadb.Collection.query`.
+        """
+        return self._request({'op': 'query', 'query_texts': list(query_texts or []), 'n_results': n_results,
+                              'where': where, 'include': include, 'collection': self.collection,
+                              'query_embeddings': [list(embedding) for embedding in query_embeddings or []]})
+
+
+def run_embedding_service(collection_name: str, socket_path: str = DEFAULT_SOCKET_PATH, max_batch_size: int = 32,
+                          max_wait: float = 0.002, ready=None):
+    """
+    Loads the model and the collection and serves them until the process is terminated.
+
+    When chromadb_data/shards.json lists shards (see `backend_service.shards`), the first one is served
+    as the main collection and the others as 'shard:<name>', each with its own embedding model. The main
+    collection follows the versions published by `web_scrapper/reindex.py`, see `index_versions`.
+
+    Args:
+        collection_name (str): The ChromaDB collection to serve when no shards are configured.
+        socket_path (str, optional): The Unix socket to listen on.
+        max_batch_size (int, optional): The maximum number of requests embedded together. Defaults to 32.
+        max_wait (float, optional): Seconds to wait for a batch to fill. Defaults to 0.002.
+        ready (optional): An event set once the socket accepts connections.
+    """
+    from backend_service.embedding_func import CustomEmbeddingFunction
+    from backend_service.helper_functions import get_chromadb_collection, get_titles_collection
+    from backend_service.shards import load_shard_configs
+    from backend_service.index_versions import IndexSwapper, read_index_pointer
+    primary, *shard_configs = load_shard_configs(default_collection=collection_name)
+    pointer = read_index_pointer(primary.collection)
+    served_collection = primary.collection if pointer is None else pointer['collection']
+    models = {primary.embedding_model: CustomEmbeddingFunction(model_name=primary.embedding_model)}
+    embedding_function = models[primary.embedding_model]
+    collection = get_chromadb_collection(served_collection, embedding_function)
+    extra_collections, embedding_functions = {}, {}
+    titles_collection = get_titles_collection(served_collection, embedding_function)
+    if titles_collection is not None:
+        extra_collections['titles'] = titles_collection
+    for config in shard_configs:
+        if config.embedding_model not in models:
+            models[config.embedding_model] = CustomEmbeddingFunction(model_name=config.embedding_model)
+        name = f"shard:{config.name}"
+        try:
+            extra_collections[name] = get_chromadb_collection(config.collection, models[config.embedding_model])
+        except ValueError:
+            logger.warning(f"Collection {config.collection} of shard {config.name} does not exist, skipping the shard")
+            continue
+        embedding_functions[name] = models[config.embedding_model]
+    service = EmbeddingService(collection, embedding_function, socket_path, max_batch_size, max_wait,
+                               extra_collections=extra_collections, embedding_functions=embedding_functions)
+    swapper = IndexSwapper()
+    swapper.configure(primary.collection, served_collection, pointer and pointer['version'],
+                      open_version=lambda name: (get_chromadb_collection(name, embedding_function),
+                                                 get_titles_collection(name, embedding_function)),
+                      apply=service.swap_primary)
+
+    async def serve():
+        swapper.start()
+        try:
+            await service.serve(ready)
+        finally:
+            await swapper.stop()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Shared embedding and retrieval service.")
+    parser.add_argument('--collection', default='info-services-index')
+    parser.add_argument('--socket', default=os.environ.get('EMBEDDING_SERVICE_SOCKET', DEFAULT_SOCKET_PATH))
+    parser.add_argument('--max-batch-size', type=int, default=32)
+    parser.add_argument('--max-wait', type=float, default=0.002, help="seconds to wait for a batch to fill")
+    args = parser.parse_args()
+    run_embedding_service(args.collection, args.socket, args.max_batch_size, args.max_wait)
@@ -7,8 +7,10 @@ import replicate
 from openai import AsyncOpenAI
 from fastapi.encoders import jsonable_encoder
 import replicate.client
+from replicate.stream import ServerSentEvent
 from backend_service.schema import MessagesRequest
 from backend_service.custom_exceptions import RateLimitError, RetryAttemptsFailed, MaximumContextLengthReached
+from backend_service.tracing import span
 
 
 
@@ -63,7 +65,8 @@ class LLMGen(ABC):
         """
         decoded_messages = jsonable_encoder(data)
         prompts = decoded_messages['messages']
-        logger.info("Requested with prompt: {}".format(prompts))
+        # The formatter truncates the prompt in the listener thread, it includes every retrieved context
+        logger.info("Requested with prompt", extra={'payload': {'prompt': prompts, 'messages': len(prompts)}})
         # Retry by continuing the loop
         for idx in range(max_attempts):
             logger.info("Retry attempt: %d", idx + 1)
@@ -125,12 +128,15 @@ class OpenAIReg(LLMGen):
         Returns:
             dict: A dictionary containing the generated text.
         """
-        response = await self.client.chat.completions.create(
-            model=self.model,
-            messages=messages,
-            temperature=0.0,
-            stop=[],
-        )
+        with span('openai.chat_completion', model=self.model) as current:
+            response = await self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                temperature=0.0,
+                stop=[],
+            )
+            if current is not None and response.usage is not None:
+                current.attributes['completion_tokens'] = response.usage.completion_tokens
         text = response.choices[0].message.content
         return self._format_output(text)
     
@@ -143,24 +149,33 @@ class OpenAIStream():
     Attributes:
         api_key (str): The API key for the OpenAI service.
         model (str): The name of the OpenAI model to use for generation.
+        base_url (Optional[str]): The base URL for the OpenAI API.
 
     Methods:
-        __init__(self, api_key: str, model: str) -> None: Initializes the OpenAIStream class with the provided API key and model name.
+        __init__(self, api_key: str, model: str, base_url: Optional[str] = None) -> None: Initializes the OpenAIStream class with the provided API key, model name, and optional base URL.
 
         generate(self, user_query: List[Dict[str,str]]) -> Dict[str, str]: Generates text based on the provided user query using the OpenAI API in a streaming manner.
 
+        async astream(self, messages: List[Dict[str,str]]) -> AsyncIterator[Dict]: Streams text deltas and the token usage with the async client.
+
     """
 
-    def __init__(self, api_key, model) -> None:
+    def __init__(self, api_key, model, base_url=None) -> None:
         """
-        Initializes the OpenAIStream class with the provided API key and model name.
+        Initializes the OpenAIStream class with the provided API key, model name, and optional base URL.
 
         Args:
             api_key (str): The API key for the OpenAI service.
             model (str): The name of the OpenAI model to use for generation.
+            base_url (Optional[str]): The base URL for the OpenAI API. Default is None.
         """
         self.model = model
-        self.client = OpenAI(api_key=api_key)
+        if base_url:
+            self.client = OpenAI(api_key=api_key, base_url=base_url)
+            self.async_client = AsyncOpenAI(api_key=api_key, base_url=base_url)
+        else:
+            self.client = OpenAI(api_key=api_key)
+            self.async_client = AsyncOpenAI(api_key=api_key)
 
     def generate(self, user_query: List[Dict[str,str]]):
         """
@@ -180,6 +195,34 @@ class OpenAIStream():
             stop=[],
         )
         return stream
+
+    async def astream(self, messages: List[Dict[str,str]]):
+        """
+        Streams text deltas without blocking the event loop. The upstream request is closed when the
+        generator is closed or cancelled, e.g. because the client disconnected.
+
+        Args:
+            messages (List[Dict[str,str]]): A list of message dictionaries representing the conversation history.
+
+        Yields:
+            dict: {"text": delta} for every delta, and a last {"text": "", "usage": {...}} with the token usage.
+        """
+        stream = await self.async_client.chat.completions.create(
+            model=self.model,
+            messages=messages,
+            temperature=0.0,
+            stream=True,
+            stream_options={"include_usage": True},
+            stop=[],
+        )
+        try:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield {"text": chunk.choices[0].delta.content}
+                if chunk.usage is not None:
+                    yield {"text": "", "usage": chunk.usage.model_dump()}
+        finally:
+            await stream.close()
     
     
     
@@ -190,23 +233,30 @@ class Replicate():
     Attributes:
         api_token (str): The API token for the Replicate service.
         model (str): The name of the Replicate model to use for generation.
+        base_url (Optional[str]): The base URL for the Replicate API.
 
     Methods:
-        __init__(self, api_token: str, model: str) -> None: Initializes the Replicate class with the provided API token and model name.
+        __init__(self, model: str, api_token: str, base_url: Optional[str] = None) -> None: Initializes the Replicate class with the provided API token, model name, and optional base URL.
 
         async generate(self, user_query: str) -> Dict[str, str]: Generates text based on the provided user query using the Replicate API.
 
+        async astream(self, user_query: str) -> AsyncIterator[Dict]: Streams text deltas with the async client.
+
     """
-    def __init__(self,model:str, api_token: str) -> None:
+    def __init__(self,model:str, api_token: str, base_url: Optional[str] = None) -> None:
         """
-        Initializes the Replicate class with the provided API token and model name.
+        Initializes the Replicate class with the provided API token, model name, and optional base URL.
 
         Args:
             model (str): The name of the Replicate model to use for generation.
             api_token (str): The API token for the Replicate service.
+            base_url (Optional[str]): The base URL for the Replicate API. Default is None.
         """
         self.model = model
-        self.client = replicate.Client(api_token=api_token)
+        if base_url:
+            self.client = replicate.Client(api_token=api_token, base_url=base_url)
+        else:
+            self.client = replicate.Client(api_token=api_token)
         
     def generate(self, user_query: str):
         """
@@ -218,7 +268,21 @@ class Replicate():
         Returns:
             stream: A stream of generated text.
         """
-        input = {
+        return self.client.stream(
+            self.model,
+            input=self._input(user_query))
+
+    def _input(self, user_query: str):
+        """
+        Builds the model input for a prompt.
+
+        Args:
+            user_query (str): The user query as a string.
+
+        Returns:
+            dict: The input of the Replicate prediction.
+        """
+        return {
             "top_p": 1,
             "prompt": user_query,
             "temperature": 0.01,
@@ -226,9 +290,27 @@ class Replicate():
             "max_new_tokens": 500
         }
 
-        return self.client.stream(
-            self.model,
-            input=input)
+    async def astream(self, user_query: str):
+        """
+        Streams text deltas without blocking the event loop. The upstream stream is closed when the
+        generator is closed or cancelled, e.g. because the client disconnected.
+
+        Args:
+            user_query (str): The user query as a string.
+
+        Yields:
+            dict: {"text": delta} for every output event. Replicate does not report token usage.
+        """
+        events = await self.client.async_stream(self.model, input=self._input(user_query))
+        try:
+            async for event in events:
+                if event.event == ServerSentEvent.EventType.OUTPUT:
+                    yield {"text": str(event)}
+                elif event.event == ServerSentEvent.EventType.ERROR:
+                    raise RuntimeError(f"Replicate stream of {self.model} failed: {event.data}")
+        finally:
+            if hasattr(events, 'aclose'):
+                await events.aclose()
 
 
 
@@ -239,23 +321,28 @@ class ReplicateReg():
     Attributes:
         api_token (str): The API token for the Replicate service.
         model (str): The name of the Replicate model to use for generation.
+        base_url (Optional[str]): The base URL for the Replicate API.
 
     Methods:
-        __init__(self, api_token: str, model: str) -> None: Initializes the ReplicateReg class with the provided API token and model name.
+        __init__(self, model: str, api_token: str, base_url: Optional[str] = None) -> None: Initializes the ReplicateReg class with the provided API token, model name, and optional base URL.
 
         async generate(self, user_query: str) -> Dict[str, str]: Generates text based on the provided user query using the Replicate API with a custom system prompt.
 
     """
-    def __init__(self,model:str, api_token: str) -> None:
+    def __init__(self,model:str, api_token: str, base_url: Optional[str] = None) -> None:
         """
-        Initializes the ReplicateReg class with the provided API token and model name.
+        Initializes the ReplicateReg class with the provided API token, model name, and optional base URL.
 
         Args:
             model (str): The name of the Replicate model to use for generation.
             api_token (str): The API token for the Replicate service.
+            base_url (Optional[str]): The base URL for the Replicate API. Default is None.
         """
         self.model = model
-        self.client = replicate.Client(api_token=api_token)
+        if base_url:
+            self.client = replicate.Client(api_token=api_token, base_url=base_url)
+        else:
+            self.client = replicate.Client(api_token=api_token)
     
     def _format_output(self, text: str):
         """
@@ -292,5 +379,6 @@ class ReplicateReg():
             "max_new_tokens": 500
         }
 
-        response = await self.client.async_run(self.model, input=input)
+        with span('replicate.run', model=self.model):
+            response = await self.client.async_run(self.model, input=input)
         return self._format_output(response)
\ No newline at end of file
@@ -1,55 +1,262 @@
 import chromadb
 import os
-from typing import Dict, List
+import sys
+import json
+import math
+import time
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import AsyncIterator, Dict, List, Optional, Sequence, Tuple
 import logging
 import asyncio
-from logging.handlers import RotatingFileHandler
+import atexit
+import queue
+from logging.handlers import RotatingFileHandler, QueueListener
 from ragas.metrics import (
     answer_relevancy,
     faithfulness,
 )
 from datasets import Dataset
 from ragas import evaluate
-from backend_service.embedding_func import CustomEmbeddingFunction
 from backend_service.prompt import prompt_template
 from backend_service.schema import ModelEvalResponse, ModelEvalRequest, ModelResponse, ModelEvaluation
+from backend_service.tracing import span
+from backend_service.admission import MODEL_LATENCY
+from backend_service.shards import select_shards, merge_shard_results
+from backend_service.generation_models import Replicate, ReplicateReg
+from backend_service.structured_logging import JsonFormatter, TextFormatter, RateLimitFilter, PayloadQueueHandler
+
+# 'flat' searches all chunks, 'hierarchical' first picks the best pages from the title index
+RETRIEVAL_MODE = os.environ.get('RETRIEVAL_MODE', 'flat')
+RETRIEVAL_TOP_PAGES = int(os.environ.get('RETRIEVAL_TOP_PAGES', 3))
+TITLES_COLLECTION_SUFFIX = '-titles'
+# Threads running the embedding forward pass and the vector search off the event loop
+RETRIEVAL_WORKERS = int(os.environ.get('RETRIEVAL_WORKERS', min(4, os.cpu_count() or 1)))
+_RETRIEVAL_EXECUTOR = None
+_RETRIEVAL_STATS = {'pending': 0, 'completed': 0}
+# Threads searching the shards of a multi-shard query concurrently, and how long a shard may take to answer
+SHARD_SEARCH_WORKERS = int(os.environ.get('SHARD_SEARCH_WORKERS', 8))
+SHARD_SEARCH_TIMEOUT = float(os.environ.get('SHARD_SEARCH_TIMEOUT', 2.0))
+_SHARD_EXECUTOR = None
+_SHARD_EXECUTOR_LOCK = threading.Lock()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')
+LOG_MAX_FIELD_CHARS = int(os.environ.get('LOG_MAX_FIELD_CHARS', 2000))
+LOG_RATE_LIMIT = float(os.environ.get('LOG_RATE_LIMIT', 50))
+_LOG_LISTENERS = {}
+logger = logging.getLogger('backend_service_logger')
+
+
+CHROMADB_DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'chromadb_data')
+# Written by web_scrapper/hnsw_sweep.py --write-config
+HNSW_CONFIG_PATH = os.environ.get('HNSW_CONFIG_PATH', os.path.join(CHROMADB_DATA_PATH, 'hnsw_config.json'))
 
 
 def get_chromadb_client():
     """
     Initializes and returns a ChromaDB client using the relative path to the 'chromadb_data' directory.
     """
-    # Get the directory of the current file
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-    # Construct the path to the folder one level up
-    relative_path = os.path.join(current_dir, '..', '..', 'chromadb_data')
-    return chromadb.PersistentClient(path=relative_path)
+    return chromadb.PersistentClient(path=CHROMADB_DATA_PATH)
+
+
+def load_hnsw_config(config_path: str = HNSW_CONFIG_PATH) -> Dict:
+    """
+    Loads the recommended HNSW settings.
+    :param config_path: The path to the config written by `web_scrapper/hnsw_sweep.py`.
+    :return: The HNSW collection metadata, or an empty dict if there is no config.
+    """
+    if not os.path.exists(config_path):
+        return {}
+    with open(config_path) as f:
+        return json.load(f)['metadata']
+
+
+def check_hnsw_config(collection, hnsw_config: Dict) -> List[str]:
+    """
+    Compares the HNSW settings a collection was built with to the recommended ones. ChromaDB fixes the
+    settings when a collection is created, so a mismatch means the index has to be rebuilt with
+    `web_scrapper/chromadb_upload.py` to apply them.
+    :param collection: The ChromaDB collection.
+    :param hnsw_config: The recommended HNSW collection metadata.
+    :return: The mismatching settings, formatted for the log.
+    """
+    metadata = collection.metadata or {}
+    return [f"{key}={metadata.get(key, 'default')} (recommended {value})"
+            for key, value in hnsw_config.items() if metadata.get(key) != value]
 
 
-def get_chromadb_collection(collection_name: str):
+def get_chromadb_collection(collection_name: str, embedding_function=None):
     """
     Retrieves a specific collection from ChromaDB using a custom embedding function.
     :param collection_name: The name of the collection to retrieve.
+    :param embedding_function: The embedding function to use, a new CustomEmbeddingFunction by default.
     :return: The requested ChromaDB collection.
     """
+    # Imported here so that API workers served by the shared embedding service never load torch
+    from backend_service.embedding_func import CustomEmbeddingFunction
     client = get_chromadb_client()
-    custom_embedding_function = CustomEmbeddingFunction()
+    custom_embedding_function = embedding_function or CustomEmbeddingFunction()
     collection = client.get_collection(name=collection_name, embedding_function=custom_embedding_function)
+    mismatches = check_hnsw_config(collection, load_hnsw_config())
+    if mismatches:
+        logger.warning(f"Collection {collection_name} was built with other HNSW settings than {HNSW_CONFIG_PATH}: "
+                       f"{', '.join(mismatches)}. Rebuild it with web_scrapper/chromadb_upload.py to apply them.")
     return collection
-    
 
 
-def perform_semantic_search(query: str, collection: Dict[str,chromadb.PersistentClient]):
+def get_titles_collection(collection_name: str, embedding_function=None):
+    """
+    Retrieves the page title index built next to a collection by `web_scrapper/chromadb_upload.py`.
+    :param collection_name: The name of the chunk collection.
+    :param embedding_function: The embedding function to use, a new CustomEmbeddingFunction by default.
+    :return: The title collection, or None if it was not built.
+    """
+    from backend_service.embedding_func import CustomEmbeddingFunction
+    client = get_chromadb_client()
+    try:
+        return client.get_collection(name=collection_name + TITLES_COLLECTION_SUFFIX,
+                                     embedding_function=embedding_function or CustomEmbeddingFunction())
+    except ValueError:
+        return None
+
+
+def search_within_pages(query_embeddings, collection: Dict, n_results: int = 5, top_pages: int = RETRIEVAL_TOP_PAGES):
+    """
+    Hierarchical search: picks the best pages from the title index, then ranks only the chunks of these
+    pages, so the cost of the second stage depends on the number of pages selected instead of the size
+    of the corpus. The chunks are grouped by page, best page first.
+    :param query_embeddings: The embedding of the query.
+    :param collection: A dictionary with the chunk collection and the title index under 'titles_collection'.
+    :param n_results: The number of chunks to return.
+    :param top_pages: The number of pages searched.
+    :return: The chunks, or None if the pages do not hold enough chunks, e.g. for an index built before
+        the chunks stored their page title.
+    """
+    with span('retrieval.pages'):
+        pages = collection['titles_collection'].query(
+            query_embeddings=query_embeddings,
+            n_results=top_pages,
+            include=['documents'],
+        )
+    titles = pages['documents'][0]
+    if not titles:
+        return None
+    with span('retrieval.search', pages=len(titles)):
+        search_results = collection['chromadb_collection'].query(
+            query_embeddings=query_embeddings,
+            n_results=n_results,
+            where={'title': {'$in': titles}},
+            include=['documents', 'metadatas'],
+        )
+    documents, metadatas = search_results['documents'][0], search_results['metadatas'][0]
+    if len(documents) < n_results:
+        return None
+    page_rank = {title: rank for rank, title in enumerate(titles)}
+    ranked = sorted(zip(documents, metadatas), key=lambda result: page_rank.get(result[1].get('title'), len(titles)))
+    return [document for document, _ in ranked]
+
+
+def _shard_executor() -> ThreadPoolExecutor:
+    global _SHARD_EXECUTOR
+    with _SHARD_EXECUTOR_LOCK:
+        if _SHARD_EXECUTOR is None:
+            _SHARD_EXECUTOR = ThreadPoolExecutor(max_workers=SHARD_SEARCH_WORKERS, thread_name_prefix='shard-search')
+        return _SHARD_EXECUTOR
+
+
+def _search_shard(shard: Dict, query_embeddings, n_results: int):
+    config = shard['config']
+    with span(f'retrieval.search.{config.name}'):
+        search_results = shard['chromadb_collection'].query(
+            query_embeddings=query_embeddings,
+            n_results=n_results,
+            include=['documents', 'distances'],
+        )
+    return config, search_results['documents'][0], search_results['distances'][0]
+
+
+def search_shards(query: str, shards: List[Dict], n_results: int = 5, timeout: float = SHARD_SEARCH_TIMEOUT) -> List[str]:
+    """
+    Searches several shards concurrently and merges their top results, see `shards.merge_shard_results`.
+
+    The query is embedded once per distinct embedding function and all shards are then searched at the
+    same time, so the latency is that of the slowest shard rather than the sum over all shards. A shard
+    that has not answered within `timeout` seconds, or that fails, is left out and logged.
+    :param query: The search query string.
+    :param shards: The shard dictionaries, each with 'config', 'chromadb_collection' and 'embedding_function'.
+    :param n_results: The number of documents returned.
+    :param timeout: Seconds the searches may take once the query is embedded.
+    :return: The merged documents, best first.
+    """
+    executor = _shard_executor()
+    functions = {id(shard['embedding_function']): shard['embedding_function'] for shard in shards}
+    with span('retrieval.embed', models=len(functions)):
+        if len(functions) == 1:
+            embeddings = {key: function([query]) for key, function in functions.items()}
+        else:
+            embedding_futures = {key: executor.submit(contextvars.copy_context().run, function, [query])
+                                 for key, function in functions.items()}
+            embeddings = {key: future.result() for key, future in embedding_futures.items()}
+    search_futures = [(shard['config'].name, executor.submit(contextvars.copy_context().run, _search_shard, shard,
+                                                             embeddings[id(shard['embedding_function'])], n_results))
+                      for shard in shards]
+    done, _ = wait([future for _, future in search_futures], timeout=timeout)
+    results = []
+    for name, future in search_futures:
+        if future not in done:
+            future.cancel()
+            logger.warning(f"Shard {name} did not answer within {timeout}s, leaving it out")
+            continue
+        try:
+            results.append(future.result())
+        except Exception:
+            logger.exception(f"Search of shard {name} failed, leaving it out")
+    if not results:
+        raise RuntimeError(f"None of the shards {', '.join(name for name, _ in search_futures)} answered")
+    return merge_shard_results(results, n_results)
+
+
+def perform_semantic_search(query: str, collection: Dict[str,chromadb.PersistentClient], shards: Optional[Sequence[str]] = None):
     """
     Performs a semantic search on a given ChromaDB collection.
+
+    With RETRIEVAL_MODE=hierarchical and a title index under 'titles_collection', only the chunks of
+    the RETRIEVAL_TOP_PAGES best pages are searched (see `search_within_pages`); otherwise, or when
+    these pages hold too few chunks, all chunks are searched.
+
+    When the dictionary holds a shard registry under 'shards', the selected shards are searched; more
+    than one shard is searched concurrently, each flat, by `search_shards`.
     :param query: The search query string.
-    :param collection: A dictionary containing the ChromaDB collection to search in.
+    :param collection: A dictionary containing the ChromaDB collection to search in, and optionally its
+        embedding function under 'embedding_function' so that embedding and search are timed separately.
+    :param shards: The names of the shards to search, the default shards when None.
     :return: A list of search results.
     """
-    search_results = collection['chromadb_collection'].query(
-        query_texts=[query],
-        n_results=5,
-    )
+    shard_collections = collection.get('shards')
+    if shard_collections:
+        names = shards or select_shards({name: shard['config'] for name, shard in shard_collections.items()})
+        if len(names) > 1:
+            return [search_shards(query, [shard_collections[name] for name in names])]
+        collection = shard_collections[names[0]]
+    embedding_function = collection.get('embedding_function')
+    if embedding_function is None:
+        with span('retrieval'):
+            search_results = collection['chromadb_collection'].query(
+                query_texts=[query],
+                n_results=5,
+            )
+        return [result for result in search_results['documents']]
+    with span('retrieval.embed'):
+        query_embeddings = embedding_function([query])
+    if RETRIEVAL_MODE == 'hierarchical' and collection.get('titles_collection') is not None:
+        documents = search_within_pages(query_embeddings, collection)
+        if documents is not None:
+            return [documents]
+    with span('retrieval.search'):
+        search_results = collection['chromadb_collection'].query(
+            query_embeddings=query_embeddings,
+            n_results=5,
+        )
     return [result for result in search_results['documents']]
 
 
@@ -57,6 +264,12 @@ def perform_semantic_search(query: str, collection: Dict[str,chromadb.Persistent
 def setup_logger(name, level=logging.INFO, log_file='backend_service.log'):
     """
     Sets up and returns a logger with specified name, level, and log file.
+
+    Records are put on an in-process queue and written by a background listener thread, so formatting
+    and disk I/O never run on the event loop. Output is JSON (LOG_FORMAT=text for the plain format),
+    long message and payload fields are truncated to LOG_MAX_FIELD_CHARS characters, and every logger
+    is limited to LOG_RATE_LIMIT records per second below WARNING. Calling it again returns the
+    configured logger.
     :param name: The name of the logger.
     :param level: The logging level.
     :param log_file: The file to log messages to.
@@ -65,16 +278,29 @@ def setup_logger(name, level=logging.INFO, log_file='backend_service.log'):
     # Creating logger
     logger = logging.getLogger(name)
     logger.setLevel(level)
+    if name in _LOG_LISTENERS:
+        return logger
     # Create handlers
     stream_handler = logging.StreamHandler()
     file_handler = RotatingFileHandler(log_file, maxBytes=10485760, backupCount=5)  # 10MB per file, max 5 files
     # Create formatter and add it to the handlers
-    formatter = logging.Formatter('%(asctime)s | %(levelname)s | %(filename)s | %(message)s')
+    if LOG_FORMAT == 'text':
+        formatter = TextFormatter(max_field_chars=LOG_MAX_FIELD_CHARS)
+    else:
+        formatter = JsonFormatter(max_field_chars=LOG_MAX_FIELD_CHARS)
     stream_handler.setFormatter(formatter)
     file_handler.setFormatter(formatter)
+    # The handlers run on the listener thread, the logger only enqueues records
+    log_queue = queue.SimpleQueue()
+    queue_handler = PayloadQueueHandler(log_queue)
+    queue_handler.addFilter(RateLimitFilter(rate=LOG_RATE_LIMIT))
+    listener = QueueListener(log_queue, stream_handler, file_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    _LOG_LISTENERS[name] = listener
     # Add handlers to the logger
-    logger.addHandler(stream_handler)
-    logger.addHandler(file_handler)
+    logger.addHandler(queue_handler)
+    logger.propagate = False
     return logger
 
 def get_port(default=9007):
@@ -98,76 +324,487 @@ def generate_prompt(question, summaries):
     :param summaries: A list of summaries to include in the prompt.
     :return: A string containing the generated prompt.
     """
-    summaries = summaries[0]
-    summaries = [f"Source #{i+1}\n {summary}" for i, summary in enumerate(summaries)]
-    prompt = prompt_template.format(question=question, summaries='\n'.join(summaries))
+    with span('prompt'):
+        summaries = summaries[0]
+        summaries = [f"Source #{i+1}\n {summary}" for i, summary in enumerate(summaries)]
+        prompt = prompt_template.format(question=question, summaries='\n'.join(summaries))
     return prompt
       
 
       
-async def query_models_async(user_query:str, generative_models) -> List[ModelResponse]:
+def retrieve_and_build_prompt(question: str, collection: Dict, shards: Optional[Sequence[str]] = None) -> Tuple[List[str], str]:
+    """
+    Runs the semantic search and builds the prompt once per query, to be shared by every model.
+    :param question: The user's question.
+    :param collection: A dictionary containing the ChromaDB collection to search in.
+    :param shards: The shards to search, the default shards when None.
+    :return: The retrieved contexts and the prompt.
+    """
+    retrieved_summaries = perform_semantic_search(query=question, collection=collection, shards=shards)
+    prompt = generate_prompt(question=question, summaries=retrieved_summaries)
+    return retrieved_summaries[0], prompt
+
+
+def configure_retrieval_executor(workers: int = RETRIEVAL_WORKERS) -> ThreadPoolExecutor:
+    """
+    Creates the thread pool the retrieval runs on, once per process.
+
+    Torch runs every forward pass on its own intra-op thread pool, by default one thread per core, so
+    `workers` concurrent forward passes would oversubscribe the CPU. Torch is therefore limited to
+    cores // workers threads (TORCH_NUM_THREADS overrides it). Nothing is changed when torch is not
+    loaded, e.g. in API workers served by the shared embedding service.
+    :param workers: The number of retrieval threads.
+    :return: The executor.
+    """
+    global _RETRIEVAL_EXECUTOR
+    if _RETRIEVAL_EXECUTOR is None:
+        _RETRIEVAL_EXECUTOR = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='retrieval')
+        torch = sys.modules.get('torch')
+        if torch is not None:
+            torch_threads = int(os.environ.get('TORCH_NUM_THREADS', 0)) or max(1, (os.cpu_count() or 1) // workers)
+            torch.set_num_threads(torch_threads)
+            logger.info(f"Retrieval runs on {workers} threads with {torch_threads} torch threads each")
+    return _RETRIEVAL_EXECUTOR
+
+
+def shutdown_retrieval_executor():
+    """
+    Stops the retrieval and shard search threads, waiting for the running searches.
+    """
+    global _RETRIEVAL_EXECUTOR, _SHARD_EXECUTOR
+    if _RETRIEVAL_EXECUTOR is not None:
+        _RETRIEVAL_EXECUTOR.shutdown(wait=True)
+        _RETRIEVAL_EXECUTOR = None
+    with _SHARD_EXECUTOR_LOCK:
+        if _SHARD_EXECUTOR is not None:
+            _SHARD_EXECUTOR.shutdown(wait=True)
+            _SHARD_EXECUTOR = None
+
+
+def retrieval_executor_stats() -> Dict:
+    """
+    Reports the size of the retrieval executor and the searches waiting for or running on it.
+    """
+    return {'workers': _RETRIEVAL_EXECUTOR._max_workers if _RETRIEVAL_EXECUTOR else 0, **_RETRIEVAL_STATS}
+
+
+async def retrieve_and_build_prompt_async(question: str, collection: Dict,
+                                          shards: Optional[Sequence[str]] = None) -> Tuple[List[str], str]:
+    """
+    Runs `retrieve_and_build_prompt` on the retrieval executor, so that the embedding forward pass and
+    the ChromaDB query never block the event loop. The tracing context is carried over to the thread,
+    and a copy of the collection dictionary, so that an index swapped in meanwhile on the event loop
+    does not change the collection under a running search.
+    :param question: The user's question.
+    :param collection: A dictionary containing the ChromaDB collection to search in.
+    :param shards: The shards to search, the default shards when None.
+    :return: The retrieved contexts and the prompt.
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    _RETRIEVAL_STATS['pending'] += 1
+    try:
+        return await loop.run_in_executor(configure_retrieval_executor(), context.run,
+                                          retrieve_and_build_prompt, question, dict(collection), shards)
+    finally:
+        _RETRIEVAL_STATS['pending'] -= 1
+        _RETRIEVAL_STATS['completed'] += 1
+
+
+def format_model_input(model, prompt: str):
+    """
+    Puts a prompt in the format a model expects: Replicate models take the text, with their system
+    prompt set in the prediction input, and OpenAI chat models a list of messages.
+    :param model: The generative model.
+    :param prompt: The prompt built by `generate_prompt`.
+    :return: The prompt text or the chat messages.
+    """
+    if isinstance(model, (Replicate, ReplicateReg)):
+        return prompt
+    return [{"role": "system", "content": prompt}]
+
+
+async def _timed(name: str, coroutine, model_name: Optional[str] = None):
+    """
+    Awaits a coroutine inside a tracing span.
+    :param name: The span name.
+    :param coroutine: The coroutine to await.
+    :param model_name: If given, the duration is recorded as the latency of this model, which the
+        admission controller uses to decide which models to drop under load.
+    :return: The result of the coroutine.
+    """
+    start = time.perf_counter()
+    with span(name):
+        result = await coroutine
+    if model_name is not None:
+        MODEL_LATENCY.record(model_name, time.perf_counter() - start)
+    return result
+
+
+QUERY_MODELS = {
+    'gpt-3.5-turbo response': 'gpt-3.5-turbo',
+    'gpt-4-turbo response': 'gpt-4-turbo',
+    'llama-2-70b-chat': 'llama-2-70b-chat',
+    'falcon-40b-instruct': 'falcon-40b-instruct',
+}
+
+
+def normalize_query(query: str) -> str:
+    """
+    Normalizes a query for use as a cache key: lower case with collapsed whitespace.
+    :param query: The user's question.
+    :return: The normalized query.
+    """
+    return ' '.join(query.lower().split())
+
+
+def _model_calls(user_query: str, generative_models: Dict, model_names: Optional[List[str]] = None) -> Dict[str, object]:
+    """
+    Creates the generation coroutine of every selected model, each timed in its own span.
+    :param user_query: The prompt.
+    :param generative_models: A dictionary of generative models to query.
+    :param model_names: The models to query, e.g. 'gpt-4-turbo', all of them by default.
+    :return: The coroutines, keyed by the model name used in responses.
+    """
+    calls = {}
+    for model_name, key in QUERY_MODELS.items():
+        if model_names is not None and key not in model_names:
+            continue
+        model = generative_models[key]
+        calls[model_name] = _timed(f'generate.{key}', model.generate(format_model_input(model, user_query)), key)
+    return calls
+
+
+async def query_models_async(user_query:str, generative_models, model_names: Optional[List[str]] = None) -> List[ModelResponse]:
     """
     Asynchronously queries multiple generative models with a user query.
     :param user_query: The query from the user.
     :param generative_models: A dictionary of generative models to query.
+    :param model_names: The models to query, all of them by default.
     :return: A list of ModelResponse objects containing the models' responses.
     """
-    data= [{"role": "system", "content": user_query}]
-    model_names = [
-        'gpt-3.5-turbo response', 'gpt-4-turbo response', 
-                   'llama-2-70b-chat', 
-                   'falcon-40b-instruct'
-                   ]
-
-
-    tasks = [
-        generative_models['gpt-3.5-turbo'].generate(data),
-        generative_models['gpt-4-turbo'].generate(data),
-        generative_models['llama-2-70b-chat'].generate(user_query),
-        generative_models['falcon-40b-instruct'].generate(user_query)
-    ]
-    responses = await asyncio.gather(*tasks)
-    model_responses = [ModelResponse(model_name=model_name,response=response['text']) for model_name, response in zip(model_names, responses)]
+    calls = _model_calls(user_query, generative_models, model_names)
+    responses = await asyncio.gather(*calls.values())
+    model_responses = [ModelResponse(model_name=model_name,response=response['text']) for model_name, response in zip(calls, responses)]
     return model_responses
 
 
-def evaluate_responses(generative_models: Dict, request: ModelEvalRequest) -> ModelEvalResponse:
+async def iter_model_responses(user_query: str, generative_models: Dict,
+                               model_names: Optional[List[str]] = None) -> AsyncIterator[Tuple[str, object]]:
     """
-    Evaluates the responses from different models based on faithfulness and relevancy metrics.
-    Determines the best model based on the combined score of faithfulness and relevancy.
+    Queries all models concurrently and yields every answer as soon as it is complete.
+    Closing the generator cancels the models still running.
+    :param user_query: The prompt.
+    :param generative_models: A dictionary of generative models to query.
+    :param model_names: The models to query, all of them by default.
+    :return: An async iterator of (model name, ModelResponse or the exception the model raised).
+    """
+    async def call(model_name: str, coroutine):
+        try:
+            result = await coroutine
+            return model_name, ModelResponse(model_name=model_name, response=result['text'])
+        except Exception as e:
+            logger.exception(f"Querying {model_name} failed")
+            return model_name, e
+
+    tasks = [asyncio.create_task(call(model_name, coroutine))
+             for model_name, coroutine in _model_calls(user_query, generative_models, model_names).items()]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+STREAM_MODELS = {
+    'gpt-3.5-turbo': 'gpt-3.5-turbo-stream',
+    'gpt-4-turbo': 'gpt-4-turbo-stream',
+    'llama-2-70b-chat': 'llama-2-70b-chat-stream',
+    'falcon-40b-instruct': 'falcon-40b-instruct-stream',
+}
+
+
+def format_sse(event: str, data) -> str:
+    """
+    Formats one Server-Sent Event.
+    :param event: The event name.
+    :param data: The JSON serialisable payload.
+    :return: The event as sent on the wire.
+    """
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def merge_model_streams(streams: Dict[str, AsyncIterator[Dict]]) -> AsyncIterator[Tuple[str, Dict]]:
+    """
+    Runs several model streams concurrently and yields their events in arrival order.
+
+    Every model ends with exactly one 'done' or 'error' event. Closing or cancelling the returned
+    generator cancels the streams still running, which closes their upstream connections.
+    :param streams: The `astream` generators, keyed by model name.
+    :return: An async iterator of (model name, event) with events
+        {'type': 'delta', 'text': ...},
+        {'type': 'done', 'usage': ..., 'first_token_ms': ..., 'total_ms': ...} or
+        {'type': 'error', 'error': ...}.
+    """
+    events = asyncio.Queue()
+
+    async def pump(model_name: str, stream: AsyncIterator[Dict]):
+        start = time.perf_counter()
+        first_token_ms, usage = None, None
+        try:
+            with span(f'stream.{model_name}'):
+                async for chunk in stream:
+                    if chunk.get('usage'):
+                        usage = chunk['usage']
+                    if chunk['text']:
+                        if first_token_ms is None:
+                            first_token_ms = round((time.perf_counter() - start) * 1000, 1)
+                        await events.put((model_name, {'type': 'delta', 'text': chunk['text']}))
+            total = time.perf_counter() - start
+            MODEL_LATENCY.record(model_name, total)
+            await events.put((model_name, {'type': 'done', 'usage': usage, 'first_token_ms': first_token_ms,
+                                           'total_ms': round(total * 1000, 1)}))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception(f"Streaming from {model_name} failed")
+            await events.put((model_name, {'type': 'error', 'error': str(e)}))
+
+    tasks = [asyncio.create_task(pump(model_name, stream)) for model_name, stream in streams.items()]
+    try:
+        remaining = len(tasks)
+        while remaining:
+            model_name, event = await events.get()
+            if event['type'] != 'delta':
+                remaining -= 1
+            yield model_name, event
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def stream_models_async(prompt: str, generative_models: Dict,
+                        model_names: Optional[List[str]] = None) -> AsyncIterator[Tuple[str, Dict]]:
+    """
+    Streams the answers of all models to a prompt, interleaved as the tokens arrive.
+    :param prompt: The prompt built by `generate_prompt`.
+    :param generative_models: A dictionary of generative models, with the streaming models under '<name>-stream'.
+    :param model_names: The models to stream, all of them by default.
+    :return: The merged stream, see `merge_model_streams`.
+    """
+    streams = {}
+    for model_name, key in STREAM_MODELS.items():
+        if model_names is not None and model_name not in model_names:
+            continue
+        model = generative_models[key]
+        streams[model_name] = model.astream(format_model_input(model, prompt))
+    return merge_model_streams(streams)
+
+
+async def coalesce_deltas(events: AsyncIterator[Dict], window: float, max_bytes: int) -> AsyncIterator[Dict]:
+    """
+    Buffers the delta events of a query stream and yields them in batches, so that a client receives one
+    frame per flush instead of one per token.
+
+    The buffer is flushed `window` seconds after its first delta, when it holds `max_bytes` of text, and
+    before any other event, so the order of the events of every model is kept.
+    :param events: The {'model', 'type', ...} events of a query stream, see `api._query_stream_events`.
+    :param window: The maximum number of seconds a delta is held back.
+    :param max_bytes: The buffered UTF-8 size that triggers a flush.
+    :return: An async iterator of the events, with the deltas replaced by
+        {'type': 'deltas', 'deltas': [(model, text), ...]}, one entry per model in order of first arrival.
+    """
+    received = asyncio.Queue()
+    finished = object()
+
+    async def pump():
+        try:
+            async for event in events:
+                received.put_nowait(event)
+        except Exception as e:
+            received.put_nowait(e)
+        finally:
+            received.put_nowait(finished)
+
+    def flush():
+        nonlocal size, deadline
+        batch = {'type': 'deltas', 'deltas': [(model_name, ''.join(texts)) for model_name, texts in buffer.items()]}
+        buffer.clear()
+        size, deadline = 0, None
+        return batch
+
+    loop = asyncio.get_running_loop()
+    task = asyncio.create_task(pump())
+    buffer: Dict[str, List[str]] = {}
+    size, deadline = 0, None
+    try:
+        while True:
+            if deadline is None:
+                event = await received.get()
+            else:
+                try:
+                    event = await asyncio.wait_for(received.get(), max(0.0, deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    yield flush()
+                    continue
+            if isinstance(event, dict) and event.get('type') == 'delta':
+                buffer.setdefault(event['model'], []).append(event['text'])
+                size += len(event['text'].encode('utf-8'))
+                if deadline is None:
+                    deadline = loop.time() + window
+                if size >= max_bytes:
+                    yield flush()
+                continue
+            if buffer:
+                yield flush()
+            if event is finished:
+                return
+            if isinstance(event, Exception):
+                raise event
+            yield event
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+def score_responses(generative_models: Dict, query: str, model_responses: List[ModelResponse],
+                    contexts: List[str]) -> List[ModelEvaluation]:
+    """
+    Scores responses on faithfulness and answer relevancy with ragas. Blocking, run it in a thread
+    from async code.
 
     :param generative_models: A dictionary containing the generative models used for evaluation.
-    :param request: The ModelEvalRequest object containing the query, model responses, and contexts.
-    :return: A ModelEvalResponse object containing the evaluations and the name of the best model.
+    :param query: The original query.
+    :param model_responses: The responses to score.
+    :param contexts: The contexts the responses were generated from.
+    :return: One ModelEvaluation per response, in order.
     """
-    model_evaluations = []
-    best_model = None
-    highest_score = -1
     # Prepare evaluation dataset
     eval_samples = {
-        'question': [request.query] * len(request.model_responses),
-        'answer': [response.response for response in request.model_responses],
-        'contexts': [request.contexts] * len(request.model_responses),
+        'question': [query] * len(model_responses),
+        'answer': [response.response for response in model_responses],
+        'contexts': [contexts] * len(model_responses),
     }
     eval_dataset = Dataset.from_dict(eval_samples)
     # Perform evaluation
-    result = evaluate(
-        eval_dataset,
-        metrics=[faithfulness, answer_relevancy],
-        llm=generative_models['gpt-3.5-turbo-eval'],
-    )
+    with span('evaluate', responses=len(model_responses)):
+        result = evaluate(
+            eval_dataset,
+            metrics=[faithfulness, answer_relevancy],
+            llm=generative_models['gpt-3.5-turbo-eval'],
+        )
     df = result.to_pandas()
-    # Process evaluation results
-    for index, (model_response, row) in enumerate(zip(request.model_responses, df.itertuples(index=False))):
-        model_faithfulness = row.faithfulness
-        model_answer_relevancy = row.answer_relevancy
-        total_score = model_faithfulness + model_answer_relevancy
-        model_evaluations.append(ModelEvaluation(
-            model_name=model_response.model_name,
-            faithfulness=model_faithfulness,
-            relevance=model_answer_relevancy
-        ))
+    return [ModelEvaluation(model_name=model_response.model_name, faithfulness=row.faithfulness,
+                            relevance=row.answer_relevancy)
+            for model_response, row in zip(model_responses, df.itertuples(index=False))]
+
+
+def select_best_model(model_evaluations: List[ModelEvaluation]) -> str:
+    """
+    Determines the best model based on the combined score of faithfulness and relevancy.
+    Models with a missing (NaN) score are never selected.
+
+    :param model_evaluations: The evaluations of every model.
+    :return: The name of the best model, or None if no model could be scored.
+    """
+    best_model = None
+    highest_score = -1
+    for evaluation in model_evaluations:
+        total_score = evaluation.faithfulness + evaluation.relevance
         if total_score > highest_score:
             highest_score = total_score
-            best_model = model_response.model_name
-    return ModelEvalResponse(model_evaluations=model_evaluations, best_model=best_model)
\ No newline at end of file
+            best_model = evaluation.model_name
+    return best_model
+
+
+def evaluate_responses(generative_models: Dict, request: ModelEvalRequest) -> ModelEvalResponse:
+    """
+    Evaluates the responses from different models based on faithfulness and relevancy metrics.
+    Determines the best model based on the combined score of faithfulness and relevancy.
+
+    :param generative_models: A dictionary containing the generative models used for evaluation.
+    :param request: The ModelEvalRequest object containing the query, model responses, and contexts.
+    :return: A ModelEvalResponse object containing the evaluations and the name of the best model.
+    """
+    model_evaluations = score_responses(generative_models, request.query, request.model_responses, request.contexts)
+    best_model = select_best_model(model_evaluations)
+    return ModelEvalResponse(model_evaluations=model_evaluations, best_model=best_model)
+
+
+async def query_and_evaluate(question: str, collection: Dict, generative_models: Dict,
+                             model_names: Optional[List[str]] = None,
+                             shards: Optional[Sequence[str]] = None) -> AsyncIterator[Tuple[str, Dict]]:
+    """
+    Queries all models and scores every answer as soon as it is complete, while the other models are
+    still generating, so the total time approaches the slowest generation plus one evaluation.
+
+    :param question: The user's question.
+    :param collection: A dictionary containing the ChromaDB collection to search in.
+    :param generative_models: A dictionary of generative models.
+    :param model_names: The models to query, all of them by default. With an empty list only the
+        contexts are sent.
+    :param shards: The shards to search, the default shards when None.
+    :return: An async iterator of (event, data) with the events
+        'contexts' {"contexts"}, 'answer' {"model", "response"},
+        'evaluation' {"model", "faithfulness", "relevance"}, 'error' {"model", "stage", "error"}
+        and finally 'best' {"best_model", "model_evaluations"}.
+    """
+    contexts, prompt = await retrieve_and_build_prompt_async(question, collection, shards)
+    yield 'contexts', {'contexts': contexts}
+    if model_names is not None and not model_names:
+        return
+    events = asyncio.Queue()
+    model_evaluations = []
+
+    async def score(model_response: ModelResponse):
+        try:
+            evaluation = (await asyncio.to_thread(score_responses, generative_models, question,
+                                                  [model_response], contexts))[0]
+            model_evaluations.append(evaluation)
+            await events.put(('evaluation', {'model': evaluation.model_name,
+                                             'faithfulness': _finite(evaluation.faithfulness),
+                                             'relevance': _finite(evaluation.relevance)}))
+        except Exception as e:
+            logger.exception(f"Evaluating {model_response.model_name} failed")
+            await events.put(('error', {'model': model_response.model_name, 'stage': 'evaluate', 'error': str(e)}))
+
+    async def generate():
+        scoring = []
+        try:
+            async for model_name, result in iter_model_responses(prompt, generative_models, model_names):
+                if isinstance(result, Exception):
+                    await events.put(('error', {'model': model_name, 'stage': 'generate', 'error': str(result)}))
+                    continue
+                await events.put(('answer', {'model': model_name, 'response': result.response}))
+                scoring.append(asyncio.create_task(score(result)))
+            await asyncio.gather(*scoring)
+        finally:
+            for task in scoring:
+                task.cancel()
+            # Always end the consumer loop; `await pipeline` then raises what went wrong
+            events.put_nowait(None)
+
+    pipeline = asyncio.create_task(generate())
+    try:
+        while (event := await events.get()) is not None:
+            yield event
+        await pipeline
+    finally:
+        pipeline.cancel()
+        await asyncio.gather(pipeline, return_exceptions=True)
+    model_evaluations.sort(key=lambda evaluation: list(QUERY_MODELS).index(evaluation.model_name))
+    yield 'best', {'best_model': select_best_model(model_evaluations),
+                   'model_evaluations': [{'model_name': evaluation.model_name,
+                                          'faithfulness': _finite(evaluation.faithfulness),
+                                          'relevance': _finite(evaluation.relevance)}
+                                         for evaluation in model_evaluations]}
+
+
+def _finite(score: float):
+    """
+    Replaces a NaN score, which JSON cannot represent, with None.
+    """
+    return None if score is None or math.isnan(score) else score
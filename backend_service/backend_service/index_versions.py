@@ -0,0 +1,188 @@
+"""
+Versioned collections and their zero-downtime swap.
+
+`web_scrapper/reindex.py` builds every refresh of the index into a new collection `<name>-v<version>`,
+validates it and publishes it by atomically rewriting the pointer file `INDEX_POINTER_PATH`:
+
+    {"base": "info-services-index", "collection": "info-services-index-v20261019T020000",
+     "version": "20261019T020000", "previous": {"collection": ..., "version": ...}}
+
+`IndexSwapper` follows the pointer in every process that serves the index. A new version is opened off
+the event loop and swapped in between two requests; the version it replaced stays open, so that a
+rollback is instant.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+INDEX_POINTER_PATH = os.environ.get('INDEX_POINTER_PATH', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', '..', 'chromadb_data', 'index_version.json'))
+INDEX_POLL_SECONDS = float(os.environ.get('INDEX_POLL_SECONDS', 5))
+logger = logging.getLogger("backend_service_logger")
+
+
+def read_index_pointer(base: str, pointer_path: str = INDEX_POINTER_PATH) -> Optional[Dict]:
+    """
+    Reads the published version of an index.
+
+    Args:
+        base (str): The name of the unversioned collection, e.g. 'info-services-index'.
+        pointer_path (str, optional): The pointer file.
+
+    Returns:
+        Optional[Dict]: The pointer, or None if no version of `base` was published.
+    """
+    try:
+        with open(pointer_path) as f:
+            pointer = json.load(f)
+    except FileNotFoundError:
+        return None
+    return pointer if pointer.get('base') == base else None
+
+
+def write_index_pointer(pointer: Dict, pointer_path: str = INDEX_POINTER_PATH):
+    """
+    Replaces the pointer file atomically, so that a reader never sees a partial file.
+    """
+    temporary_path = f"{pointer_path}.{os.getpid()}.tmp"
+    with open(temporary_path, 'w') as f:
+        json.dump(pointer, f, indent=2)
+    os.replace(temporary_path, pointer_path)
+
+
+class IndexSwapper:
+    """
+    Follows the index pointer and swaps the published version in.
+
+    Attributes:
+        base (str): The name of the unversioned collection.
+        version (Optional[str]): The version served, None for the unversioned collection.
+        collection_name (str): The collection served.
+        pointer_path (str): The pointer file.
+        interval (float): Seconds between two checks of the pointer.
+    """
+    def __init__(self, pointer_path: str = INDEX_POINTER_PATH, interval: float = INDEX_POLL_SECONDS):
+        self.pointer_path = pointer_path
+        self.interval = interval
+        self.base = None
+        self.version = None
+        self.collection_name = None
+        self.swaps = 0
+        self.swapped_at = None
+        self._open = None
+        self._apply = None
+        self._previous: Optional[Tuple[Optional[str], str, object]] = None
+        self._listeners: List[Callable[[Optional[str]], None]] = []
+        self._mtime = None
+        self._task: Optional[asyncio.Task] = None
+
+    def configure(self, base: str, collection_name: str, version: Optional[str],
+                  open_version: Callable[[str], object], apply: Callable[[object], object]):
+        """
+        Args:
+            base (str): The name of the unversioned collection.
+            collection_name (str): The collection served now.
+            version (Optional[str]): Its version.
+            open_version (Callable[[str], object]): Opens a collection by name. Blocking, it runs in a thread.
+            apply (Callable[[object], object]): Serves an opened collection and returns the one it replaced.
+                It runs on the event loop and must not await, so that every request sees one version or the other.
+        """
+        self.base, self.collection_name, self.version = base, collection_name, version
+        self._open, self._apply = open_version, apply
+        self._mtime = self._pointer_mtime()
+
+    def add_listener(self, callback: Callable[[Optional[str]], None]):
+        """
+        Registers a callback called with the new version after every swap, e.g. to invalidate caches.
+        """
+        self._listeners.append(callback)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def _pointer_mtime(self) -> Optional[float]:
+        try:
+            return os.stat(self.pointer_path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.check()
+            except Exception:
+                logger.exception(f"Could not switch to the index published in {self.pointer_path}")
+
+    async def check(self):
+        """
+        Swaps in the version of the pointer file if it changed since the last check.
+        """
+        mtime = self._pointer_mtime()
+        if mtime is None or mtime == self._mtime:
+            return
+        pointer = read_index_pointer(self.base, self.pointer_path)
+        if pointer is not None and pointer['collection'] != self.collection_name:
+            await self.activate(pointer['collection'], pointer['version'])
+        self._mtime = mtime
+
+    async def activate(self, collection_name: str, version: Optional[str]):
+        """
+        Opens a version, unless it is the one kept for rollback, and swaps it in.
+        """
+        if self._previous is not None and self._previous[1] == collection_name:
+            handle = self._previous[2]
+        else:
+            handle = await asyncio.to_thread(self._open, collection_name)
+        replaced = self._apply(handle)
+        self._previous = (self.version, self.collection_name, replaced)
+        logger.info(f"Swapped index {self.collection_name} for {collection_name}")
+        self.collection_name, self.version = collection_name, version
+        self.swaps += 1
+        self.swapped_at = time.time()
+        for listener in self._listeners:
+            listener(version)
+
+    async def rollback(self) -> str:
+        """
+        Swaps the previous version recorded in the pointer file back in and republishes it, so that the
+        other processes following the pointer roll back too. Any process can roll back, whether or not
+        it served the previous version; rolling back twice returns to the version rolled back from.
+
+        Returns:
+            str: The collection served again.
+
+        Raises:
+            ValueError: If the pointer records no previous version, or it cannot be opened.
+        """
+        pointer = read_index_pointer(self.base, self.pointer_path)
+        previous = pointer and pointer.get('previous')
+        if not previous:
+            raise ValueError("There is no previous index version to roll back to")
+        if previous['collection'] != self.collection_name:
+            await self.activate(previous['collection'], previous['version'])
+        write_index_pointer({'base': self.base, 'collection': previous['collection'], 'version': previous['version'],
+                             'previous': {'collection': pointer['collection'], 'version': pointer['version']},
+                             'rolled_back_at': time.time()}, self.pointer_path)
+        self._mtime = self._pointer_mtime()
+        return previous['collection']
+
+    def stats(self) -> Dict:
+        return {
+            'base': self.base,
+            'collection': self.collection_name,
+            'version': self.version,
+            'previous': None if self._previous is None else {'collection': self._previous[1], 'version': self._previous[0]},
+            'swaps': self.swaps,
+            'swapped_at': self.swapped_at,
+        }
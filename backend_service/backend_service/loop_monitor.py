@@ -0,0 +1,77 @@
+"""
+Event-loop lag monitoring.
+
+`EventLoopLagMonitor` sleeps for a fixed interval in a task and measures how much later than requested it
+wakes up. The delay is the time other callbacks held the event loop, i.e. how long every connection of
+the worker, including open WebSockets, was stalled.
+"""
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+from typing import Dict, Optional
+
+logger = logging.getLogger("backend_service_logger")
+
+
+class EventLoopLagMonitor:
+    """
+    Samples the event-loop lag and keeps the recent samples.
+
+    Attributes:
+        interval (float): Seconds between two samples.
+        window (int): The number of recent samples the percentiles are computed over.
+        warn_threshold (float): Seconds of lag counted as a stall and logged, at most every 10 seconds. 0 to disable.
+    """
+    def __init__(self, interval: float = 0.1, window: int = 600, warn_threshold: float = 0.1):
+        self.interval = interval
+        self.warn_threshold = warn_threshold
+        self.samples = deque(maxlen=window)
+        self.max_lag = 0.0
+        self.stalls = 0
+        self._last_warning = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.perf_counter() - start - self.interval)
+            self.samples.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+            if self.warn_threshold and lag >= self.warn_threshold:
+                self.stalls += 1
+                if time.monotonic() - self._last_warning >= 10:
+                    self._last_warning = time.monotonic()
+                    logger.warning(f"Event loop blocked for {lag * 1000:.0f}ms ({self.stalls} stalls so far)")
+
+    def _percentile(self, samples, percentile: float) -> float:
+        return samples[min(len(samples) - 1, math.ceil(percentile / 100 * len(samples)) - 1)]
+
+    def stats(self) -> Dict:
+        """
+        Summarises the lag in milliseconds over the recent samples.
+        """
+        samples = sorted(self.samples)
+        if not samples:
+            return {'samples': 0}
+        return {
+            'samples': len(samples),
+            'last_ms': round(self.samples[-1] * 1000, 3),
+            'mean_ms': round(sum(samples) / len(samples) * 1000, 3),
+            'p50_ms': round(self._percentile(samples, 50) * 1000, 3),
+            'p99_ms': round(self._percentile(samples, 99) * 1000, 3),
+            'max_ms': round(self.max_lag * 1000, 3),
+            'stalls': self.stalls,
+        }
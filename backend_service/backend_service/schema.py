@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 
 
 class QueryRequest(BaseModel):
@@ -8,8 +8,12 @@ class QueryRequest(BaseModel):
     
     Attributes:
         query (str): The query string to be sent to the model.
+        shards (Optional[List[str]]): The names of the shards to search, the default shards if omitted.
+        language (Optional[str]): Searches the shards of this language, e.g. 'ar'.
     """
     query: str
+    shards: Optional[List[str]] = None
+    language: Optional[str] = None
 
 
 class ModelResponse(BaseModel):
@@ -30,9 +34,12 @@ class QueryResponse(BaseModel):
     Attributes:
         model_responses (List[ModelResponse]): A list of responses from different models.
         contexts (List[str]): A list of contexts relevant to the query and responses.
+        degraded (Optional[str]): Set under load: 'reduced-models' if some models were skipped,
+            'retrieval-only' if none was queried and 'cached' if a cached answer was served instead.
     """
     model_responses: List[ModelResponse]
     contexts: List[str]
+    degraded: Optional[str] = None
 
 class ModelEvalRequest(BaseModel):
     """
@@ -0,0 +1,191 @@
+"""
+Registry of the corpora (shards) retrieval can search.
+
+Every shard is a ChromaDB collection with its own embedding model, e.g. the English and the Arabic
+u.ae portal or the portal of an emirate. The shards are listed in `SHARDS_CONFIG_PATH`:
+
+    {"shards": [
+        {"name": "en", "collection": "info-services-index", "language": "en"},
+        {"name": "ar", "collection": "info-services-index-ar", "language": "ar",
+         "embedding_model": "Alibaba-NLP/gte-multilingual-base", "default": false}
+    ]}
+
+Without the file the service searches `info-services-index` only, as before. A query searches the shards
+it selects by name or language, the default shards otherwise. The results of shards sharing an embedding
+model are merged by similarity; the similarities of different models are not comparable and are first
+calibrated against the similarity of unrelated text under each model, see `calibrate`.
+"""
+import json
+import math
+import os
+import random
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+from backend_service.custom_exceptions import UnknownShard
+
+SHARDS_CONFIG_PATH = os.environ.get('SHARDS_CONFIG_PATH', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', '..', 'chromadb_data', 'shards.json'))
+DEFAULT_EMBEDDING_MODEL = "Alibaba-NLP/gte-base-en-v1.5"
+# 'calibrated' rescales the similarities of shards with different embedding models by their similarity floor
+# before merging, 'none' merges the raw similarities
+SHARD_SCORE_NORMALIZATION = os.environ.get('SHARD_SCORE_NORMALIZATION', 'calibrated')
+
+
+@dataclass
+class ShardConfig:
+    """
+    One searchable corpus.
+
+    Attributes:
+        name (str): The name queries select the shard by.
+        collection (str): The ChromaDB collection.
+        language (str): The language of its documents, queries can select all shards of a language.
+        embedding_model (str): The model its documents were embedded with.
+        space (str): The distance of the collection, 'cosine', 'ip' or 'l2'.
+        weight (float): Multiplies the scores of the shard when merging.
+        default (bool): Whether a query selecting no shard searches it.
+        similarity_floor (Optional[float]): The typical similarity of unrelated text under the shard's
+            embedding model, see `estimate_similarity_floor`. None until measured, which counts as 0.
+    """
+    name: str
+    collection: str
+    language: str = 'en'
+    embedding_model: str = DEFAULT_EMBEDDING_MODEL
+    space: str = 'cosine'
+    weight: float = 1.0
+    default: bool = True
+    similarity_floor: Optional[float] = None
+
+
+def load_shard_configs(config_path: str = SHARDS_CONFIG_PATH, default_collection: str = 'info-services-index') -> List[ShardConfig]:
+    """
+    Loads the shard registry. The first shard is the primary one, served under the keys of the
+    collection dictionary the rest of the service uses.
+
+    Args:
+        config_path (str, optional): The path to the shard configuration.
+        default_collection (str, optional): The collection searched when there is no configuration.
+
+    Returns:
+        List[ShardConfig]: The configured shards, or a single English shard of `default_collection`.
+    """
+    if not os.path.exists(config_path):
+        return [ShardConfig(name='en', collection=default_collection)]
+    with open(config_path) as f:
+        configs = [ShardConfig(**shard) for shard in json.load(f)['shards']]
+    if not configs:
+        raise ValueError(f"{config_path} lists no shards")
+    if len({config.name for config in configs}) != len(configs):
+        raise ValueError(f"{config_path} lists a shard name twice")
+    return configs
+
+
+def select_shards(configs: Dict[str, ShardConfig], shards: Optional[Sequence[str]] = None,
+                  language: Optional[str] = None) -> Tuple[str, ...]:
+    """
+    Resolves the shards a query searches.
+
+    Args:
+        configs (Dict[str, ShardConfig]): The available shards by name.
+        shards (Optional[Sequence[str]]): The shards selected by name.
+        language (Optional[str]): Selects every shard of a language, combined with `shards` if both are given.
+
+    Returns:
+        Tuple[str, ...]: The selected shard names, in registry order.
+
+    Raises:
+        UnknownShard: If a selected shard is not available or no shard has the language.
+    """
+    if shards:
+        unknown = [name for name in shards if name not in configs]
+        if unknown:
+            raise UnknownShard(f"Unknown shards: {', '.join(unknown)}. Available: {', '.join(configs)}")
+    selected = [name for name, config in configs.items()
+                if (not shards or name in shards) and (language is None or config.language == language)
+                and (shards or language is not None or config.default)]
+    if not selected:
+        raise UnknownShard(f"No shard matches shards={list(shards or [])} language={language}")
+    return tuple(selected)
+
+
+def similarity(distance: float, space: str = 'cosine') -> float:
+    """
+    Turns a ChromaDB distance into a similarity where higher is better.
+    """
+    if space == 'l2':
+        return 1.0 / (1.0 + distance)
+    return 1.0 - distance  # The cosine and inner product distances are 1 - similarity
+
+
+def calibrate(score: float, floor: Optional[float]) -> float:
+    """
+    Rescales a similarity so that unrelated text scores 0 and an identical text 1 under any embedding model.
+
+    Unlike rescaling the top results of each query, this keeps the absolute signal: the best result of a
+    shard that holds nothing relevant still scores close to 0.
+    """
+    floor = floor or 0.0
+    return (score - floor) / (1.0 - floor) if floor < 1.0 else score
+
+
+def estimate_similarity_floor(embeddings: Sequence[Sequence[float]], pairs: int = 2000, seed: int = 0) -> Optional[float]:
+    """
+    Estimates the similarity floor of a shard as the mean cosine similarity of random pairs of its
+    stored embeddings, which are nearly all unrelated chunks.
+
+    Args:
+        embeddings (Sequence[Sequence[float]]): A sample of the shard's embeddings.
+        pairs (int, optional): The number of pairs averaged. Defaults to 2000.
+        seed (int, optional): The seed of the pair sampling.
+
+    Returns:
+        Optional[float]: The floor, or None if there are fewer than two embeddings.
+    """
+    if len(embeddings) < 2:
+        return None
+    norms = [math.sqrt(sum(x * x for x in embedding)) or 1.0 for embedding in embeddings]
+    rng = random.Random(seed)
+    total = 0.0
+    for _ in range(pairs):
+        i, j = rng.sample(range(len(embeddings)), 2)
+        total += sum(x * y for x, y in zip(embeddings[i], embeddings[j])) / (norms[i] * norms[j])
+    return total / pairs
+
+
+def merge_shard_results(results: Iterable[Tuple[ShardConfig, List[str], List[float]]], n_results: int,
+                        method: str = SHARD_SCORE_NORMALIZATION) -> List[str]:
+    """
+    Merges the top-k results of several shards into one ranking.
+
+    Shards sharing an embedding model and distance are ranked by their raw similarities. When the models
+    differ, each similarity is calibrated by its shard's `similarity_floor` first (method 'calibrated').
+
+    Args:
+        results (Iterable[Tuple[ShardConfig, List[str], List[float]]]): The shard, its documents and their
+            distances, nearest first.
+        n_results (int): The number of documents returned.
+        method (str, optional): 'calibrated' or 'none'. Defaults to SHARD_SCORE_NORMALIZATION.
+
+    Returns:
+        List[str]: The best documents over all shards by weighted score, the raw similarity breaking
+            ties. A document found in several shards is returned once.
+    """
+    if method not in ('calibrated', 'none'):
+        raise ValueError(f"Unknown score normalization: {method}")
+    results = list(results)
+    calibrated = method == 'calibrated' and len({(config.embedding_model, config.space) for config, _, _ in results}) > 1
+    ranked = []
+    for config, documents, distances in results:
+        for document, distance in zip(documents, distances):
+            raw = similarity(distance, config.space)
+            score = calibrate(raw, config.similarity_floor) if calibrated else raw
+            ranked.append((score * config.weight, raw, document))
+    ranked.sort(key=lambda result: (result[0], result[1]), reverse=True)
+    merged, seen = [], set()
+    for _, _, document in ranked:
+        if document not in seen:
+            seen.add(document)
+            merged.append(document)
+        if len(merged) == n_results:
+            break
+    return merged
@@ -0,0 +1,136 @@
+"""
+Building blocks of the queue-based logging pipeline set up by `helper_functions.setup_logger`.
+
+The event loop only runs `PayloadQueueHandler.prepare` and `RateLimitFilter`, which copy the record and
+put it on an in-process queue. Formatting, payload truncation and disk I/O happen in the listener thread.
+
+Structured fields are passed with `extra={'payload': {...}}` and end up as top-level JSON keys.
+"""
+import copy
+import json
+import logging
+import logging.handlers
+import threading
+import time
+from typing import Dict
+from backend_service.tracing import current_request_id
+
+RESERVED_KEYS = {'ts', 'level', 'logger', 'file', 'line', 'message', 'request_id', 'exception'}
+
+
+def truncate(value, max_chars: int):
+    """
+    Shortens long strings, and the strings nested in lists and dicts, to `max_chars` characters.
+
+    Args:
+        value: The value to shorten.
+        max_chars (int): The maximum number of characters kept per string.
+
+    Returns:
+        The shortened value, with a marker giving the original length of every cut string.
+    """
+    if isinstance(value, str):
+        if len(value) <= max_chars:
+            return value
+        return f"{value[:max_chars]}... [truncated, {len(value)} chars]"
+    if isinstance(value, dict):
+        return {key: truncate(item, max_chars) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [truncate(item, max_chars) for item in value]
+    return value
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats records as one JSON object per line, truncating the message and payload fields.
+
+    Attributes:
+        max_field_chars (int): The maximum number of characters kept per string field.
+    """
+    def __init__(self, max_field_chars: int = 2000):
+        super().__init__()
+        self.max_field_chars = max_field_chars
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': self.formatTime(record, '%Y-%m-%dT%H:%M:%S') + f'.{int(record.msecs):03d}',
+            'level': record.levelname,
+            'logger': record.name,
+            'file': record.filename,
+            'line': record.lineno,
+            'message': truncate(record.getMessage(), self.max_field_chars),
+        }
+        request_id = getattr(record, 'request_id', None)
+        if request_id:
+            entry['request_id'] = request_id
+        payload = getattr(record, 'payload', None)
+        if isinstance(payload, dict):
+            for key, value in truncate(payload, self.max_field_chars).items():
+                entry[f'payload_{key}' if key in RESERVED_KEYS else key] = value
+        if record.exc_info:
+            entry['exception'] = truncate(self.formatException(record.exc_info), self.max_field_chars * 4)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    """
+    The original human readable format, with the request id and truncated payload appended.
+    """
+    def __init__(self, max_field_chars: int = 2000):
+        super().__init__('%(asctime)s | %(levelname)s | %(filename)s | %(message)s')
+        self.max_field_chars = max_field_chars
+
+    def format(self, record: logging.LogRecord) -> str:
+        text = truncate(super().format(record), self.max_field_chars)
+        payload = getattr(record, 'payload', None)
+        if isinstance(payload, dict):
+            text += ' | ' + json.dumps(truncate(payload, self.max_field_chars), default=str, ensure_ascii=False)
+        request_id = getattr(record, 'request_id', None)
+        return f"{text} | request_id={request_id}" if request_id else text
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Token bucket limiting the records per second of every logger. Warnings and errors are never dropped.
+    The number of dropped records is attached to the next record that passes as `suppressed`.
+
+    Attributes:
+        rate (float): The sustained records per second per logger, 0 to disable.
+        burst (int): The number of records allowed in a burst.
+    """
+    def __init__(self, rate: float = 50.0, burst: int = 200):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self._buckets: Dict[str, list] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.rate <= 0 or record.levelno >= logging.WARNING:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated, suppressed = self._buckets.get(record.name, (self.burst, now, 0))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens < 1:
+                self._buckets[record.name] = [tokens, now, suppressed + 1]
+                return False
+            self._buckets[record.name] = [tokens - 1, now, 0]
+        if suppressed:
+            record.suppressed = suppressed
+            record.payload = dict(getattr(record, 'payload', None) or {}, suppressed=suppressed)
+        return True
+
+
+class PayloadQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that defers all formatting to the listener thread.
+
+    The standard `QueueHandler.prepare` formats the message on the calling thread so that records can be
+    pickled; the queue here is in-process, so the record is only copied and tagged with the request id.
+    Message arguments are therefore formatted later and must not be mutated after logging.
+    """
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.request_id = current_request_id()
+        return record
@@ -0,0 +1,265 @@
+"""
+Lightweight per-request span tracing.
+
+`TracingMiddleware` opens a trace for every sampled request. Code running inside the request records
+stages with the `span` context manager or the `traced` decorator; the active trace and span are kept
+in context variables, so spans opened in tasks created by `asyncio.gather` nest under the span that
+created them. When the request finishes its stages are
+
+- returned in a `Server-Timing` header (top-level stages only) together with an `X-Request-ID` header,
+- written as one structured log line,
+- optionally exported to a JSON lines file or an OTLP/HTTP collector by a background thread.
+
+Configuration:
+    TRACE_SAMPLE_RATE: The fraction of requests traced, 1.0 by default. Unsampled requests only get
+        a request id, and `span` costs one context variable lookup.
+    TRACE_EXPORT: 'json:<path>' or 'otlp:<url>', e.g. 'otlp:http://127.0.0.1:4318/v1/traces'.
+"""
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+import urllib.request
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+logger = logging.getLogger("backend_service_logger")
+
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "1.0"))
+TRACE_EXPORT = os.environ.get("TRACE_EXPORT", "")
+REQUEST_ID_HEADER = "x-request-id"
+
+_current_trace: contextvars.ContextVar = contextvars.ContextVar("trace", default=None)
+_current_span: contextvars.ContextVar = contextvars.ContextVar("span", default=None)
+_request_id: contextvars.ContextVar = contextvars.ContextVar("request_id", default=None)
+
+
+@dataclass
+class Span:
+    """
+    One timed stage of a request.
+    """
+    name: str
+    span_id: str
+    parent_id: Optional[str]
+    start_time_ns: int
+    start: float
+    end: Optional[float] = None
+    attributes: Dict[str, object] = field(default_factory=dict)
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end or time.perf_counter()) - self.start) * 1000
+
+
+@dataclass
+class Trace:
+    """
+    The spans recorded for one request.
+    """
+    request_id: str
+    trace_id: str
+    root: Span
+    spans: List[Span] = field(default_factory=list)
+
+    def server_timing(self) -> str:
+        """
+        Formats the finished top-level stages and the total as a Server-Timing header value.
+        """
+        entries = []
+        for span in self.spans:
+            if span.parent_id == self.root.span_id and span.end is not None:
+                entries.append(f"{re.sub(r'[^A-Za-z0-9_.-]', '_', span.name)};dur={span.duration_ms:.1f}")
+        entries.append(f"total;dur={self.root.duration_ms:.1f}")
+        return ", ".join(entries)
+
+    def as_dict(self) -> Dict:
+        return {
+            'request_id': self.request_id,
+            'name': self.root.name,
+            'total_ms': round(self.root.duration_ms, 3),
+            'attributes': self.root.attributes,
+            'spans': [{'name': span.name, 'duration_ms': round(span.duration_ms, 3),
+                       'offset_ms': round((span.start - self.root.start) * 1000, 3),
+                       'parent': None if span.parent_id == self.root.span_id else span.parent_id,
+                       'span_id': span.span_id, **({'attributes': span.attributes} if span.attributes else {})}
+                      for span in self.spans],
+        }
+
+
+def current_request_id() -> Optional[str]:
+    """
+    Returns the id of the request being handled, or None outside a request.
+    """
+    return _request_id.get()
+
+
+def _new_span(name: str, parent: Optional[Span], attributes: Dict) -> Span:
+    return Span(name=name, span_id=uuid.uuid4().hex[:16], parent_id=parent.span_id if parent else None,
+                start_time_ns=time.time_ns(), start=time.perf_counter(), attributes=attributes)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    Times a stage of the current request. Does nothing outside a sampled request.
+
+    Args:
+        name (str): The stage name, e.g. 'retrieval.search' or 'generate.gpt-4-turbo'.
+        **attributes: Attributes attached to the span.
+
+    Yields:
+        Optional[Span]: The span, or None if the request is not traced.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield None
+        return
+    current = _new_span(name, _current_span.get() or trace.root, attributes)
+    trace.spans.append(current)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.attributes['error'] = type(e).__name__
+        raise
+    finally:
+        current.end = time.perf_counter()
+        _current_span.reset(token)
+
+
+def traced(name: str):
+    """
+    Decorator recording every call of a sync or async function as a span.
+
+    Args:
+        name (str): The span name.
+    """
+    def decorator(function):
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await function(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class SpanExporter:
+    """
+    Exports finished traces from a background thread, so that file and network I/O never run on the
+    event loop. Traces are dropped when the queue is full.
+
+    Attributes:
+        target (str): 'json:<path>' or 'otlp:<url>'.
+    """
+    def __init__(self, target: str, max_queue_size: int = 1000):
+        kind, _, self.destination = target.partition(':')
+        if kind not in ('json', 'otlp') or not self.destination:
+            raise ValueError(f"Unsupported TRACE_EXPORT value: {target}. Use 'json:<path>' or 'otlp:<url>'")
+        self.kind = kind
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._thread = threading.Thread(target=self._run, name='span-exporter', daemon=True)
+        self._thread.start()
+
+    def submit(self, trace: Trace):
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            pass
+
+    def _run(self):
+        while True:
+            trace = self._queue.get()
+            try:
+                if self.kind == 'json':
+                    with open(self.destination, 'a') as f:
+                        f.write(json.dumps(trace.as_dict(), default=str) + '\n')
+                else:
+                    request = urllib.request.Request(self.destination, data=json.dumps(to_otlp(trace)).encode(),
+                                                     headers={'Content-Type': 'application/json'})
+                    urllib.request.urlopen(request, timeout=5).close()
+            except Exception as e:
+                logger.warning(f"Exporting trace {trace.request_id} failed: {e}")
+
+
+def to_otlp(trace: Trace) -> Dict:
+    """
+    Converts a trace to the OTLP/HTTP JSON encoding.
+    """
+    def otlp_span(span: Span):
+        end_time_ns = span.start_time_ns + int(((span.end or span.start) - span.start) * 1e9)
+        attributes = [{'key': key, 'value': {'stringValue': str(value)}} for key, value in span.attributes.items()]
+        return {'traceId': trace.trace_id, 'spanId': span.span_id, 'parentSpanId': span.parent_id or '',
+                'name': span.name, 'kind': 2 if span is trace.root else 1,
+                'startTimeUnixNano': str(span.start_time_ns), 'endTimeUnixNano': str(end_time_ns),
+                'attributes': attributes}
+    return {'resourceSpans': [{
+        'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': 'backend_service'}}]},
+        'scopeSpans': [{'scope': {'name': 'backend_service.tracing'},
+                        'spans': [otlp_span(trace.root)] + [otlp_span(span) for span in trace.spans]}],
+    }]}
+
+
+class TracingMiddleware:
+    """
+    ASGI middleware assigning a request id to every HTTP and WebSocket request and tracing a sample of the
+    HTTP requests.
+
+    An incoming X-Request-ID header is reused as the request id.
+    """
+    def __init__(self, app, sample_rate: float = TRACE_SAMPLE_RATE, export: str = TRACE_EXPORT):
+        self.app = app
+        self.sample_rate = sample_rate
+        self.exporter = SpanExporter(export) if export else None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] not in ('http', 'websocket'):
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope.get('headers') or [])
+        request_id = headers.get(REQUEST_ID_HEADER.encode(), b'').decode('latin-1') or uuid.uuid4().hex
+        request_id_token = _request_id.set(request_id)
+        trace = None
+        # A WebSocket session carries many queries over a long time, so only its request id is kept
+        if scope['type'] == 'http' and (self.sample_rate >= 1 or random.random() < self.sample_rate):
+            root = _new_span(f"{scope.get('method', 'WS')} {scope['path']}", None, {})
+            trace = Trace(request_id=request_id, trace_id=uuid.uuid4().hex, root=root)
+        trace_token = _current_trace.set(trace)
+        span_token = _current_span.set(None)
+
+        async def send_with_headers(message):
+            if message['type'] == 'http.response.start':
+                message.setdefault('headers', [])
+                message['headers'] = list(message['headers']) + [(REQUEST_ID_HEADER.encode(), request_id.encode())]
+                if trace is not None:
+                    trace.root.attributes['status'] = message['status']
+                    message['headers'].append((b'server-timing', trace.server_timing().encode()))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_headers)
+        finally:
+            _current_span.reset(span_token)
+            _current_trace.reset(trace_token)
+            _request_id.reset(request_id_token)
+            if trace is not None:
+                trace.root.end = time.perf_counter()
+                logger.info("Request timing", extra={'payload': trace.as_dict()})
+                if self.exporter is not None:
+                    self.exporter.submit(trace)
@@ -0,0 +1,207 @@
+"""Local stand-ins for the OpenAI and Replicate APIs used by the load-test harness"""
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Dict
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+ANSWER_WORDS = (
+    "The Golden visa is a long-term residence visa that allows foreign talents to live, work or study "
+    "in the UAE [1]. It is valid for 5 or 10 years and is renewed automatically [2]. "
+).split(' ')
+
+
+@dataclass
+class ProviderProfile:
+    """
+    Latency and failure behaviour of the fake providers.
+
+    Attributes:
+        ttft (float): Seconds before the first token.
+        tokens_per_second (float): The generation speed after the first token.
+        response_tokens (int): The number of tokens in every answer.
+        error_rate (float): The fraction of requests answered with a 500.
+        rate_limit_rate (float): The fraction of requests answered with a 429 and a Retry-After header.
+        embedding_dimension (int): The size of the vectors returned by /v1/embeddings.
+    """
+    ttft: float = 0.3
+    tokens_per_second: float = 50.0
+    response_tokens: int = 120
+    error_rate: float = 0.0
+    rate_limit_rate: float = 0.0
+    embedding_dimension: int = 1536
+
+
+def _tokens(count: int):
+    return [ANSWER_WORDS[index % len(ANSWER_WORDS)] + ' ' for index in range(count)]
+
+
+def _judge_response(prompt: str):
+    """
+    Returns a well-formed answer for the ragas faithfulness and answer relevancy prompts, so that the
+    evaluation path is exercised end to end. Every other prompt gets a plain generated answer.
+    """
+    if 'noncommittal' in prompt:
+        return json.dumps({"question": "What is the Golden visa?", "noncommittal": 0})
+    if 'verdict' in prompt:
+        return json.dumps([{"statement": "The Golden visa is a long-term residence visa.",
+                            "reason": "The context states it explicitly.", "verdict": 1}])
+    if 'simpler_statements' in prompt or 'sentence_index' in prompt:
+        return json.dumps([{"sentence_index": 0,
+                            "simpler_statements": ["The Golden visa is a long-term residence visa."]}])
+    return None
+
+
+def create_app(profile: ProviderProfile) -> FastAPI:
+    """
+    Builds the fake provider application.
+
+    OpenAI-compatible routes live under /v1/chat/completions and /v1/embeddings, Replicate-compatible
+    routes under /v1/models/{owner}/{name}/predictions, /v1/predictions/{id} and /stream/{id}.
+
+    Args:
+        profile (ProviderProfile): The simulated latency and failure behaviour.
+
+    Returns:
+        FastAPI: The application.
+    """
+    app = FastAPI()
+    predictions: Dict[str, dict] = {}
+
+    def injected_failure():
+        roll = random.random()
+        if roll < profile.rate_limit_rate:
+            return JSONResponse({"error": {"message": "Rate limit reached (injected)", "type": "rate_limit"}},
+                                status_code=429, headers={"Retry-After": "1"})
+        if roll < profile.rate_limit_rate + profile.error_rate:
+            return JSONResponse({"error": {"message": "Internal error (injected)", "type": "server_error"}},
+                                status_code=500)
+        return None
+
+    async def token_stream(count: int):
+        await asyncio.sleep(profile.ttft)
+        for index, token in enumerate(_tokens(count)):
+            if index:
+                await asyncio.sleep(1 / profile.tokens_per_second)
+            yield token
+
+    def generation_seconds(count: int):
+        return profile.ttft + max(count - 1, 0) / profile.tokens_per_second
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        failure = injected_failure()
+        if failure:
+            return failure
+        body = await request.json()
+        prompt = ' '.join(str(message.get('content', '')) for message in body.get('messages', []))
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+        judged = _judge_response(prompt)
+        usage = {"prompt_tokens": len(prompt.split()), "completion_tokens": profile.response_tokens,
+                 "total_tokens": len(prompt.split()) + profile.response_tokens}
+        if not body.get('stream'):
+            await asyncio.sleep(generation_seconds(profile.response_tokens))
+            text = judged or ''.join(_tokens(profile.response_tokens))
+            return {"id": completion_id, "object": "chat.completion", "created": created, "model": body['model'],
+                    "choices": [{"index": 0, "finish_reason": "stop",
+                                 "message": {"role": "assistant", "content": text}}],
+                    "usage": usage}
+
+        async def events():
+            def chunk(delta, finish_reason=None):
+                return "data: " + json.dumps({
+                    "id": completion_id, "object": "chat.completion.chunk", "created": created,
+                    "model": body['model'],
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}) + "\n\n"
+            yield chunk({"role": "assistant", "content": ""})
+            async for token in token_stream(profile.response_tokens):
+                yield chunk({"content": token})
+            yield chunk({}, "stop")
+            if body.get('stream_options', {}).get('include_usage'):
+                yield "data: " + json.dumps({"id": completion_id, "object": "chat.completion.chunk",
+                                             "created": created, "model": body['model'], "choices": [],
+                                             "usage": usage}) + "\n\n"
+            yield "data: [DONE]\n\n"
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    @app.post("/v1/embeddings")
+    async def embeddings(request: Request):
+        body = await request.json()
+        inputs = body['input'] if isinstance(body['input'], list) else [body['input']]
+        data = []
+        for index, item in enumerate(inputs):
+            seed = int(hashlib.md5(json.dumps(item).encode()).hexdigest()[:8], 16)
+            rng = random.Random(seed)
+            data.append({"object": "embedding", "index": index,
+                         "embedding": [rng.uniform(-1, 1) for _ in range(profile.embedding_dimension)]})
+        return {"object": "list", "data": data, "model": body.get('model', 'fake-embedding'),
+                "usage": {"prompt_tokens": 0, "total_tokens": 0}}
+
+    @app.post("/v1/models/{owner}/{name}/predictions")
+    async def create_prediction(owner: str, name: str, request: Request):
+        failure = injected_failure()
+        if failure:
+            return failure
+        body = await request.json()
+        prediction_id = uuid.uuid4().hex
+        base_url = str(request.base_url).rstrip('/')
+        prediction = {
+            "id": prediction_id, "model": f"{owner}/{name}", "version": "fake", "status": "starting",
+            "input": body.get('input', {}), "output": None, "logs": "", "error": None, "metrics": {},
+            "created_at": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), "started_at": None,
+            "completed_at": None,
+            "urls": {"get": f"{base_url}/v1/predictions/{prediction_id}",
+                     "cancel": f"{base_url}/v1/predictions/{prediction_id}/cancel",
+                     "stream": f"{base_url}/stream/{prediction_id}"},
+        }
+        predictions[prediction_id] = dict(prediction, _ready_at=time.monotonic() + generation_seconds(profile.response_tokens))
+        return JSONResponse(prediction, status_code=201)
+
+    @app.get("/v1/predictions/{prediction_id}")
+    async def get_prediction(prediction_id: str):
+        prediction = predictions.get(prediction_id)
+        if prediction is None:
+            return JSONResponse({"detail": "Not found"}, status_code=404)
+        if time.monotonic() >= prediction['_ready_at']:
+            prediction.update(status="succeeded", output=_tokens(profile.response_tokens),
+                              completed_at=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()))
+            predictions.pop(prediction_id, None)
+        else:
+            prediction['status'] = "processing"
+        return {key: value for key, value in prediction.items() if not key.startswith('_')}
+
+    @app.get("/stream/{prediction_id}")
+    async def stream_prediction(prediction_id: str):
+        predictions.pop(prediction_id, None)
+
+        async def events():
+            async for token in token_stream(profile.response_tokens):
+                yield f"event: output\nid: {uuid.uuid4().hex}\ndata: {token}\n\n"
+            yield "event: done\ndata: {}\n\n"
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake OpenAI- and Replicate-compatible providers.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9100)
+    parser.add_argument('--ttft', type=float, default=ProviderProfile.ttft, help="seconds to first token")
+    parser.add_argument('--tokens-per-second', type=float, default=ProviderProfile.tokens_per_second)
+    parser.add_argument('--response-tokens', type=int, default=ProviderProfile.response_tokens)
+    parser.add_argument('--error-rate', type=float, default=ProviderProfile.error_rate)
+    parser.add_argument('--rate-limit-rate', type=float, default=ProviderProfile.rate_limit_rate)
+    args = parser.parse_args()
+    profile = ProviderProfile(ttft=args.ttft, tokens_per_second=args.tokens_per_second,
+                              response_tokens=args.response_tokens, error_rate=args.error_rate,
+                              rate_limit_rate=args.rate_limit_rate)
+    uvicorn.run(create_app(profile), host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,290 @@
+"""
+End-to-end load test of the backend service against local stand-ins of the LLM providers.
+
+Run from the `backend_service` directory:
+
+    python -m benchmarks.load_test --concurrency 8 --requests 200 --output results.json
+    python -m benchmarks.load_test --compare results.json
+
+Unless `--target` points at a running backend, the harness starts `benchmarks.fake_providers` and a
+backend whose OpenAI and Replicate clients are redirected to it, so no provider credit is used.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import List, Optional
+import httpx
+import websockets
+from benchmarks.fake_providers import ProviderProfile
+from benchmarks.stats import summarize, save_results, compare_results
+
+SCENARIOS = ['query', 'evaluate', 'websocket', 'websocket-compact']
+QUERIES = [
+    "What is the Golden visa?",
+    "How do I renew my Emirates ID?",
+    "Is health insurance mandatory in Dubai?",
+    "Which vaccines are given to children at two months?",
+    "How can an expatriate get a residence visa for working in the private sector?",
+]
+EVALUATE_REQUEST = {
+    "query": QUERIES[0],
+    "model_responses": [
+        {"model_name": name, "response": "The Golden visa is a long-term residence visa [1]."}
+        for name in ['gpt-3.5-turbo response', 'gpt-4-turbo response', 'llama-2-70b-chat', 'falcon-40b-instruct']
+    ],
+    "contexts": ["The UAE's Golden visa is a long-term residence visa which enables foreign talents to live, "
+                 "work or study in the UAE."],
+}
+REGRESSION_METRICS = ['latency_ms.p50', 'latency_ms.p95', 'latency_ms.p99', 'ttft_ms.p50', 'ttft_ms.p95',
+                      'ttfb_ms.p50', 'ttfb_ms.p95',
+                      'throughput_rps']
+
+
+@dataclass
+class ScenarioResult:
+    """
+    The samples collected for one scenario. Streamed scenarios measure the time to the first token
+    (`ttfts`); the JSON endpoints answer in one body, so only the time to its first byte (`ttfbs`) is
+    measured, which is close to the total latency.
+    """
+    latencies: List[float] = field(default_factory=list)
+    ttfts: List[float] = field(default_factory=list)
+    ttfbs: List[float] = field(default_factory=list)
+    errors: List[str] = field(default_factory=list)
+    wall_seconds: float = 0.0
+    frames: int = 0
+
+    def as_dict(self):
+        requests = len(self.latencies) + len(self.errors)
+        first_output = {'ttft_ms': summarize(self.ttfts)} if self.ttfts else {'ttfb_ms': summarize(self.ttfbs)}
+        return {
+            'requests': requests,
+            'errors': len(self.errors),
+            'error_rate': round(len(self.errors) / requests, 4) if requests else 0.0,
+            'throughput_rps': round(len(self.latencies) / self.wall_seconds, 3) if self.wall_seconds else 0.0,
+            'latency_ms': summarize(self.latencies),
+            **first_output,
+            'frames_per_request': round(self.frames / len(self.latencies), 1) if self.latencies else 0.0,
+            'sample_errors': sorted(set(self.errors))[:5],
+        }
+
+
+async def http_request(client: httpx.AsyncClient, path: str, payload: dict, result: ScenarioResult):
+    start = time.perf_counter()
+    first_byte = None
+    async with client.stream('POST', path, json=payload) as response:
+        async for _ in response.aiter_bytes():
+            if first_byte is None:
+                first_byte = time.perf_counter()
+        if response.status_code != 200:
+            result.errors.append(f"HTTP {response.status_code}")
+            return
+    result.latencies.append(time.perf_counter() - start)
+    result.ttfbs.append((first_byte or time.perf_counter()) - start)
+
+
+async def websocket_request(websocket, query_id: str, query: str, result: ScenarioResult, compact: bool = False):
+    """
+    Runs one query of a WebSocket session and waits for its 'end' event, counting the frames received.
+    """
+    start = time.perf_counter()
+    first_delta = None
+    await websocket.send(json.dumps({'id': query_id, 'type': 'query', 'query': query, 'compact': compact}))
+    async for message in websocket:
+        event = json.loads(message)
+        if event.get('id') != query_id:
+            continue
+        result.frames += 1
+        if (event.get('type') == 'delta' or 'd' in event) and first_delta is None:
+            first_delta = time.perf_counter()
+        elif event.get('type') == 'error' and 'model' not in event:
+            result.errors.append(f"WebSocket error: {event['error']}")
+            return
+        elif event.get('type') == 'end':
+            break
+    else:
+        result.errors.append("WebSocket closed before the end of the query")
+        return
+    if first_delta is None:
+        result.errors.append("WebSocket query ended without output")
+        return
+    result.latencies.append(time.perf_counter() - start)
+    result.ttfts.append(first_delta - start)
+
+
+async def run_scenario(scenario: str, base_url: str, concurrency: int, requests: int) -> ScenarioResult:
+    """
+    Sends `requests` requests of one scenario with `concurrency` of them in flight at any time.
+
+    Args:
+        scenario (str): 'query', 'evaluate', 'websocket' or 'websocket-compact'.
+        base_url (str): The backend URL, e.g. http://127.0.0.1:9007.
+        concurrency (int): The number of concurrent clients.
+        requests (int): The total number of requests.
+
+    Returns:
+        ScenarioResult: The collected samples.
+    """
+    result = ScenarioResult()
+    counter = iter(range(requests))
+    ws_url = base_url.replace('http', 'ws', 1) + '/api/ws/model-output'
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=httpx.Timeout(300.0), limits=limits) as client:
+        async def worker():
+            # Every WebSocket client keeps one session open for all its queries
+            websocket = None
+            try:
+                for index in counter:
+                    query = QUERIES[index % len(QUERIES)]
+                    try:
+                        if scenario == 'query':
+                            await http_request(client, '/api/query', {"query": query}, result)
+                        elif scenario == 'evaluate':
+                            await http_request(client, '/api/evaluate', EVALUATE_REQUEST, result)
+                        else:
+                            if websocket is None:
+                                websocket = await websockets.connect(ws_url, max_size=None)
+                            await websocket_request(websocket, f"q{index}", query, result,
+                                                    compact=scenario == 'websocket-compact')
+                    except (httpx.HTTPError, OSError, websockets.WebSocketException) as e:
+                        result.errors.append(type(e).__name__)
+                        websocket = None
+            finally:
+                if websocket is not None:
+                    await websocket.close()
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        result.wall_seconds = time.perf_counter() - start
+    return result
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _wait_for(url: str, process: subprocess.Popen, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{' '.join(process.args)} exited with code {process.returncode}")
+        try:
+            if httpx.get(url, timeout=2.0).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    raise TimeoutError(f"{url} did not come up within {timeout}s")
+
+
+def start_stack(profile: ProviderProfile, startup_timeout: float):
+    """
+    Starts the fake providers and a backend pointed at them.
+
+    Args:
+        profile (ProviderProfile): The simulated provider behaviour.
+        startup_timeout (float): Seconds to wait for the backend to load its models.
+
+    Returns:
+        Tuple[str, List[subprocess.Popen]]: The backend URL and the processes to stop afterwards.
+    """
+    provider_port, backend_port = _free_port(), _free_port()
+    provider_url = f"http://127.0.0.1:{provider_port}"
+    providers = subprocess.Popen([
+        sys.executable, '-m', 'benchmarks.fake_providers', '--port', str(provider_port),
+        '--ttft', str(profile.ttft), '--tokens-per-second', str(profile.tokens_per_second),
+        '--response-tokens', str(profile.response_tokens), '--error-rate', str(profile.error_rate),
+        '--rate-limit-rate', str(profile.rate_limit_rate),
+    ])
+    processes = [providers]
+    try:
+        _wait_for(provider_url + '/docs', providers, 30)
+        env = dict(os.environ,
+                   OPENAI_API_KEY='fake-key', REPLICATE_API_TOKEN='fake-token',
+                   OPENAI_BASE_URL=provider_url + '/v1', OPENAI_API_BASE=provider_url + '/v1',
+                   REPLICATE_BASE_URL=provider_url, REPLICATE_POLL_INTERVAL='0.05')
+        backend = subprocess.Popen([
+            sys.executable, '-m', 'uvicorn', 'backend_service.app:app', '--host', '127.0.0.1',
+            '--port', str(backend_port), '--log-level', 'warning',
+        ], env=env)
+        processes.append(backend)
+        backend_url = f"http://127.0.0.1:{backend_port}"
+        _wait_for(backend_url + '/api/', backend, startup_timeout)
+    except Exception:
+        stop_stack(processes)
+        raise
+    return backend_url, processes
+
+
+def stop_stack(processes: List[subprocess.Popen]):
+    for process in reversed(processes):
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--target', default=None, help="URL of a running backend; by default one is started")
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=100, help="requests per scenario")
+    parser.add_argument('--ttft', type=float, default=ProviderProfile.ttft)
+    parser.add_argument('--tokens-per-second', type=float, default=ProviderProfile.tokens_per_second)
+    parser.add_argument('--response-tokens', type=int, default=ProviderProfile.response_tokens)
+    parser.add_argument('--error-rate', type=float, default=ProviderProfile.error_rate)
+    parser.add_argument('--rate-limit-rate', type=float, default=ProviderProfile.rate_limit_rate)
+    parser.add_argument('--startup-timeout', type=float, default=300.0)
+    parser.add_argument('--output', default=None, help="write the results to this JSON file")
+    parser.add_argument('--compare', default=None, help="results file of an earlier commit to compare with")
+    parser.add_argument('--threshold', type=float, default=0.1, help="relative change reported as regression")
+    args = parser.parse_args(argv)
+
+    profile = ProviderProfile(ttft=args.ttft, tokens_per_second=args.tokens_per_second,
+                              response_tokens=args.response_tokens, error_rate=args.error_rate,
+                              rate_limit_rate=args.rate_limit_rate)
+    processes = []
+    if args.target:
+        base_url = args.target.rstrip('/')
+    else:
+        base_url, processes = start_stack(profile, args.startup_timeout)
+    results = {}
+    try:
+        for scenario in args.scenarios:
+            result = asyncio.run(run_scenario(scenario, base_url, args.concurrency, args.requests)).as_dict()
+            results[scenario] = result
+            latency = result['latency_ms']
+            first_output, first = ('TTFT', result['ttft_ms']) if 'ttft_ms' in result else ('TTFB', result['ttfb_ms'])
+            frames = f" | {result['frames_per_request']:.0f} frames/req" if result['frames_per_request'] else ''
+            print(f"{scenario:>10}: {result['throughput_rps']:.2f} req/s | errors {result['error_rate']:.1%} | "
+                  f"latency p50/p95/p99 {latency.get('p50', 0):.0f}/{latency.get('p95', 0):.0f}/"
+                  f"{latency.get('p99', 0):.0f} ms | {first_output} p50/p95/p99 {first.get('p50', 0):.0f}/"
+                  f"{first.get('p95', 0):.0f}/{first.get('p99', 0):.0f} ms{frames}")
+    finally:
+        stop_stack(processes)
+
+    meta = {'target': args.target or 'local', 'concurrency': args.concurrency, 'requests': args.requests,
+            'provider_profile': vars(profile)}
+    if args.output:
+        save_results(args.output, results, meta)
+    if args.compare:
+        regressions = compare_results(results, args.compare, REGRESSION_METRICS, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regressions above {args.threshold:.0%}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
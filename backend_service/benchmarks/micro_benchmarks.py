@@ -0,0 +1,224 @@
+"""
+Micro-benchmarks of the in-process hot paths: embedding, retrieval, prompt building, chunking and HTML parsing.
+
+Run from the `backend_service` directory:
+
+    python -m benchmarks.micro_benchmarks --output micro_baseline.json
+    python -m benchmarks.micro_benchmarks --compare micro_baseline.json --threshold 0.15
+    python -m benchmarks.micro_benchmarks --only embedding_batch_1 embedding_batch_32
+
+Every benchmark reports mean/p50/p99 time per call and the peak resident set size reached while it
+ran. A benchmark whose inputs are missing, e.g. `semantic_search` without a populated `chromadb_data`,
+is skipped with a message.
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+from benchmarks.stats import summarize, save_results, compare_results
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+WEB_SCRAPPER_DIR = os.path.join(REPO_ROOT, 'web_scrapper')
+DATA_FILE_PATH = os.path.join(REPO_ROOT, 'scrapped_data', 'scrapped_data_v23.csv')
+COLLECTION_NAME = 'info-services-index'
+EMBEDDING_BATCH_SIZES = [1, 8, 32, 128]
+QUERY = "How can an expatriate get a residence visa for working in the private sector?"
+REGRESSION_METRICS = ['latency_ms.mean', 'latency_ms.p99', 'peak_rss_mb']
+
+
+class BenchmarkSkipped(Exception):
+    """Raised by a benchmark setup when its inputs are not available."""
+
+
+@dataclass
+class MicroBenchmark:
+    """
+    A benchmark whose `setup` returns the zero-argument callable that is timed.
+
+    Attributes:
+        name (str): The name used in the results file.
+        setup (Callable[[], Callable[[], object]]): Builds the inputs, untimed.
+        iterations (int): The number of timed calls.
+        warmup (int): The number of untimed calls before timing.
+    """
+    name: str
+    setup: Callable[[], Callable[[], object]]
+    iterations: int = 50
+    warmup: int = 3
+
+
+class PeakRSSSampler:
+    """
+    Samples the resident set size of the process in a background thread and keeps the maximum.
+
+    `resource.getrusage` only reports the peak of the whole process lifetime, which hides the
+    footprint of every benchmark after the most expensive one.
+    """
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @staticmethod
+    def current_rss() -> int:
+        """
+        Returns the resident set size in bytes, read from /proc on Linux.
+        """
+        try:
+            with open('/proc/self/statm', 'r') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError):
+            import resource
+            # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+            scale = 1 if sys.platform == 'darwin' else 1024
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self.current_rss())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = self.current_rss()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.current_rss())
+
+
+def _import_web_scrapper():
+    # The scraper modules use flat imports and are normally run from the web_scrapper directory
+    if WEB_SCRAPPER_DIR not in sys.path:
+        sys.path.insert(0, WEB_SCRAPPER_DIR)
+
+
+def _sample_documents(count: int) -> List[str]:
+    import pandas as pd
+    if not os.path.exists(DATA_FILE_PATH):
+        raise BenchmarkSkipped(f"{DATA_FILE_PATH} does not exist")
+    df = pd.read_csv(DATA_FILE_PATH, nrows=count * 2).dropna()
+    documents = (df['title'] + ' ' + df['content']).tolist()
+    return [documents[index % len(documents)][:2000] for index in range(count)]
+
+
+def setup_embedding(batch_size: int):
+    def setup():
+        from backend_service.embedding_func import CustomEmbeddingFunction
+        embedding_function = CustomEmbeddingFunction()
+        documents = _sample_documents(batch_size)
+        return lambda: embedding_function(documents)
+    return setup
+
+
+def setup_semantic_search():
+    from backend_service.helper_functions import get_chromadb_collection, perform_semantic_search
+    try:
+        collection = {'chromadb_collection': get_chromadb_collection(COLLECTION_NAME)}
+    except Exception as e:
+        raise BenchmarkSkipped(f"collection '{COLLECTION_NAME}' is not available: {e}")
+    return lambda: perform_semantic_search(QUERY, collection)
+
+
+def setup_generate_prompt():
+    from backend_service.helper_functions import generate_prompt
+    summaries = [_sample_documents(5)]
+    return lambda: generate_prompt(QUERY, summaries)
+
+
+def setup_preprocess_data():
+    _import_web_scrapper()
+    from utils import preprocess_data
+    if not os.path.exists(DATA_FILE_PATH):
+        raise BenchmarkSkipped(f"{DATA_FILE_PATH} does not exist")
+    return lambda: preprocess_data(DATA_FILE_PATH)
+
+
+def setup_data_parsers():
+    _import_web_scrapper()
+    from benchmark_parsers import load_fixtures
+    from data_parsers import parse_page
+    from utils import ParsedPage
+    pages = load_fixtures()
+    if not pages:
+        raise BenchmarkSkipped("no saved pages in web_scrapper/fixtures")
+    return lambda: [parse_page(ParsedPage(response), kind) for response, kind in pages]
+
+
+BENCHMARKS = [
+    *[MicroBenchmark(f'embedding_batch_{batch_size}', setup_embedding(batch_size),
+                     iterations=max(5, 160 // batch_size)) for batch_size in EMBEDDING_BATCH_SIZES],
+    MicroBenchmark('semantic_search', setup_semantic_search, iterations=50),
+    MicroBenchmark('generate_prompt', setup_generate_prompt, iterations=2000, warmup=20),
+    MicroBenchmark('preprocess_data', setup_preprocess_data, iterations=3, warmup=1),
+    MicroBenchmark('data_parsers', setup_data_parsers, iterations=50),
+]
+
+
+def run_benchmark(benchmark: MicroBenchmark, iterations: Optional[int] = None) -> Optional[Dict]:
+    """
+    Runs one benchmark.
+
+    Args:
+        benchmark (MicroBenchmark): The benchmark.
+        iterations (int, optional): Overrides the number of timed calls.
+
+    Returns:
+        Optional[Dict]: The timings and peak RSS, or None if the benchmark was skipped.
+    """
+    try:
+        function = benchmark.setup()
+    except BenchmarkSkipped as e:
+        print(f"{benchmark.name:>24}: skipped, {e}")
+        return None
+    for _ in range(benchmark.warmup):
+        function()
+    timings = []
+    with PeakRSSSampler() as sampler:
+        for _ in range(iterations or benchmark.iterations):
+            start = time.perf_counter()
+            function()
+            timings.append(time.perf_counter() - start)
+    result = {'iterations': len(timings), 'latency_ms': summarize(timings),
+              'peak_rss_mb': round(sampler.peak / 2 ** 20, 1)}
+    latency = result['latency_ms']
+    print(f"{benchmark.name:>24}: mean {latency['mean']:10.3f} ms | p99 {latency['p99']:10.3f} ms | "
+          f"peak RSS {result['peak_rss_mb']:8.1f} MB")
+    return result
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--only', nargs='+', choices=[benchmark.name for benchmark in BENCHMARKS], default=None)
+    parser.add_argument('--iterations', type=int, default=None, help="overrides the timed calls per benchmark")
+    parser.add_argument('--output', default=None, help="write the results to this JSON file")
+    parser.add_argument('--compare', default=None, help="results file of an earlier commit to compare with")
+    parser.add_argument('--threshold', type=float, default=0.15, help="relative change reported as regression")
+    args = parser.parse_args(argv)
+
+    results = {}
+    for benchmark in BENCHMARKS:
+        if args.only and benchmark.name not in args.only:
+            continue
+        result = run_benchmark(benchmark, args.iterations)
+        if result is not None:
+            results[benchmark.name] = result
+
+    if args.output:
+        save_results(args.output, results, {'iterations': args.iterations, 'python': sys.version.split()[0]})
+    if args.compare:
+        regressions = compare_results(results, args.compare, REGRESSION_METRICS, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regressions above {args.threshold:.0%}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,109 @@
+"""Shared statistics and result-file helpers for the benchmarks"""
+import json
+import math
+import subprocess
+import time
+from typing import Dict, List, Sequence
+
+
+def percentile(values: Sequence[float], q: float) -> float:
+    """
+    Computes a percentile with linear interpolation between the closest ranks.
+
+    Args:
+        values (Sequence[float]): The samples.
+        q (float): The percentile, between 0 and 100.
+
+    Returns:
+        float: The percentile, or NaN if there are no samples.
+    """
+    if not values:
+        return math.nan
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * q / 100
+    lower, upper = math.floor(rank), math.ceil(rank)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
+
+
+def summarize(seconds: Sequence[float]) -> Dict[str, float]:
+    """
+    Summarises durations in milliseconds.
+
+    Args:
+        seconds (Sequence[float]): The durations in seconds.
+
+    Returns:
+        Dict[str, float]: The mean, p50, p95, p99 and max in milliseconds.
+    """
+    if not seconds:
+        return {}
+    return {
+        'mean': round(sum(seconds) / len(seconds) * 1000, 3),
+        'p50': round(percentile(seconds, 50) * 1000, 3),
+        'p95': round(percentile(seconds, 95) * 1000, 3),
+        'p99': round(percentile(seconds, 99) * 1000, 3),
+        'max': round(max(seconds) * 1000, 3),
+    }
+
+
+def git_commit() -> str:
+    """
+    Returns the short hash of the checked out commit, or 'unknown' outside a git checkout.
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def save_results(path: str, results: Dict, meta: Dict):
+    """
+    Writes benchmark results together with the commit and time they were measured at.
+
+    Args:
+        path (str): The JSON file to write.
+        results (Dict): The results, keyed by benchmark name.
+        meta (Dict): The benchmark configuration.
+    """
+    payload = {'meta': dict(meta, commit=git_commit(), timestamp=time.strftime('%Y-%m-%dT%H:%M:%S%z')),
+               'results': results}
+    with open(path, 'w') as f:
+        json.dump(payload, f, indent=2)
+    print(f"Results written to {path}")
+
+
+def compare_results(current: Dict, baseline_path: str, metrics: List[str], threshold: float) -> List[str]:
+    """
+    Compares results against a baseline file. Every metric is a path like 'latency_ms.p95' where a
+    higher value is worse, except for names ending in '_rps' where a lower value is worse.
+
+    Args:
+        current (Dict): The results, keyed by benchmark name.
+        baseline_path (str): A file written by `save_results`.
+        metrics (List[str]): The metric paths to compare.
+        threshold (float): The relative change that counts as a regression, e.g. 0.1 for 10%.
+
+    Returns:
+        List[str]: A description of every regression, empty if there are none.
+    """
+    with open(baseline_path, 'r') as f:
+        baseline = json.load(f)
+    print(f"Comparing against {baseline_path} (commit {baseline['meta'].get('commit', 'unknown')})")
+    regressions = []
+    for name, result in current.items():
+        if name not in baseline['results']:
+            continue
+        for metric in metrics:
+            new, old = result, baseline['results'][name]
+            for key in metric.split('.'):
+                new, old = (new or {}).get(key), (old or {}).get(key)
+            if not isinstance(new, (int, float)) or not isinstance(old, (int, float)) or not old:
+                continue
+            change = (new - old) / old
+            worse = -change if metric.endswith('_rps') else change
+            flag = 'REGRESSION' if worse > threshold else ''
+            print(f"{name:>24} {metric:<18} {old:>12.3f} -> {new:>12.3f} ({change:+.1%}) {flag}")
+            if flag:
+                regressions.append(f"{name} {metric} {old:.3f} -> {new:.3f} ({change:+.1%})")
+    return regressions
@@ -1,19 +1,84 @@
 from dotenv import load_dotenv
 
 load_dotenv()  # take environment variables from .env.
+import argparse
+import multiprocessing
+import os
 import uvicorn
 from backend_service.helper_functions import get_port, setup_logger
+from backend_service.embedding_service import DEFAULT_SOCKET_PATH, run_embedding_service
+
+COLLECTION_NAME = 'info-services-index'
+
+
+def parse_args():
+    """
+    Parses the command line, with defaults taken from the environment.
+    """
+    parser = argparse.ArgumentParser(description="Run the backend service.")
+    parser.add_argument('--production', action='store_true', default=os.environ.get('BACKEND_MODE') == 'production',
+                        help="serve with several workers sharing one embedding service, without reload")
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('WEB_CONCURRENCY', os.cpu_count() or 1)),
+                        help="number of API worker processes in production mode")
+    parser.add_argument('--embedding-socket', default=os.environ.get('EMBEDDING_SERVICE_SOCKET', DEFAULT_SOCKET_PATH))
+    return parser.parse_args()
+
+
+def start_embedding_service(socket_path: str, logger, timeout: float = 600):
+    """
+    Starts the shared embedding service in a separate process and waits until it accepts connections.
+
+    Args:
+        socket_path (str): The Unix socket the service listens on.
+        logger: The service logger.
+        timeout (float, optional): Seconds to wait for the model and collection to load. Defaults to 600.
+
+    Returns:
+        multiprocessing.Process: The service process.
+    """
+    context = multiprocessing.get_context('spawn')
+    ready = context.Event()
+    process = context.Process(target=run_embedding_service, args=(COLLECTION_NAME, socket_path),
+                              kwargs={'ready': ready}, name='embedding-service', daemon=True)
+    process.start()
+    if not ready.wait(timeout) or not process.is_alive():
+        process.terminate()
+        raise RuntimeError(f"Embedding service did not start within {timeout}s")
+    logger.info(f"Embedding service ready on {socket_path} (pid {process.pid})")
+    return process
 
 
 def main():
     """
     Entry point for the application.
+
+    By default the service runs one worker with reload for development. With `--production` (or
+    BACKEND_MODE=production) the gte model and the ChromaDB collection are loaded once in a separate
+    embedding service process, and `--workers` API workers (WEB_CONCURRENCY, the number of cores by
+    default) query it over a Unix socket, so memory does not grow with the number of workers.
+
+    WebSocket frames are compressed with permessage-deflate when the client offers it.
     """
+    args = parse_args()
     logger = setup_logger('backend_service_logger')
     port = get_port()
 
-    logger.info("Starting backend service..")
-    uvicorn.run("backend_service.app:app", port=port, host="0.0.0.0", workers=1, reload=True)
+    if not args.production:
+        logger.info("Starting backend service..")
+        uvicorn.run("backend_service.app:app", port=port, host="0.0.0.0", workers=1, reload=True,
+                    ws_per_message_deflate=True)
+        return
+
+    embedding_service = start_embedding_service(args.embedding_socket, logger)
+    # Inherited by the worker processes, see `backend_service.app`
+    os.environ['EMBEDDING_SERVICE_SOCKET'] = args.embedding_socket
+    try:
+        logger.info(f"Starting backend service with {args.workers} workers..")
+        uvicorn.run("backend_service.app:app", port=port, host="0.0.0.0", workers=args.workers,
+                    ws_per_message_deflate=True)
+    finally:
+        embedding_service.terminate()
+        embedding_service.join(10)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
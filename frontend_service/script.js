@@ -1,4 +1,136 @@
-document.getElementById('searchBtn').addEventListener('click', function() {
+const WEBSOCKET_URL = 'ws://127.0.0.2:9007/api/ws/model-output'; // Adjust this URL
+
+// One WebSocket session is kept open and reused for every query
+let websocket = null;
+let currentQueryId = null;
+let queryCounter = 0;
+// Model names of the compact frames of the current query, by index
+let queryModels = [];
+// Text received since the last repaint, appended to the page once per animation frame
+const pendingText = new Map();
+const responseNodes = new Map();
+let repaintScheduled = false;
+
+function getWebSocket() {
+    if (websocket && (websocket.readyState === WebSocket.OPEN || websocket.readyState === WebSocket.CONNECTING)) {
+        return Promise.resolve(websocket);
+    }
+    return new Promise((resolve, reject) => {
+        const socket = new WebSocket(WEBSOCKET_URL);
+        socket.onopen = () => resolve(socket);
+        socket.onmessage = (event) => handleEvent(JSON.parse(event.data));
+        socket.onclose = () => {
+            websocket = null;
+            if (currentQueryId !== null) finishQuery();
+        };
+        socket.onerror = (error) => {
+            console.error('WebSocket error:', error);
+            reject(error);
+        };
+        websocket = socket;
+    });
+}
+
+function getModelResponse(model) {
+    const modelResponsesDiv = document.getElementById('modelResponses');
+    let modelResponse = document.getElementById(`response-${model}`);
+    if (!modelResponse) {
+        const responseDiv = document.createElement('div');
+        const modelTitle = document.createElement('h3');
+        modelTitle.textContent = model;
+        modelResponse = document.createElement('p');
+        modelResponse.id = `response-${model}`;
+        responseDiv.appendChild(modelTitle);
+        responseDiv.appendChild(modelResponse);
+        modelResponsesDiv.appendChild(responseDiv);
+    }
+    return modelResponse;
+}
+
+function getResponseNode(model) {
+    let node = responseNodes.get(model);
+    if (!node) {
+        node = document.createTextNode('');
+        getModelResponse(model).appendChild(node);
+        responseNodes.set(model, node);
+    }
+    return node;
+}
+
+function appendText(model, text) {
+    pendingText.set(model, (pendingText.get(model) || '') + text);
+    if (!repaintScheduled) {
+        repaintScheduled = true;
+        requestAnimationFrame(flushText);
+    }
+}
+
+function flushText() {
+    repaintScheduled = false;
+    pendingText.forEach((text, model) => getResponseNode(model).appendData(text));
+    pendingText.clear();
+}
+
+function resetResponses() {
+    pendingText.clear();
+    responseNodes.clear();
+    queryModels = [];
+}
+
+function showContexts(contexts) {
+    const modelResponsesDiv = document.getElementById('modelResponses');
+    const sourcesDiv = document.createElement('div');
+    const sourcesTitle = document.createElement('h3');
+    sourcesTitle.textContent = 'Sources';
+    const sourcesList = document.createElement('ol');
+    contexts.forEach(context => {
+        const item = document.createElement('li');
+        item.textContent = context;
+        sourcesList.appendChild(item);
+    });
+    sourcesDiv.appendChild(sourcesTitle);
+    sourcesDiv.appendChild(sourcesList);
+    modelResponsesDiv.prepend(sourcesDiv);
+}
+
+function handleEvent(data) {
+    // Events of a cancelled query may still be in flight
+    if (data.id !== currentQueryId) return;
+    if (data.d) {
+        // Compact frame: the coalesced deltas of every model as [model index, text]
+        data.d.forEach(([index, text]) => appendText(queryModels[index], text));
+    } else if (data.type === 'models') {
+        queryModels = data.models;
+    } else if (data.type === 'contexts') {
+        showContexts(data.contexts);
+    } else if (data.type === 'delta') {
+        appendText(data.model, data.text);
+    } else if (data.type === 'degraded') {
+        // Under load the server may answer from its cache instead of querying the models
+        (data.model_responses || []).forEach(response => {
+            getModelResponse(response.model_name).textContent = response.response;
+        });
+    } else if (data.type === 'error') {
+        if (data.model) {
+            appendText(data.model, ` [error: ${data.error}]`);
+        } else {
+            // An error of the whole query is its last event, the server sends no 'end' after it
+            finishQuery();
+            document.getElementById('evaluationResult').textContent += ` [error: ${data.error}]`;
+        }
+    } else if (data.type === 'end' || data.type === 'cancelled') {
+        finishQuery();
+    }
+}
+
+function finishQuery() {
+    flushText();
+    currentQueryId = null;
+    document.getElementById('queryInput').disabled = false;
+    evaluateModelResponses();
+}
+
+document.getElementById('searchBtn').addEventListener('click', async function() {
     const queryInput = document.getElementById('queryInput');
     const modelResponsesDiv = document.getElementById('modelResponses');
     const evaluationResultPre = document.getElementById('evaluationResult');
@@ -8,36 +140,28 @@ document.getElementById('searchBtn').addEventListener('click', function() {
 
     queryInput.disabled = true;
     modelResponsesDiv.innerHTML = '';
+    resetResponses();
     evaluationResultPre.textContent = '';
 
-    const websocket = new WebSocket('ws://127.0.0.2:9007/api/ws/model-output'); // Adjust this URL
-
-    websocket.onopen = () => websocket.send(query);
-    websocket.onmessage = (event) => {
-        const data = JSON.parse(event.data);
-        Object.keys(data).forEach(model => {
-            const responseDiv = document.createElement('div');
-            const modelTitle = document.createElement('h3');
-            modelTitle.textContent = model;
-            const modelResponse = document.createElement('p');
-            modelResponse.textContent = data[model];
-            responseDiv.appendChild(modelTitle);
-            responseDiv.appendChild(modelResponse);
-            modelResponsesDiv.appendChild(responseDiv);
-        });
-    };
-    websocket.onclose = () => {
-        queryInput.disabled = false;
-        evaluateModelResponses();
-    };
-    websocket.onerror = (error) => {
-        console.error('WebSocket error:', error);
+    try {
+        const socket = await getWebSocket();
+        // A new query cancels the previous one on the server
+        currentQueryId = `q${++queryCounter}`;
+        socket.send(JSON.stringify({ id: currentQueryId, type: 'query', query: query, compact: true }));
+    } catch (error) {
         queryInput.disabled = false;
-    };
+    }
+});
+
+// Stop paying for tokens nobody reads when the page is left
+window.addEventListener('beforeunload', () => {
+    if (websocket && currentQueryId !== null) {
+        websocket.send(JSON.stringify({ id: currentQueryId, type: 'cancel' }));
+    }
 });
 
 function evaluateModelResponses() {
     // Dummy function for evaluation - replace with actual API call
     const evaluationResultPre = document.getElementById('evaluationResult');
     evaluationResultPre.textContent = 'Evaluation results will be displayed here.';
-}
\ No newline at end of file
+}
@@ -0,0 +1,311 @@
+import asyncio
+import json
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Tuple
+from urllib.parse import urlparse
+import aiohttp
+from data_parsers import parse_page
+from utils import ParsedPage
+from http_cache import ResponseCache
+from crawl_journal import CrawlJournal
+from record_store import open_record_writer, make_records
+
+MAIN_URL = 'https://u.ae/en/information-and-services'
+SPECIAL_CASE_PATH = '/en/information-and-services/top-government-services'
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+@dataclass
+class PageResponse:
+    """
+    The subset of `requests.Response` used by the parsers, filled from an aiohttp response.
+
+    Attributes:
+        url (str): The URL of the page.
+        status_code (int): The HTTP status code.
+        content (bytes): The response body.
+        from_cache (bool): True if the server answered 304 and the body was read from the cache.
+    """
+    url: str
+    status_code: int
+    content: bytes = b''
+    from_cache: bool = False
+
+
+@dataclass(order=True)
+class CrawlTask:
+    """
+    An entry of the crawl frontier.
+
+    Attributes:
+        order (Tuple[int, ...]): The position of the page in a depth-first walk of the site. Results are
+            merged in this order so the output matches the recursive scraper regardless of fetch order.
+        url (str): The URL to fetch.
+        kind (str): 'main' for the start page, 'special' for top government services, 'page' otherwise.
+    """
+    order: Tuple[int, ...]
+    url: str = field(compare=False)
+    kind: str = field(compare=False, default='page')
+
+
+class AsyncCrawler:
+    """
+    Concurrent crawler for the u.ae information and services portal.
+
+    Pages are fetched through one pooled keep-alive `aiohttp` session by `concurrency` workers that
+    share a work-queue frontier. Requests to the same host are limited to `per_host_limit` at a time
+    and spaced by at least `min_delay` seconds. Already discovered URLs are kept in a set.
+
+    Attributes:
+        start_url (str): The information and services page to start from.
+        concurrency (int): The number of pages fetched and parsed at the same time.
+        per_host_limit (int): The maximum number of concurrent requests to a single host.
+        min_delay (float): The minimum number of seconds between two requests to the same host.
+        timeout (float): The total timeout of a single request in seconds.
+        max_retries (int): How often a request is retried on connection errors and 429/5xx responses.
+        parser (Optional[str]): The BeautifulSoup parser backend, see `resolve_html_parser`.
+        cache (Optional[ResponseCache]): When set, pages are requested conditionally and 304 responses
+            are served from the cache.
+        journal (Optional[CrawlJournal]): When set, the frontier, visited set and results are persisted
+            so that an interrupted crawl resumes where it stopped and only retries unfinished URLs.
+        output_path (Optional[str]): When set, the records of every page are appended to this .jsonl,
+            .parquet or .csv file as soon as the page is parsed.
+        visited (Set[str]): The URLs that have been added to the frontier.
+        failed_pages (Dict[str, int]): The URLs that could not be fetched or parsed in this run.
+        changed_pages (List[str]): The URLs whose body was new or different from the cached one.
+        unchanged_pages (List[str]): The URLs confirmed unchanged by a 304 response.
+    """
+    def __init__(self, start_url: str = MAIN_URL, concurrency: int = 16, per_host_limit: int = 8,
+                 min_delay: float = 0.0, timeout: float = 30.0, max_retries: int = 2, parser: str = None,
+                 cache_dir: str = None, journal_path: str = None, output_path: str = None):
+        self.start_url = start_url
+        self.concurrency = concurrency
+        self.per_host_limit = per_host_limit
+        self.min_delay = min_delay
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.parser = parser
+        self.cache = ResponseCache(cache_dir) if cache_dir else None
+        self.journal = CrawlJournal(journal_path) if journal_path else None
+        self.output_path = output_path
+        self._writer = None
+        self.visited = set()
+        self.changed_pages = []
+        self.failed_pages = {}
+        self.unchanged_pages = []
+        self.results = {}
+        self._frontier = None
+        self._session = None
+        self._host_semaphores = {}
+        self._host_next_slot = {}
+        self._host_locks = {}
+
+    async def _wait_for_host(self, host: str):
+        # Reserve the next request slot for this host so that requests are at least `min_delay` apart
+        lock = self._host_locks.setdefault(host, asyncio.Lock())
+        async with lock:
+            now = time.monotonic()
+            slot = max(now, self._host_next_slot.get(host, now))
+            self._host_next_slot[host] = slot + self.min_delay
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def fetch(self, url: str) -> PageResponse:
+        """
+        Fetches a page, retrying connection errors and retryable status codes with exponential backoff.
+
+        With a cache, the request carries the cached validators. A 304 response is turned into a 200
+        with the cached body, and a 200 response is stored and recorded in `changed_pages` if it differs.
+
+        Args:
+            url (str): The URL to fetch.
+
+        Returns:
+            PageResponse: The response. Non-200 responses are returned after the retries are exhausted.
+        """
+        headers = await asyncio.to_thread(self.cache.conditional_headers, url) if self.cache else {}
+        page, response_headers = await self._get(url, headers)
+        if self.cache is None:
+            return page
+        if page.status_code == 304 and headers:
+            self.unchanged_pages.append(url)
+            content = await asyncio.to_thread(self.cache.load_body, url)
+            await asyncio.to_thread(self.cache.mark_validated, url)
+            return PageResponse(url=page.url, status_code=200, content=content, from_cache=True)
+        if page.status_code == 200:
+            changed = await asyncio.to_thread(self.cache.store, url, page.content,
+                                              response_headers.get('ETag'), response_headers.get('Last-Modified'))
+            if changed:
+                self.changed_pages.append(url)
+            else:
+                self.unchanged_pages.append(url)
+        return page
+
+    async def _get(self, url: str, headers: Dict[str, str]):
+        host = urlparse(url).netloc
+        semaphore = self._host_semaphores.setdefault(host, asyncio.Semaphore(self.per_host_limit))
+        for attempt in range(self.max_retries + 1):
+            backoff = 2 ** attempt
+            try:
+                async with semaphore:
+                    if self.min_delay:
+                        await self._wait_for_host(host)
+                    async with self._session.get(url, headers=headers) as response:
+                        page = PageResponse(url=str(response.url), status_code=response.status,
+                                            content=await response.read())
+                        response_headers = response.headers
+                        retry_after = response.headers.get('Retry-After')
+                if page.status_code not in RETRY_STATUSES or attempt == self.max_retries:
+                    return page, response_headers
+                if retry_after and retry_after.isdigit():
+                    backoff = int(retry_after)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == self.max_retries:
+                    return PageResponse(url=url, status_code=0, content=str(e).encode()), {}
+                print(f"Error fetching {url}: {e!r}, retrying")
+            await asyncio.sleep(backoff)
+
+    def _enqueue(self, url: str, order: Tuple[int, ...], kind: str = 'page'):
+        if url in self.visited:
+            print(f"Webpage {url} already visited")
+            return
+        self.visited.add(url)
+        if self.journal is not None:
+            self.journal.enqueued(url, order, kind)
+        self._frontier.put_nowait(CrawlTask(order=order, url=url, kind=kind))
+
+    def _process(self, task: CrawlTask, page: PageResponse):
+        # Runs in a worker thread so that parsing does not stall the fetches
+        return parse_page(ParsedPage(page, self.parser), task.kind)
+
+    async def _worker(self):
+        while True:
+            task = await self._frontier.get()
+            try:
+                print(f"Fetching contents of webpage: {task.url}")
+                page = await self.fetch(task.url)
+                if page.status_code != 200:
+                    print(f"Failed to retrieve the webpage {task.url}. Status code: {page.status_code}")
+                    self._failed(task, page.status_code)
+                    continue
+                try:
+                    data, links = await asyncio.to_thread(self._process, task, page)
+                except Exception as e:
+                    print(f"Error parsing data from webpage {task.url}: {e}")
+                    self._failed(task, page.status_code)
+                    continue
+                if data:
+                    self.results[task.order] = data
+                    # Written before the journal marks the page done: a crash here duplicates the
+                    # page's records on resume, which the exact-duplicate filter of preprocessing drops
+                    if self._writer is not None:
+                        self._writer.write(make_records(data, url=task.url))
+                # Children are journaled before the parent is marked done, so a crash cannot lose them
+                for index, link in enumerate(links):
+                    kind = 'special' if urlparse(link).path == SPECIAL_CASE_PATH else 'page'
+                    self._enqueue(link, task.order + (index,), kind)
+                if self.journal is not None:
+                    self.journal.succeeded(task.url, task.order, data or None)
+            finally:
+                # Before task_done, so that the crawl does not end while a snapshot is being written
+                if self.journal is not None:
+                    await self.journal.compact_if_due()
+                self._frontier.task_done()
+
+    def _failed(self, task: CrawlTask, status: int):
+        self.failed_pages[task.url] = status
+        if self.journal is not None:
+            self.journal.failed(task.url, status)
+
+    def _resume(self) -> bool:
+        state = self.journal.load()
+        if not state.tasks:
+            return False
+        if not state.pending:
+            # The recorded crawl finished: a rerun, e.g. a scheduled refresh, crawls the portal again
+            print(f"The crawl in {self.journal.path} is complete, starting a new crawl")
+            self.journal.reset()
+            return False
+        self.visited = set(state.tasks)
+        self.results = dict(state.results)
+        pending = state.pending
+        print(f"Resuming crawl: {len(state.done)} pages done, {len(pending)} pending "
+              f"({len(state.failed)} of them failed before)")
+        for url, (order, kind) in sorted(pending.items(), key=lambda item: item[1][0]):
+            self._frontier.put_nowait(CrawlTask(order=order, url=url, kind=kind))
+        return True
+
+    async def crawl(self) -> Dict[str, str]:
+        """
+        Crawls the portal starting from `start_url`, or resumes the crawl recorded in the journal.
+
+        Returns:
+            Dict[str, str]: The scraped title to content mapping, as produced by `scraping_pipeline`.
+        """
+        self._frontier = asyncio.Queue()
+        resumed = self.journal is not None and self._resume()
+        if not resumed:
+            self._enqueue(self.start_url, (), 'main')
+        if self.output_path:
+            self._writer = open_record_writer(self.output_path, append=resumed)
+        connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=self.per_host_limit,
+                                         ttl_dns_cache=300)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            self._session = session
+            workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+            try:
+                await self._frontier.join()
+            finally:
+                for worker in workers:
+                    worker.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+                if self.journal is not None:
+                    await asyncio.to_thread(self.journal.close)
+                if self._writer is not None:
+                    self._writer.close()
+        complete_scraped_data = {}
+        for order in sorted(self.results):
+            complete_scraped_data.update(self.results[order])
+        return complete_scraped_data
+
+
+def async_scraping_pipeline(url: str = MAIN_URL, concurrency: int = 16, per_host_limit: int = 8,
+                            min_delay: float = 0.0, parser: str = None, cache_dir: str = None,
+                            changed_pages_path: str = None, journal_path: str = None,
+                            output_path: str = None) -> Dict[str, str]:
+    """
+    Concurrent counterpart of `scraping_pipeline`.
+
+    Args:
+        url (str): The URL to start scraping from. Default is 'https://u.ae/en/information-and-services'.
+        concurrency (int): The number of pages fetched at the same time. Default is 16.
+        per_host_limit (int): The maximum number of concurrent requests to one host. Default is 8.
+        min_delay (float): The minimum number of seconds between requests to one host. Default is 0.
+        parser (str): The BeautifulSoup parser backend. Default is `HTML_PARSER`.
+        cache_dir (str): The directory of the conditional-request cache, None disables it. Default is None.
+        changed_pages_path (str): Where to write the JSON list of new or changed pages for re-indexing.
+            Only used together with `cache_dir`. Default is None.
+        journal_path (str): The crawl journal. An existing journal is resumed, retrying only the pages
+            that were not scraped successfully. Default is None.
+        output_path (str): A .jsonl, .parquet or .csv file the records are streamed to while crawling,
+            with title, content, URL and crawl timestamp. Default is None.
+
+    Returns:
+        Dict[str, str]: A dictionary containing the complete scraped data.
+    """
+    crawler = AsyncCrawler(start_url=url, concurrency=concurrency, per_host_limit=per_host_limit,
+                           min_delay=min_delay, parser=parser, cache_dir=cache_dir, journal_path=journal_path,
+                           output_path=output_path)
+    scraped_data = asyncio.run(crawler.crawl())
+    if crawler.failed_pages:
+        print(f"{len(crawler.failed_pages)} pages failed" + (", rerun to retry them" if journal_path else ""))
+    if crawler.cache is not None:
+        print(f"{len(crawler.changed_pages)} pages changed, {len(crawler.unchanged_pages)} unchanged")
+        if changed_pages_path:
+            with open(changed_pages_path, 'w') as f:
+                json.dump({'changed': sorted(crawler.changed_pages),
+                           'unchanged': sorted(crawler.unchanged_pages)}, f, indent=2)
+            print(f"Changed pages written to {changed_pages_path}")
+    return scraped_data
@@ -0,0 +1,79 @@
+import argparse
+import os
+import time
+import pandas as pd
+import utils
+from utils import get_text_splitter, split_texts
+
+DATA_FILE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scrapped_data', 'scrapped_data_v23.csv')
+
+
+def load_contents(filepath: str):
+    """
+    Loads the content column of a scraped CSV file.
+
+    Args:
+        filepath (str): The path to the CSV file.
+
+    Returns:
+        List[str]: The non-empty contents.
+    """
+    df = pd.read_csv(filepath)
+    return [content for content in df['content'] if not pd.isna(content)]
+
+
+def benchmark_splitter(splitter: str, contents, repeat: int = 3):
+    """
+    Times one text splitter over all contents.
+
+    Args:
+        splitter (str): The splitter name accepted by `get_text_splitter`.
+        contents (List[str]): The documents to split.
+        repeat (int, optional): The number of timed runs, the best one is reported. Defaults to 3.
+
+    Returns:
+        dict: Timing, tokenizer calls and chunk statistics of the splitter.
+    """
+    calls = {'count': 0}
+    original_token_length = utils.token_length
+
+    def counting_token_length(text):
+        calls['count'] += 1
+        return original_token_length(text)
+
+    utils.token_length = counting_token_length
+    try:
+        text_splitter = get_text_splitter(splitter)
+        timings = []
+        for _ in range(repeat):
+            calls['count'] = 0
+            start = time.perf_counter()
+            chunks = [chunk for document_chunks in split_texts(text_splitter, contents) for chunk in document_chunks]
+            timings.append(time.perf_counter() - start)
+    finally:
+        utils.token_length = original_token_length
+    lengths = [original_token_length(chunk) for chunk in chunks]
+    return {
+        'splitter': splitter,
+        'seconds': min(timings),
+        'token_length_calls': calls['count'],
+        'chunks': len(chunks),
+        'mean_tokens': sum(lengths) / len(lengths) if lengths else 0,
+        'max_tokens': max(lengths, default=0),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare the recursive and single-pass token chunkers.")
+    parser.add_argument('--data-file', default=DATA_FILE_PATH)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    contents = load_contents(args.data_file)
+    print(f"{len(contents)} documents from {args.data_file}")
+    results = [benchmark_splitter(splitter, contents, args.repeat) for splitter in ('recursive', 'token')]
+    for result in results:
+        print(f"{result['splitter']:>10}: {result['seconds']:.3f}s | {result['chunks']} chunks | "
+              f"{result['token_length_calls']} token_length calls | "
+              f"mean {result['mean_tokens']:.0f} / max {result['max_tokens']} tokens per chunk")
+    print(f"speedup: {results[0]['seconds'] / results[1]['seconds']:.1f}x")
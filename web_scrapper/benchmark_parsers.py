@@ -0,0 +1,92 @@
+import argparse
+import os
+import time
+from dataclasses import dataclass
+from data_parsers import parse_page, parse_sub_category_links, parse_data
+from utils import ParsedPage, check_nested_categories, resolve_html_parser
+from fixture_server import FIXTURES_DIR
+from async_crawler import SPECIAL_CASE_PATH
+
+MAIN_PATH = '/en/information-and-services'
+
+
+@dataclass
+class SavedResponse:
+    """
+    A saved page standing in for `requests.Response`.
+    """
+    url: str
+    content: bytes
+    status_code: int = 200
+
+
+def load_fixtures(root: str = FIXTURES_DIR):
+    """
+    Loads every saved page below `root`.
+
+    Args:
+        root (str, optional): The directory holding the saved site. Defaults to `fixtures/site`.
+
+    Returns:
+        List[Tuple[SavedResponse, str]]: The pages with the kind `parse_page` expects for them.
+    """
+    pages = []
+    for directory, _, files in os.walk(root):
+        for file_name in sorted(files):
+            if not file_name.endswith('.html'):
+                continue
+            file_path = os.path.join(directory, file_name)
+            path = '/' + os.path.relpath(file_path, root)[:-len('.html')].replace(os.sep, '/')
+            kind = 'main' if path == MAIN_PATH else 'special' if path == SPECIAL_CASE_PATH else 'page'
+            with open(file_path, 'rb') as f:
+                pages.append((SavedResponse(url='https://u.ae' + path, content=f.read()), kind))
+    return sorted(pages, key=lambda page: page[0].url)
+
+
+def legacy_extract(response, kind: str):
+    """
+    Extracts a page the way the scraper did before `ParsedPage`: 'html.parser', parsing once per check.
+    """
+    if kind != 'page':
+        return parse_page(ParsedPage(response, 'html.parser'), kind)
+    if check_nested_categories(ParsedPage(response, 'html.parser')):
+        return None, parse_sub_category_links(ParsedPage(response, 'html.parser'))
+    return parse_data(ParsedPage(response, 'html.parser')), []
+
+
+def benchmark(extract, pages, repeat: int):
+    """
+    Times `extract` over all pages.
+
+    Returns:
+        Tuple[float, list]: The best time of `repeat` runs and the extracted output.
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = [extract(response, kind) for response, kind in pages]
+        timings.append(time.perf_counter() - start)
+    return min(timings), output
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare HTML parser backends on the saved u.ae pages.")
+    parser.add_argument('--root', default=FIXTURES_DIR)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--backends', nargs='+', default=['html.parser', 'lxml'])
+    args = parser.parse_args()
+
+    pages = load_fixtures(args.root)
+    print(f"{len(pages)} saved pages from {args.root}, best of {args.repeat} runs")
+    baseline_time, baseline_output = benchmark(legacy_extract, pages, args.repeat)
+    print(f"{'legacy (html.parser, parsed per check)':>40}: {baseline_time * 1000:8.1f} ms")
+    for backend in args.backends:
+        if resolve_html_parser(backend) != backend:
+            continue
+        elapsed, output = benchmark(lambda response, kind: parse_page(ParsedPage(response, backend), kind),
+                                    pages, args.repeat)
+        mismatches = [response.url for (response, _), expected, actual in zip(pages, baseline_output, output)
+                      if expected != actual]
+        status = 'identical output' if not mismatches else f"DIFFERENT output on {', '.join(mismatches)}"
+        print(f"{f'parse once ({backend})':>40}: {elapsed * 1000:8.1f} ms | "
+              f"{baseline_time / elapsed:4.1f}x | {status}")
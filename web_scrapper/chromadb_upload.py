@@ -1,33 +1,86 @@
+import argparse
+import json
+import os
 from typing import List
 import chromadb
-from utils import preprocess_data, batch_generator
+from utils import batch_generator, iter_preprocessed_records
 from embedding_func import CustomEmbeddingFunction
+from ingestion_pipeline import IngestionPipeline
+from near_dedup import NearDuplicateFilter
 
 
 DATA_FILE_PATH = './scrapped_data/scrapped_data_v2.csv'
 COLLECTION_NAME = 'info-services-index'
-CHROMADB_STORAGE_PATH = '/content/chroma'
+# The directory the backend reads its collections from
+CHROMADB_STORAGE_PATH = os.environ.get('CHROMADB_STORAGE_PATH', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'chromadb_data'))
+# The page-level index used by the hierarchical retrieval of the backend
+TITLES_COLLECTION_SUFFIX = '-titles'
+# Chunks at least this similar (Jaccard over 5-word shingles) to an earlier chunk are not indexed
+NEAR_DUPLICATE_THRESHOLD = 0.8
+NEAR_DUPLICATE_REPORT_PATH = './scrapped_data/near_duplicates.json'
+# Written by hnsw_sweep.py, see its --write-config option
+HNSW_CONFIG_PATH = os.path.join(CHROMADB_STORAGE_PATH, 'hnsw_config.json')
 
 
-def upload_to_chromadb(preprocessed_data: List, collection_name: str, chromadb_storage_path: str):
+def load_hnsw_config(config_path: str = HNSW_CONFIG_PATH):
     """
-    Uploads preprocessed data to ChromaDB, creating vector embeddings.
+    Loads the recommended HNSW index settings.
+
+    Args:
+        config_path (str, optional): The path to the config written by `hnsw_sweep.py`.
+
+    Returns:
+        dict: The collection metadata, e.g. {"hnsw:M": 32, "hnsw:construction_ef": 200, "hnsw:search_ef": 100},
+            or an empty dict if there is no config.
+    """
+    if not os.path.exists(config_path):
+        return {}
+    with open(config_path) as f:
+        return json.load(f)['metadata']
+
+
+def get_or_create_collection(collection_name: str, chromadb_storage_path: str, embedding_function=None,
+                             hnsw_config: dict = None):
+    """
+    Opens (or creates) the ChromaDB collection the scraped data is uploaded to.
+
+    The HNSW settings only take effect when the collection is created; an existing collection keeps
+    the settings it was built with.
 
     Args:
-        preprocessed_data (List): The preprocessed data to be uploaded.
         collection_name (str): The name of the collection in ChromaDB.
         chromadb_storage_path (str): The storage path for ChromaDB.
+        embedding_function (CustomEmbeddingFunction, optional): The embedding function of the collection.
+            A new one is created when omitted.
+        hnsw_config (dict, optional): HNSW collection metadata. Defaults to the config at `HNSW_CONFIG_PATH`, if any.
 
     Returns:
-        None
+        chromadb.Collection: The collection.
     """
     client = chromadb.PersistentClient(path=chromadb_storage_path)
-    custom_embeddings = CustomEmbeddingFunction()
-    collection = client.get_or_create_collection(
+    custom_embeddings = embedding_function or CustomEmbeddingFunction()
+    hnsw_config = load_hnsw_config() if hnsw_config is None else hnsw_config
+    return client.get_or_create_collection(
         name=collection_name,
         embedding_function=custom_embeddings,
-        metadata={"hnsw:space": "cosine", 'dimension': 768}  # l2 is the default
+        metadata={"hnsw:space": "cosine", 'dimension': 768, **hnsw_config}  # l2 is the default
     )
+
+
+def upload_to_chromadb(preprocessed_data: List, collection_name: str, chromadb_storage_path: str):
+    """
+    Uploads preprocessed data to ChromaDB, creating vector embeddings.
+
+    Args:
+        preprocessed_data (List): The preprocessed data to be uploaded.
+        collection_name (str): The name of the collection in ChromaDB.
+        chromadb_storage_path (str): The storage path for ChromaDB.
+
+    Returns:
+        None
+    """
+    collection = get_or_create_collection(collection_name, chromadb_storage_path)
     counter = 0
     batch_generator_obj = batch_generator(array=preprocessed_data, batch_size=64)
     for batch in batch_generator_obj:
@@ -37,8 +90,107 @@ def upload_to_chromadb(preprocessed_data: List, collection_name: str, chromadb_s
         )
         counter += len(batch)
     print("successfully created vector embeddings and uploaded to chromadb")
+
+
+def build_title_index(titles: dict, collection_name: str, chromadb_storage_path: str, embedding_function=None,
+                      batch_size: int = 64):
+    """
+    (Re)builds the page-level index: one entry per page title, which the hierarchical retrieval searches
+    before ranking the chunks of the best pages.
+
+    Args:
+        titles (dict): The number of chunks of every page title.
+        collection_name (str): The name of the chunk collection; the title index is stored next to it
+            with the `TITLES_COLLECTION_SUFFIX` suffix.
+        chromadb_storage_path (str): The storage path for ChromaDB.
+        embedding_function (CustomEmbeddingFunction, optional): The embedding function. A new one is created when omitted.
+        batch_size (int, optional): The number of titles embedded per call. Defaults to 64.
+
+    Returns:
+        chromadb.Collection: The title index.
+    """
+    client = chromadb.PersistentClient(path=chromadb_storage_path)
+    name = collection_name + TITLES_COLLECTION_SUFFIX
+    try:
+        client.delete_collection(name)
+    except ValueError:
+        pass  # Not built yet
+    collection = client.create_collection(
+        name=name,
+        embedding_function=embedding_function or CustomEmbeddingFunction(),
+        metadata={"hnsw:space": "cosine"}
+    )
+    counter = 0
+    for batch in batch_generator(array=list(titles.items()), batch_size=batch_size):
+        collection.add(
+            documents=[title for title, _ in batch],
+            metadatas=[{'title': title, 'chunks': chunks} for title, chunks in batch],
+            ids=[f"title{idx}" for idx in range(counter, counter + len(batch))]
+        )
+        counter += len(batch)
+    print(f"indexed {counter} page titles in {name}")
+    return collection
+
+
+def ingest_to_chromadb(data_file_path: str, collection_name: str, chromadb_storage_path: str,
+                       batch_size: int = 64, queue_size: int = 4, title_index: bool = True,
+                       dedup_threshold: float = NEAR_DUPLICATE_THRESHOLD,
+                       dedup_report_path: str = NEAR_DUPLICATE_REPORT_PATH, embedding_model: str = None):
+    """
+    Streams a scraped CSV file into ChromaDB with the chunk, tokenize, embed and write stages running concurrently.
+
+    Unlike `upload_to_chromadb`, the preprocessed data is never held in memory as a whole. Every chunk
+    stores the title of its page in its metadata, so that a search can be restricted to some pages.
+
+    Args:
+        data_file_path (str): The path to the scraped CSV file.
+        collection_name (str): The name of the collection in ChromaDB.
+        chromadb_storage_path (str): The storage path for ChromaDB.
+        batch_size (int, optional): The number of chunks per batch. Defaults to 64.
+        queue_size (int, optional): The number of batches buffered between two stages. Defaults to 4.
+        title_index (bool, optional): Also build the page-level index, see `build_title_index`. Defaults to True.
+        dedup_threshold (float, optional): Chunks this similar to an earlier chunk are dropped, see
+            `NearDuplicateFilter`. None to only drop exact duplicates. Defaults to `NEAR_DUPLICATE_THRESHOLD`.
+        dedup_report_path (str, optional): Where the report of the dropped near duplicates is written.
+            Defaults to `NEAR_DUPLICATE_REPORT_PATH`; None to skip it.
+        embedding_model (str, optional): The embedding model of the collection, e.g. a multilingual one for a
+            shard of the Arabic portal. It must match the shard's `embedding_model` in the backend's
+            chromadb_data/shards.json. Defaults to the model of `CustomEmbeddingFunction`.
+
+    Returns:
+        List[dict]: The throughput report of every stage.
+    """
+    custom_embeddings = CustomEmbeddingFunction(model_name=embedding_model) if embedding_model else CustomEmbeddingFunction()
+    collection = get_or_create_collection(collection_name, chromadb_storage_path, custom_embeddings)
+    pipeline = IngestionPipeline(custom_embeddings, collection, batch_size=batch_size, queue_size=queue_size)
+    titles = {}
+
+    def with_page_metadata(records):
+        for title, document in records:
+            titles[title] = titles.get(title, 0) + 1
+            yield document, {'title': title}
+
+    near_dedup = NearDuplicateFilter(dedup_threshold) if dedup_threshold else None
+    report = pipeline.run(with_page_metadata(iter_preprocessed_records(data_file_path, near_dedup=near_dedup)))
+    print("successfully created vector embeddings and uploaded to chromadb")
+    if near_dedup is not None:
+        print(f"dropped {len(near_dedup.merges)} of {near_dedup.seen} chunks as near duplicates")
+        if dedup_report_path:
+            near_dedup.write_report(dedup_report_path)
+    if title_index:
+        build_title_index(titles, collection_name, chromadb_storage_path, custom_embeddings)
+    return report
     
      
 if __name__ == "__main__":
-    preprocessed_data = preprocess_data(DATA_FILE_PATH)
-    upload_to_chromadb(preprocessed_data=preprocessed_data,collection_name=COLLECTION_NAME,chromadb_storage_path=CHROMADB_STORAGE_PATH)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Chunk, embed and upload scraped data to ChromaDB.")
+    parser.add_argument('--data-file', default=DATA_FILE_PATH)
+    parser.add_argument('--collection', default=COLLECTION_NAME)
+    parser.add_argument('--storage-path', default=CHROMADB_STORAGE_PATH)
+    parser.add_argument('--embedding-model', default=None)
+    parser.add_argument('--dedup-threshold', type=float, default=NEAR_DUPLICATE_THRESHOLD,
+                        help="0 to only drop exact duplicates")
+    args = parser.parse_args()
+    ingest_to_chromadb(data_file_path=args.data_file, collection_name=args.collection,
+                       chromadb_storage_path=args.storage_path, dedup_threshold=args.dedup_threshold or None,
+                       embedding_model=args.embedding_model)
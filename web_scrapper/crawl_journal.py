@@ -0,0 +1,221 @@
+import asyncio
+import json
+import os
+import threading
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Set, Tuple
+
+
+@dataclass
+class CrawlState:
+    """
+    The crawl progress recovered from a journal.
+
+    Attributes:
+        tasks (Dict[str, Tuple[Tuple[int, ...], str]]): Every URL added to the frontier with its order and kind.
+        done (Set[str]): The URLs fetched and parsed successfully.
+        failed (Dict[str, int]): The URLs whose last attempt failed, with the status code.
+        results (Dict[Tuple[int, ...], Dict[str, str]]): The parsed data of every successful content page.
+    """
+    tasks: Dict[str, Tuple[Tuple[int, ...], str]] = field(default_factory=dict)
+    done: Set[str] = field(default_factory=set)
+    failed: Dict[str, int] = field(default_factory=dict)
+    results: Dict[Tuple[int, ...], Dict[str, str]] = field(default_factory=dict)
+
+    @property
+    def pending(self):
+        """
+        The frontier: URLs enqueued but not successfully processed, including failed ones.
+        """
+        return {url: task for url, task in self.tasks.items() if url not in self.done}
+
+    def apply(self, event: dict):
+        """
+        Applies one journal event. Events are idempotent, so replaying a journal twice is harmless.
+
+        Args:
+            event (dict): The event, see `CrawlJournal`.
+        """
+        op = event['op']
+        if op == 'enqueue':
+            self.tasks.setdefault(event['url'], (tuple(event['order']), event['kind']))
+        elif op == 'done':
+            self.done.add(event['url'])
+            self.failed.pop(event['url'], None)
+            if event.get('data'):
+                self.results[tuple(event['order'])] = event['data']
+        elif op == 'failed':
+            self.failed[event['url']] = event['status']
+
+
+class CrawlJournal:
+    """
+    Append-only journal that makes a crawl resumable.
+
+    Every frontier addition, successful page and failure is appended to `path` as one JSON line and
+    flushed immediately. Every `compact_every` events the state is folded into `<path>.snapshot`
+    (written atomically) and the journal is truncated, so recovery never replays more than
+    `compact_every` events. The journal is moved aside to `<path>.prev` first and deleted once the
+    snapshot is on disk, so the slow write can run in a thread while new events are appended.
+
+    Events:
+        {"op": "enqueue", "url": ..., "order": [...], "kind": ...}
+        {"op": "done", "url": ..., "order": [...], "data": {...} | null}
+        {"op": "failed", "url": ..., "status": ...}
+
+    Attributes:
+        path (str): The journal file.
+        compact_every (int): The number of events between two compactions.
+        state (CrawlState): The current crawl state.
+    """
+    def __init__(self, path: str, compact_every: int = 500):
+        self.path = path
+        self.snapshot_path = path + '.snapshot'
+        self.previous_path = path + '.prev'
+        self.compact_every = compact_every
+        self.state = CrawlState()
+        self._events_since_compaction = 0
+        self._compacting = False
+        self._snapshot_lock = threading.RLock()
+        self._file = None
+
+    def load(self) -> CrawlState:
+        """
+        Recovers the state from the snapshot and the journal, and opens the journal for appending.
+
+        A truncated last line, left by a crash in the middle of a write, is ignored.
+
+        Returns:
+            CrawlState: The recovered state, empty for a new crawl.
+        """
+        self.state = CrawlState()
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'r') as f:
+                snapshot = json.load(f)
+            for url, order, kind in snapshot['tasks']:
+                self.state.tasks[url] = (tuple(order), kind)
+            self.state.done = set(snapshot['done'])
+            self.state.failed = dict(snapshot['failed'])
+            self.state.results = {tuple(order): data for order, data in snapshot['results']}
+        # The journal moved aside by a compaction that did not finish is older than the current one
+        interrupted = os.path.exists(self.previous_path)
+        for path in (self.previous_path, self.path):
+            if os.path.exists(path):
+                with open(path, 'r') as f:
+                    for line in f:
+                        try:
+                            event = json.loads(line)
+                        except ValueError:
+                            continue
+                        self.state.apply(event)
+                        self._events_since_compaction += 1
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        self._file = open(self.path, 'a')
+        if interrupted:
+            self.compact()
+        return self.state
+
+    def reset(self):
+        """
+        Discards the recorded crawl, so that the next crawl starts from scratch.
+        """
+        if self._file is not None:
+            self._file.close()
+        for path in (self.snapshot_path, self.previous_path):
+            if os.path.exists(path):
+                os.remove(path)
+        self._file = open(self.path, 'w')
+        self.state = CrawlState()
+        self._events_since_compaction = 0
+
+    def record(self, event: dict):
+        """
+        Appends an event to the journal and applies it to `state`.
+
+        Args:
+            event (dict): The event.
+        """
+        self.state.apply(event)
+        self._file.write(json.dumps(event) + '\n')
+        self._file.flush()
+        self._events_since_compaction += 1
+
+    def enqueued(self, url: str, order: Tuple[int, ...], kind: str):
+        """
+        Records that a URL was added to the frontier.
+        """
+        self.record({'op': 'enqueue', 'url': url, 'order': list(order), 'kind': kind})
+
+    def succeeded(self, url: str, order: Tuple[int, ...], data: Optional[Dict[str, str]]):
+        """
+        Records that a URL was fetched and parsed, with the parsed data of a content page.
+        """
+        self.record({'op': 'done', 'url': url, 'order': list(order), 'data': data})
+
+    def failed(self, url: str, status: int):
+        """
+        Records that fetching or parsing a URL failed; it is retried when the crawl is resumed.
+        """
+        self.record({'op': 'failed', 'url': url, 'status': status})
+
+    @property
+    def compaction_due(self) -> bool:
+        return self._events_since_compaction >= self.compact_every and not self._compacting
+
+    def _begin_compaction(self) -> dict:
+        """
+        Captures the state and moves the journal aside. Fast, so that it can run on the event loop.
+        """
+        self._compacting = True
+        snapshot = {
+            'tasks': [[url, list(order), kind] for url, (order, kind) in self.state.tasks.items()],
+            'done': sorted(self.state.done),
+            'failed': dict(self.state.failed),
+            'results': [[list(order), data] for order, data in self.state.results.items()],
+        }
+        self._file.close()
+        os.replace(self.path, self.previous_path)
+        self._file = open(self.path, 'w')
+        self._events_since_compaction = 0
+        return snapshot
+
+    def _write_snapshot(self, snapshot: dict):
+        """
+        Writes and syncs the snapshot, then drops the journal it replaces. Slow, run it in a thread.
+        """
+        with self._snapshot_lock:
+            try:
+                tmp_path = self.snapshot_path + '.tmp'
+                with open(tmp_path, 'w') as f:
+                    json.dump(snapshot, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.snapshot_path)
+                # A crash before this only means the moved journal is replayed on top of the snapshot again
+                os.remove(self.previous_path)
+            finally:
+                self._compacting = False
+
+    def compact(self):
+        """
+        Folds the journal into the snapshot and truncates it, after any compaction still running in a thread.
+        """
+        with self._snapshot_lock:
+            self._write_snapshot(self._begin_compaction())
+
+    async def compact_if_due(self):
+        """
+        Compacts once `compact_every` events were recorded, syncing the snapshot off the event loop.
+        """
+        if self.compaction_due:
+            await asyncio.to_thread(self._write_snapshot, self._begin_compaction())
+
+    def close(self):
+        """
+        Compacts the journal and closes it.
+        """
+        if self._file is not None:
+            self.compact()
+            self._file.close()
+            self._file = None
@@ -1,5 +1,5 @@
-from bs4 import BeautifulSoup
-from utils import ordered_set, combine_result
+from urllib.parse import urljoin
+from utils import ordered_set, combine_result, as_page, check_nested_categories
 
 def parse_nested_text(tag):
     """
@@ -59,13 +59,13 @@ def parse_goverment_services(response):
     Parses government services from the given HTTP response.
 
     Args:
-        response (requests.Response): The HTTP response object.
+        response (requests.Response | ParsedPage): The HTTP response object.
 
     Returns:
         List[Dict[str, str]]: A list of dictionaries containing the parsed government services.
     """
     parsed_data = []
-    soup = BeautifulSoup(response.content, 'html.parser')  
+    soup = as_page(response).soup
     # Parse providing entities
     divs = soup.find_all('div', id='entities')
     for div in divs:
@@ -93,14 +93,14 @@ def parse_data(response):
     Parses data from the given HTTP response.
 
     Args:
-        response (requests.Response): The HTTP response object.
+        response (requests.Response | ParsedPage): The HTTP response object.
 
     Returns:
         List[Dict[str, str]]: A list of dictionaries containing the parsed data.
     """
     scraped_data = []
     # Parse the webpage content
-    soup = BeautifulSoup(response.content, 'html.parser')
+    soup = as_page(response).soup
     qa_divs = soup.find_all('div', class_='child-tab-container')
     # Iterate through each div
     for qa_div in qa_divs:
@@ -112,4 +112,62 @@ def parse_data(response):
         content_outer_div = soup.find('div', class_='row list-content-page')
         content_div = content_outer_div.find('div', class_='col-md-12')
         scraped_data = parse_title_and_content(content_div, section_title=heading)
-    return combine_result(scraped_data)
\ No newline at end of file
+    return combine_result(scraped_data)
+
+def parse_category_links(response):
+    """
+    Parses the category links of the main information and services page.
+
+    Args:
+        response (requests.Response | ParsedPage): The HTTP response object.
+
+    Returns:
+        List[str]: The absolute URLs of the categories.
+    """
+    page = as_page(response)
+    category_section = page.soup.find('div', class_='row ui-filter-items row-flex')
+    if category_section is None:
+        return []
+    return [urljoin(page.url, link.get('href')) for link in category_section.findAll('a') if link.get('href')]
+
+def parse_sub_category_links(response):
+    """
+    Parses the sub-category links of a nested category page.
+
+    Args:
+        response (requests.Response | ParsedPage): The HTTP response object.
+
+    Returns:
+        List[str]: The absolute URLs of the sub-categories.
+    """
+    page = as_page(response)
+    links = []
+    for sub_category_div in page.soup.find_all('div', class_='col-md-3'):
+        sub_category_link = sub_category_div.find('a')
+        if sub_category_link is None or not sub_category_link.get('href'):
+            print(f"Incorrect sub-category link on {page.url}")
+            continue
+        links.append(urljoin(page.url, sub_category_link.get('href')))
+    return links
+
+def parse_page(response, kind: str = 'page'):
+    """
+    Parses any page of the portal, reusing a single parsed document for every check and parser.
+
+    Args:
+        response (requests.Response | ParsedPage): The HTTP response object.
+        kind (str, optional): 'main' for the information and services page, 'special' for the top
+            government services page, 'page' for category and content pages. Defaults to 'page'.
+
+    Returns:
+        Tuple[Optional[Dict[str, str]], List[str]]: The parsed data of a content page, and the links
+        to follow from a category page.
+    """
+    page = as_page(response)
+    if kind == 'special':
+        return parse_goverment_services(page), []
+    if kind == 'main':
+        return None, parse_category_links(page)
+    if check_nested_categories(page):
+        return None, parse_sub_category_links(page)
+    return parse_data(page), []
@@ -1,28 +1,32 @@
+import argparse
 from typing import List, Dict
 import requests
-from bs4 import BeautifulSoup
 from data_parsers import parse_data, parse_goverment_services
-from utils import check_nested_categories, convert_dict_to_list, save_to_csv
+from utils import check_nested_categories, convert_dict_to_list, save_to_csv, as_page
+from async_crawler import async_scraping_pipeline
+from record_store import export_csv
 
 MAIN_URL = 'https://u.ae/en/information-and-services'
 DATA_FILE_PATH = 'scrapped_data/scrapped_data_v2.csv'
 
-def scrape_website(response, visited_pages: List[str]):
+def scrape_website(response, visited_pages: List[str], parser: str = None):
     """
     Recursively scrapes a website for data, handling nested categories.
 
     Args:
-        response (requests.Response): The HTTP response object from the initial request.
+        response (requests.Response | ParsedPage): The HTTP response object from the initial request.
         visited_pages (List[str]): A list of URLs that have already been visited to avoid duplication.
+        parser (str, optional): The BeautifulSoup parser backend, see `resolve_html_parser`.
 
     Returns:
         Tuple[Dict[str, str], List[str]]: A tuple containing the scraped data and the updated list of visited pages.
     """
     scraped_data = {}
-    is_nested = check_nested_categories(response)
+    page = as_page(response, parser)
+    is_nested = check_nested_categories(page)
     if not is_nested:
-        return parse_data(response), visited_pages
-    soup = BeautifulSoup(response.content, 'html.parser')
+        return parse_data(page), visited_pages
+    soup = page.soup
     sub_category_divs = soup.find_all('div', class_='col-md-3')
     for sub_category_div in sub_category_divs:
         sub_category_link = sub_category_div.find('a')
@@ -36,12 +40,12 @@ def scrape_website(response, visited_pages: List[str]):
             continue
         visited_pages.append(complete_sub_category_link)
         print(f"Fetching contents of webpage: {complete_sub_category_link}")
-        sub_category_response = requests.get(complete_sub_category_link)
+        sub_category_response = as_page(requests.get(complete_sub_category_link), parser)
         if sub_category_response.status_code == 200:
             is_nested = check_nested_categories(sub_category_response)
             if is_nested:
                 # Recursively scrape nested categories
-                scraped_result, visited_pages = scrape_website(sub_category_response, visited_pages=visited_pages)
+                scraped_result, visited_pages = scrape_website(sub_category_response, visited_pages=visited_pages, parser=parser)
                 scraped_data.update(scraped_result)
             else:
                 try:
@@ -52,16 +56,17 @@ def scrape_website(response, visited_pages: List[str]):
                     continue
         else:
             print(f"Failed to retrieve the webpage. Status code: {sub_category_response.status_code}")
-            return scraped_data, visited_pages
+            continue
     return scraped_data, visited_pages
 
 
-def scraping_pipeline(url: str = 'https://u.ae/en/information-and-services') -> Dict[str, str]:
+def scraping_pipeline(url: str = 'https://u.ae/en/information-and-services', parser: str = None) -> Dict[str, str]:
     """
     Main pipeline to scrape data from the specified URL.
 
     Args:
         url (str): The URL to start scraping from. Default is 'https://u.ae/en/information-and-services'.
+        parser (str, optional): The BeautifulSoup parser backend, see `resolve_html_parser`.
 
     Returns:
         Dict[str, str]: A dictionary containing the complete scraped data.
@@ -72,7 +77,7 @@ def scraping_pipeline(url: str = 'https://u.ae/en/information-and-services') ->
     main_page_response = requests.get(url)
     if main_page_response.status_code == 200:
         visited_pages.append(url)
-        main_soup = BeautifulSoup(main_page_response.content, 'html.parser')
+        main_soup = as_page(main_page_response, parser).soup
         category_section = main_soup.find('div', class_='row ui-filter-items row-flex')
         category_links = category_section.findAll('a')
         for category_link in category_links:
@@ -86,11 +91,11 @@ def scraping_pipeline(url: str = 'https://u.ae/en/information-and-services') ->
                 visited_pages.append(complete_category_link)
                 if complete_category_link == special_case:
                     # Handle special case for top government services
-                    scrapped_data = parse_goverment_services(category_response)
+                    scrapped_data = parse_goverment_services(as_page(category_response, parser))
                     complete_scraped_data.update(scrapped_data)
                 else:
                     # Scrape data from the category page
-                    scrapped_data, visited_pages = scrape_website(category_response, visited_pages=visited_pages)
+                    scrapped_data, visited_pages = scrape_website(category_response, visited_pages=visited_pages, parser=parser)
                     complete_scraped_data.update(scrapped_data)
             else:
                 print(f"Failed to retrieve the webpage. Status code: {category_response.status_code}")
@@ -101,6 +106,41 @@ def scraping_pipeline(url: str = 'https://u.ae/en/information-and-services') ->
     
 
 if __name__ == '__main__':
-    main_data = scraping_pipeline(url=MAIN_URL)
-    converted_data = convert_dict_to_list(main_data)
-    save_to_csv(data=converted_data, filename=DATA_FILE_PATH)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Scrape the u.ae information and services portal.")
+    parser.add_argument('--url', default=MAIN_URL)
+    parser.add_argument('--output', default=DATA_FILE_PATH,
+                        help="a .csv file is written at the end; .jsonl or .parquet records are streamed while crawling")
+    parser.add_argument('--export-csv', default=None, help="also export streamed .jsonl/.parquet records to this CSV file")
+    parser.add_argument('--mode', choices=['async', 'sync'], default='async',
+                        help="'async' crawls concurrently, 'sync' uses the original sequential scraper")
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--per-host-limit', type=int, default=8)
+    parser.add_argument('--min-delay', type=float, default=0.0, help="seconds between requests to the same host")
+    parser.add_argument('--html-parser', default=None, help="BeautifulSoup backend, e.g. 'lxml' or 'html.parser'")
+    parser.add_argument('--cache-dir', default=None, help="cache pages on disk and re-crawl with conditional requests")
+    parser.add_argument('--changed-pages-output', default=None, help="JSON file listing the pages that changed")
+    parser.add_argument('--journal', default=None, help="checkpoint the crawl to this file and resume from it")
+    args = parser.parse_args()
+    stream_records = not args.output.endswith('.csv')
+    if args.journal and args.output.endswith('.parquet'):
+        parser.error("a resumed crawl appends to --output, which Parquet does not support; use a .jsonl output with --journal")
+    if args.mode == 'async':
+        main_data = async_scraping_pipeline(url=args.url, concurrency=args.concurrency,
+                                            per_host_limit=args.per_host_limit, min_delay=args.min_delay,
+                                            parser=args.html_parser, cache_dir=args.cache_dir,
+                                            changed_pages_path=args.changed_pages_output,
+                                            journal_path=args.journal,
+                                            output_path=args.output if stream_records else None)
+    elif stream_records:
+        parser.error("streaming .jsonl/.parquet output needs --mode async")
+    elif args.cache_dir or args.changed_pages_output or args.journal:
+        parser.error("--cache-dir, --changed-pages-output and --journal need --mode async")
+    else:
+        main_data = scraping_pipeline(url=args.url, parser=args.html_parser)
+    if stream_records:
+        print(f'Data written to {args.output}')
+        if args.export_csv:
+            export_csv(args.output, args.export_csv)
+    else:
+        converted_data = convert_dict_to_list(main_data)
+        save_to_csv(data=converted_data, filename=args.output)
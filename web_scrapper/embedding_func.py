@@ -61,20 +61,42 @@ class CustomEmbeddingFunction(EmbeddingFunction[Documents]):
         embeddings= F.normalize(vector, p=2, dim=1)
         return embeddings.detach().cpu().numpy().tolist()
 
-    def __call__(self, input: Documents) -> Embeddings:
+    def tokenize(self, input: Documents):
         """
-        Generates embeddings for the given input documents.
+        Tokenizes the given input documents into padded model inputs kept on the CPU.
 
         Args:
-            input (Documents): The input documents to generate embeddings for.
+            input (Documents): The input documents to tokenize.
+
+        Returns:
+            transformers.BatchEncoding: The tokenized documents.
+        """
+        return self._tokenizer(input, padding=True, truncation=True, return_tensors="pt")
+
+    def embed_tokens(self, inputs) -> Embeddings:
+        """
+        Runs the model forward pass on already tokenized documents.
+
+        Args:
+            inputs (transformers.BatchEncoding): The output of `tokenize`.
 
         Returns:
             Embeddings: The generated embeddings.
         """
-        inputs = self._tokenizer(
-            input, padding=True, truncation=True, return_tensors="pt"
-        ).to(self._device)
+        inputs = inputs.to(self._device)
         with self._torch.no_grad():
             outputs = self._model(**inputs)
         embeddings = outputs.last_hidden_state[:, 0]
-        return self._normalize(embeddings)
\ No newline at end of file
+        return self._normalize(embeddings)
+
+    def __call__(self, input: Documents) -> Embeddings:
+        """
+        Generates embeddings for the given input documents.
+
+        Args:
+            input (Documents): The input documents to generate embeddings for.
+
+        Returns:
+            Embeddings: The generated embeddings.
+        """
+        return self.embed_tokens(self.tokenize(input))
\ No newline at end of file
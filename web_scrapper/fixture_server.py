@@ -0,0 +1,100 @@
+import argparse
+import hashlib
+import os
+import threading
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'site')
+
+
+class FixtureRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves saved u.ae pages, mapping the request path `/en/a/b` to the file `<root>/en/a/b.html`.
+
+    Responses carry an ETag and a Last-Modified header and conditional requests are answered with 304.
+    """
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real portal
+    root = FIXTURES_DIR
+
+    def _resolve(self):
+        path = self.path.split('?', 1)[0].rstrip('/')
+        file_path = os.path.normpath(os.path.join(self.root, path.lstrip('/') + '.html'))
+        if not file_path.startswith(os.path.normpath(self.root) + os.sep) or not os.path.isfile(file_path):
+            return None
+        return file_path
+
+    def _send(self, status: int, body: bytes = b'', headers: dict = None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body and self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_GET(self):
+        file_path = self._resolve()
+        if file_path is None:
+            self._send(404, b'Not Found', {'Content-Type': 'text/plain'})
+            return
+        with open(file_path, 'rb') as f:
+            body = f.read()
+        mtime = int(os.path.getmtime(file_path))
+        headers = {
+            'ETag': '"{}"'.format(hashlib.sha1(body).hexdigest()),
+            'Last-Modified': formatdate(mtime, usegmt=True),
+        }
+        if self._not_modified(headers['ETag'], mtime):
+            self._send(304, headers=headers)
+            return
+        self._send(200, body, dict(headers, **{'Content-Type': 'text/html; charset=utf-8'}))
+
+    def _not_modified(self, etag: str, mtime: int) -> bool:
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            return etag in [tag.strip() for tag in if_none_match.split(',')]
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since:
+            try:
+                return mtime <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    do_HEAD = do_GET
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_fixtures(root: str = FIXTURES_DIR, host: str = '127.0.0.1', port: int = 0):
+    """
+    Starts a local HTTP server for the saved pages in a background thread.
+
+    Args:
+        root (str, optional): The directory holding the saved site. Defaults to `fixtures/site`.
+        host (str, optional): The interface to bind. Defaults to '127.0.0.1'.
+        port (int, optional): The port to bind, 0 picks a free one. Defaults to 0.
+
+    Returns:
+        Tuple[ThreadingHTTPServer, str]: The running server (call `shutdown()` to stop it) and its base URL.
+    """
+    handler = type('BoundFixtureRequestHandler', (FixtureRequestHandler,), {'root': root})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve the saved u.ae pages for offline crawls.")
+    parser.add_argument('--root', default=FIXTURES_DIR)
+    parser.add_argument('--port', type=int, default=8008)
+    args = parser.parse_args()
+    server, base_url = serve_fixtures(root=args.root, port=args.port)
+    print(f"Serving {args.root} at {base_url}/en/information-and-services")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,205 @@
+import argparse
+import itertools
+import json
+import os
+import shutil
+import time
+import numpy as np
+import chromadb
+import hnswlib  # Installed with chromadb as chroma-hnswlib
+from chromadb_upload import COLLECTION_NAME, HNSW_CONFIG_PATH
+
+SOURCE_STORAGE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'chromadb_data')
+WORK_DIR = os.path.join(SOURCE_STORAGE_PATH, 'hnsw_sweep')
+GRID = {'hnsw:M': [16, 32, 48], 'hnsw:construction_ef': [100, 200, 400], 'hnsw:search_ef': [10, 50, 100, 200]}
+
+
+def load_vectors(storage_path: str, collection_name: str, limit: int = None):
+    """
+    Loads the ids and stored embeddings of a collection, so that the sweep never re-embeds the corpus.
+
+    Args:
+        storage_path (str): The ChromaDB storage path.
+        collection_name (str): The name of the collection.
+        limit (int, optional): The maximum number of vectors loaded.
+
+    Returns:
+        Tuple[List[str], np.ndarray]: The ids and the embeddings, one row per id.
+    """
+    collection = chromadb.PersistentClient(path=storage_path).get_collection(collection_name)
+    records = collection.get(include=['embeddings'], limit=limit)
+    return records['ids'], np.asarray(records['embeddings'], dtype=np.float32)
+
+
+def embed_queries(queries_file: str):
+    """
+    Embeds one query per line with the embedding function of the upload.
+
+    Args:
+        queries_file (str): The path to the text file.
+
+    Returns:
+        np.ndarray: The query embeddings.
+    """
+    from embedding_func import CustomEmbeddingFunction
+    with open(queries_file) as f:
+        queries = [line.strip() for line in f if line.strip()]
+    return np.asarray(CustomEmbeddingFunction()(queries), dtype=np.float32)
+
+
+def exact_neighbours(vectors: np.ndarray, queries: np.ndarray, k: int):
+    """
+    Computes the exact cosine nearest neighbours by brute force.
+
+    Args:
+        vectors (np.ndarray): The corpus embeddings.
+        queries (np.ndarray): The query embeddings.
+        k (int): The number of neighbours.
+
+    Returns:
+        np.ndarray: The row indices of the k nearest vectors of every query, nearest first.
+    """
+    vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    similarities = queries @ vectors.T
+    top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(similarities, top, axis=1), axis=1)
+    return np.take_along_axis(top, order, axis=1)
+
+
+def directory_size(path: str):
+    """
+    Returns the size in bytes of all files below `path`.
+    """
+    return sum(os.path.getsize(os.path.join(directory, file_name))
+               for directory, _, files in os.walk(path) for file_name in files)
+
+
+def evaluate_build(m: int, construction_ef: int, search_efs, vectors: np.ndarray, queries: np.ndarray,
+                   truth: np.ndarray, k: int, work_dir: str):
+    """
+    Builds one HNSW index and measures its build time and size, then its recall and latency at every
+    `search_ef`. Only M and construction_ef shape the graph, so the index is built once per pair and
+    search_ef is changed in place.
+
+    The index is built with hnswlib, the library ChromaDB stores its collections in, because ChromaDB
+    fixes search_ef when it opens a collection. Latencies therefore leave out ChromaDB's own per-query
+    overhead, which is the same for every setting.
+
+    Args:
+        m (int): The hnsw:M of the index.
+        construction_ef (int): The hnsw:construction_ef of the index.
+        search_efs (List[int]): The hnsw:search_ef values measured.
+        vectors (np.ndarray): The corpus embeddings.
+        queries (np.ndarray): The query embeddings, not part of `vectors`.
+        truth (np.ndarray): The exact neighbours of every query, see `exact_neighbours`.
+        k (int): The number of results per query.
+        work_dir (str): The directory the index is saved to, to measure its size.
+
+    Returns:
+        List[dict]: Per search_ef, the configuration with 'build_seconds', 'disk_bytes', 'recall',
+            'p50_ms' and 'p95_ms'.
+    """
+    index = hnswlib.Index(space='cosine', dim=vectors.shape[1])
+    start = time.perf_counter()
+    index.init_index(max_elements=len(vectors), ef_construction=construction_ef, M=m)
+    index.add_items(vectors, np.arange(len(vectors)), num_threads=1)
+    build_seconds = time.perf_counter() - start
+    os.makedirs(work_dir, exist_ok=True)
+    index_path = os.path.join(work_dir, f"M{m}_construction_ef{construction_ef}.bin")
+    index.save_index(index_path)
+    disk_bytes = os.path.getsize(index_path)
+    os.remove(index_path)
+
+    results = []
+    for search_ef in search_efs:
+        index.set_ef(max(search_ef, k))
+        hits, latencies = 0, []
+        for query, expected in zip(queries, truth):
+            start = time.perf_counter()
+            labels, _ = index.knn_query(query, k=k, num_threads=1)
+            latencies.append((time.perf_counter() - start) * 1000)
+            hits += len(set(labels[0].tolist()) & set(expected.tolist()))
+        results.append({
+            'hnsw:M': m,
+            'hnsw:construction_ef': construction_ef,
+            'hnsw:search_ef': search_ef,
+            'build_seconds': round(build_seconds, 3),
+            'disk_bytes': disk_bytes,
+            'recall': round(hits / (len(queries) * k), 4),
+            'p50_ms': round(float(np.percentile(latencies, 50)), 3),
+            'p95_ms': round(float(np.percentile(latencies, 95)), 3),
+        })
+    return results
+
+
+def recommend(results, target_recall: float):
+    """
+    Picks the configuration with the lowest p95 latency among those reaching the target recall, or the
+    one with the highest recall if none does.
+
+    Args:
+        results (List[dict]): The results of `evaluate_build`.
+        target_recall (float): The minimum recall@k.
+
+    Returns:
+        dict: The recommended result.
+    """
+    good = [result for result in results if result['recall'] >= target_recall]
+    if good:
+        return min(good, key=lambda result: (result['p95_ms'], result['disk_bytes']))
+    return max(results, key=lambda result: (result['recall'], -result['p95_ms']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Sweep HNSW settings and measure recall@k against exact search.")
+    parser.add_argument('--storage-path', default=SOURCE_STORAGE_PATH)
+    parser.add_argument('--collection', default=COLLECTION_NAME)
+    parser.add_argument('--limit', type=int, default=None, help="Use at most this many vectors of the collection.")
+    parser.add_argument('--queries-file', default=None,
+                        help="Questions, one per line. By default stored vectors are held out of the index as queries.")
+    parser.add_argument('--num-queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--m', type=int, nargs='+', default=GRID['hnsw:M'])
+    parser.add_argument('--construction-ef', type=int, nargs='+', default=GRID['hnsw:construction_ef'])
+    parser.add_argument('--search-ef', type=int, nargs='+', default=GRID['hnsw:search_ef'])
+    parser.add_argument('--target-recall', type=float, default=0.95)
+    parser.add_argument('--work-dir', default=WORK_DIR)
+    parser.add_argument('--output', default=None, help="Write all results to this JSON file.")
+    parser.add_argument('--write-config', nargs='?', const=HNSW_CONFIG_PATH, default=None,
+                        help=f"Save the recommendation for the upload and the backend (default path: {HNSW_CONFIG_PATH}).")
+    args = parser.parse_args()
+
+    ids, vectors = load_vectors(args.storage_path, args.collection, args.limit)
+    if args.queries_file:
+        queries = embed_queries(args.queries_file)
+    else:
+        # Held out of the index: a query that is indexed finds itself first, which inflates recall
+        rng = np.random.default_rng(0)
+        held_out = np.zeros(len(vectors), dtype=bool)
+        held_out[rng.choice(len(vectors), size=min(args.num_queries, len(vectors) // 2), replace=False)] = True
+        queries, vectors = vectors[held_out], vectors[~held_out]
+        ids = [vector_id for vector_id, held in zip(ids, held_out) if not held]
+    truth = exact_neighbours(vectors, queries, args.k)
+    print(f"{len(ids)} vectors, {len(queries)} queries, recall@{args.k}")
+
+    results = []
+    for m, construction_ef in itertools.product(args.m, args.construction_ef):
+        for result in evaluate_build(m, construction_ef, args.search_ef, vectors, queries, truth, args.k, args.work_dir):
+            results.append(result)
+            print(f"M={m:>3} construction_ef={construction_ef:>4} search_ef={result['hnsw:search_ef']:>4}: "
+                  f"recall {result['recall']:.4f} | p50 {result['p50_ms']:.2f}ms | p95 {result['p95_ms']:.2f}ms | "
+                  f"build {result['build_seconds']:.1f}s | {result['disk_bytes'] / 2**20:.1f} MiB")
+    shutil.rmtree(args.work_dir, ignore_errors=True)
+
+    best = recommend(results, args.target_recall)
+    print(f"recommended: M={best['hnsw:M']} construction_ef={best['hnsw:construction_ef']} "
+          f"search_ef={best['hnsw:search_ef']} (recall {best['recall']:.4f}, p95 {best['p95_ms']:.2f}ms)")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'k': args.k, 'vectors': len(ids), 'queries': len(queries), 'results': results}, f, indent=2)
+    if args.write_config:
+        metadata = {key: best[key] for key in ('hnsw:M', 'hnsw:construction_ef', 'hnsw:search_ef')}
+        with open(args.write_config, 'w') as f:
+            json.dump({'metadata': metadata, 'benchmark': {'k': args.k, 'vectors': len(ids), **best}}, f, indent=2)
+        print(f"saved the HNSW config to {args.write_config}")
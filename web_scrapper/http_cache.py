@@ -0,0 +1,140 @@
+import hashlib
+import json
+import os
+import time
+from dataclasses import dataclass, asdict
+from typing import Dict, Optional
+
+
+@dataclass
+class CacheEntry:
+    """
+    The validators and bookkeeping stored for one cached URL.
+
+    Attributes:
+        url (str): The URL of the page.
+        etag (Optional[str]): The ETag header of the last 200 response.
+        last_modified (Optional[str]): The Last-Modified header of the last 200 response.
+        body_hash (str): The SHA-256 of the cached body.
+        fetched_at (float): When the body was last downloaded.
+        validated_at (float): When the server last confirmed the body, by a 200 or a 304.
+    """
+    url: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+    body_hash: str
+    fetched_at: float
+    validated_at: float
+
+
+class ResponseCache:
+    """
+    On-disk cache of page bodies and their HTTP validators, used for conditional re-crawls.
+
+    Every URL is stored as `<sha256(url)>.json` (the `CacheEntry`) next to `<sha256(url)>.body`.
+    Writes go through a temporary file and `os.replace`, so an interrupted crawl never leaves a
+    half-written entry behind.
+
+    Attributes:
+        cache_dir (str): The directory holding the cache.
+    """
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, url: str, suffix: str) -> str:
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key + suffix)
+
+    @staticmethod
+    def _write_atomic(path: str, data: bytes):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def get(self, url: str) -> Optional[CacheEntry]:
+        """
+        Looks up the cache entry of a URL.
+
+        Args:
+            url (str): The URL.
+
+        Returns:
+            Optional[CacheEntry]: The entry, or None if the URL is not cached or its body is missing.
+        """
+        meta_path = self._path(url, '.json')
+        if not os.path.exists(meta_path) or not os.path.exists(self._path(url, '.body')):
+            return None
+        try:
+            with open(meta_path, 'r') as f:
+                return CacheEntry(**json.load(f))
+        except (ValueError, TypeError):
+            return None
+
+    def conditional_headers(self, url: str) -> Dict[str, str]:
+        """
+        Builds the `If-None-Match`/`If-Modified-Since` headers for a URL.
+
+        Args:
+            url (str): The URL.
+
+        Returns:
+            Dict[str, str]: The headers, empty if the URL is not cached.
+        """
+        entry = self.get(url)
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+        return headers
+
+    def load_body(self, url: str) -> bytes:
+        """
+        Reads the cached body of a URL, e.g. after a 304 response.
+
+        Args:
+            url (str): The URL.
+
+        Returns:
+            bytes: The cached body.
+        """
+        with open(self._path(url, '.body'), 'rb') as f:
+            return f.read()
+
+    def mark_validated(self, url: str):
+        """
+        Records that the server confirmed the cached body of a URL is still current.
+
+        Args:
+            url (str): The URL.
+        """
+        entry = self.get(url)
+        if entry is not None:
+            entry.validated_at = time.time()
+            self._write_atomic(self._path(url, '.json'), json.dumps(asdict(entry)).encode('utf-8'))
+
+    def store(self, url: str, body: bytes, etag: Optional[str] = None, last_modified: Optional[str] = None) -> bool:
+        """
+        Stores a freshly downloaded body and its validators.
+
+        Args:
+            url (str): The URL.
+            body (bytes): The response body.
+            etag (Optional[str]): The ETag response header.
+            last_modified (Optional[str]): The Last-Modified response header.
+
+        Returns:
+            bool: True if the page is new or its body differs from the cached one.
+        """
+        previous = self.get(url)
+        body_hash = hashlib.sha256(body).hexdigest()
+        now = time.time()
+        entry = CacheEntry(url=url, etag=etag, last_modified=last_modified, body_hash=body_hash,
+                           fetched_at=now, validated_at=now)
+        if previous is None or previous.body_hash != body_hash:
+            self._write_atomic(self._path(url, '.body'), body)
+        self._write_atomic(self._path(url, '.json'), json.dumps(asdict(entry)).encode('utf-8'))
+        return previous is None or previous.body_hash != body_hash
@@ -0,0 +1,237 @@
+import queue
+import threading
+import time
+from typing import Callable, Iterable, List, Optional
+from utils import iter_batches
+
+_END_OF_STREAM = object()
+
+
+class StageStats:
+    """
+    Throughput counters for a single pipeline stage.
+
+    Attributes:
+        name (str): The name of the stage.
+        batches (int): The number of batches the stage has processed.
+        items (int): The number of items (chunks) the stage has processed.
+        busy_seconds (float): Time spent doing work, excluding time blocked on the queues.
+        started_at (Optional[float]): When the stage received its first batch.
+        finished_at (Optional[float]): When the stage saw the end of the stream.
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self.batches = 0
+        self.items = 0
+        self.busy_seconds = 0.0
+        self.started_at = None
+        self.finished_at = None
+
+    def record(self, items: int, seconds: float):
+        """
+        Records one processed batch.
+
+        Args:
+            items (int): The number of items in the batch.
+            seconds (float): The time spent processing the batch.
+        """
+        self.batches += 1
+        self.items += items
+        self.busy_seconds += seconds
+
+    def as_dict(self):
+        """
+        Summarises the counters.
+
+        Returns:
+            dict: Items, busy time, items/s while busy and utilisation of the stage.
+        """
+        wall = (self.finished_at or time.perf_counter()) - (self.started_at or time.perf_counter())
+        return {
+            'stage': self.name,
+            'batches': self.batches,
+            'items': self.items,
+            'busy_seconds': round(self.busy_seconds, 3),
+            'items_per_second': round(self.items / self.busy_seconds, 1) if self.busy_seconds else 0.0,
+            'utilisation': round(self.busy_seconds / wall, 3) if wall > 0 else 0.0,
+        }
+
+
+class _Stage(threading.Thread):
+    """
+    Worker thread that applies `func` to every batch taken from `inbox` and forwards the result to `outbox`.
+    """
+    def __init__(self, name: str, func: Callable, inbox: queue.Queue, outbox: Optional[queue.Queue],
+                 stop_event: threading.Event, count_items: Callable = len):
+        super().__init__(name=f"ingest-{name}", daemon=True)
+        self.func = func
+        self.inbox = inbox
+        self.outbox = outbox
+        self.stop_event = stop_event
+        self.count_items = count_items
+        self.stats = StageStats(name)
+        self.error = None
+
+    def _put(self, item):
+        # Poll so that a failure further down the pipeline cannot leave us blocked on a full queue
+        while not self.stop_event.is_set():
+            try:
+                self.outbox.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _get(self):
+        while not self.stop_event.is_set():
+            try:
+                return self.inbox.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _END_OF_STREAM
+
+    def run(self):
+        try:
+            while True:
+                batch = self._get()
+                if batch is _END_OF_STREAM:
+                    break
+                if self.stats.started_at is None:
+                    self.stats.started_at = time.perf_counter()
+                start = time.perf_counter()
+                result = self.func(batch)
+                self.stats.record(self.count_items(batch), time.perf_counter() - start)
+                if self.outbox is not None:
+                    self._put(result)
+        except Exception as e:
+            self.error = e
+            self.stop_event.set()
+        finally:
+            self.stats.finished_at = time.perf_counter()
+            if self.outbox is not None:
+                self._put(_END_OF_STREAM)
+
+
+class _SourceStage(_Stage):
+    """
+    Worker thread that pulls batches from an iterator, timing how long each one takes to produce.
+    """
+    def __init__(self, name: str, batches: Iterable, outbox: queue.Queue, stop_event: threading.Event):
+        super().__init__(name, None, None, outbox, stop_event)
+        self.batches = batches
+
+    def run(self):
+        try:
+            self.stats.started_at = time.perf_counter()
+            iterator = iter(self.batches)
+            while not self.stop_event.is_set():
+                start = time.perf_counter()
+                batch = next(iterator, _END_OF_STREAM)
+                if batch is _END_OF_STREAM:
+                    break
+                self.stats.record(len(batch), time.perf_counter() - start)
+                self._put(batch)
+        except Exception as e:
+            self.error = e
+            self.stop_event.set()
+        finally:
+            self.stats.finished_at = time.perf_counter()
+            self._put(_END_OF_STREAM)
+
+
+class IngestionPipeline:
+    """
+    Bounded-queue pipeline that overlaps chunking, tokenization, embedding and ChromaDB writes.
+
+    Every stage runs in its own thread and hands batches to the next one through a queue holding
+    at most `queue_size` batches, so a slow stage applies backpressure to the ones before it.
+    Memory is bounded by the queue sizes instead of the corpus size, and the wall time approaches
+    that of the slowest stage instead of the sum of all of them.
+
+    Attributes:
+        embedding_function (CustomEmbeddingFunction): Provides the `tokenize` and `embed_tokens` stages.
+        collection (chromadb.Collection): The collection the embeddings are written to.
+        batch_size (int): The number of chunks per batch.
+        queue_size (int): The maximum number of batches buffered between two stages.
+        report_interval (Optional[float]): Seconds between progress reports, or None to only report at the end.
+    """
+    def __init__(self, embedding_function, collection, batch_size: int = 64, queue_size: int = 4,
+                 report_interval: Optional[float] = 10.0, id_prefix: str = 'id'):
+        self.embedding_function = embedding_function
+        self.collection = collection
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.report_interval = report_interval
+        self.id_prefix = id_prefix
+        self._counter = 0
+
+    @staticmethod
+    def _split(batch: List):
+        # Items are either documents or (document, metadata) pairs
+        if batch and isinstance(batch[0], tuple):
+            documents, metadatas = zip(*batch)
+            return list(documents), list(metadatas)
+        return batch, None
+
+    def _tokenize(self, batch: List):
+        documents, metadatas = self._split(batch)
+        return documents, metadatas, self.embedding_function.tokenize(documents)
+
+    def _embed(self, batch):
+        documents, metadatas, encodings = batch
+        return documents, metadatas, self.embedding_function.embed_tokens(encodings)
+
+    def _write(self, batch):
+        documents, metadatas, embeddings = batch
+        self.collection.add(
+            documents=documents,
+            embeddings=embeddings,
+            metadatas=metadatas,
+            ids=[f"{self.id_prefix}{idx}" for idx in range(self._counter, self._counter + len(documents))]
+        )
+        self._counter += len(documents)
+
+    @staticmethod
+    def _first(batch):
+        return len(batch[0])
+
+    def _report(self, stages):
+        for stage in stages:
+            stats = stage.stats.as_dict()
+            print(f"[{stats['stage']:>8}] {stats['items']:>8} chunks | "
+                  f"{stats['items_per_second']:>8} chunks/s | utilisation {stats['utilisation']:.0%}")
+
+    def run(self, documents: Iterable[str]):
+        """
+        Runs the pipeline until `documents` is exhausted.
+
+        Args:
+            documents (Iterable): Preprocessed chunks, typically from `iter_preprocessed_data`, or
+                (chunk, metadata) pairs to store metadata with every chunk.
+
+        Returns:
+            List[dict]: The throughput report of every stage.
+
+        Raises:
+            Exception: The first error raised by any stage; the remaining stages are stopped.
+        """
+        stop_event = threading.Event()
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(3)]
+        stages = [
+            _SourceStage('chunk', iter_batches(documents, self.batch_size), queues[0], stop_event),
+            _Stage('tokenize', self._tokenize, queues[0], queues[1], stop_event),
+            _Stage('embed', self._embed, queues[1], queues[2], stop_event, count_items=self._first),
+            _Stage('write', self._write, queues[2], None, stop_event, count_items=self._first),
+        ]
+        for stage in stages:
+            stage.start()
+        while stages[-1].is_alive():
+            stages[-1].join(timeout=self.report_interval)
+            if stages[-1].is_alive():
+                self._report(stages)
+        for stage in stages:
+            stage.join()
+        for stage in stages:
+            if stage.error is not None:
+                raise stage.error
+        self._report(stages)
+        return [stage.stats.as_dict() for stage in stages]
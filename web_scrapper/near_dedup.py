@@ -0,0 +1,172 @@
+import argparse
+import json
+import re
+import zlib
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+
+# A Mersenne prime larger than any 32 bit shingle hash, so (a * x + b) mod p never overflows 64 bits
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+WORD_PATTERN = re.compile(r"\w+")
+
+
+def choose_bands(num_perm: int, threshold: float) -> Tuple[int, int]:
+    """
+    Picks the LSH banding whose S-curve crosses 1/2 closest to the similarity threshold.
+
+    Two signatures share a bucket in at least one of `bands` bands of `rows` rows with probability
+    1 - (1 - s^rows)^bands for a Jaccard similarity s, which rises steeply around (1 / bands)^(1 / rows).
+
+    Args:
+        num_perm (int): The number of MinHash permutations.
+        threshold (float): The Jaccard similarity above which chunks are near duplicates.
+
+    Returns:
+        Tuple[int, int]: The number of bands and of rows per band, with bands * rows <= num_perm.
+    """
+    candidates = [(bands, num_perm // bands) for bands in range(1, num_perm + 1)]
+    return min(candidates, key=lambda band: abs((1 / band[0]) ** (1 / band[1]) - threshold))
+
+
+def shingles(text: str, size: int = 5) -> List[str]:
+    """
+    Returns the lower-cased word n-grams of a text, or the whole text if it has fewer than `size` words.
+    """
+    words = WORD_PATTERN.findall(text.lower())
+    if len(words) <= size:
+        return [' '.join(words)] if words else []
+    return [' '.join(words[i:i + size]) for i in range(len(words) - size + 1)]
+
+
+class NearDuplicateFilter:
+    """
+    Detects near-duplicate chunks with MinHash signatures and LSH banding.
+
+    Every chunk kept is indexed in `bands` hash tables keyed by a slice of its signature; a new chunk is
+    only compared with the chunks sharing one of its buckets, so the cost grows linearly with the corpus
+    instead of quadratically. A chunk whose estimated Jaccard similarity with a kept chunk reaches the
+    threshold is dropped and recorded in `merges`.
+
+    Attributes:
+        threshold (float): The Jaccard similarity over word shingles above which a chunk is dropped.
+        num_perm (int): The number of MinHash permutations.
+        shingle_size (int): The number of words per shingle.
+        bands (int): The number of LSH bands.
+        rows (int): The number of signature rows per band.
+        merges (List[dict]): The dropped chunks with the chunk they duplicate and the estimated similarity.
+    """
+    def __init__(self, threshold: float = 0.8, num_perm: int = 128, shingle_size: int = 5, seed: int = 1,
+                 preview_chars: int = 160):
+        if not 0 < threshold <= 1:
+            raise ValueError("threshold must be in (0, 1]")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.bands, self.rows = choose_bands(num_perm, threshold)
+        self.preview_chars = preview_chars
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, 1 << 32, size=(num_perm, 1), dtype=np.uint64)
+        self._b = rng.integers(0, 1 << 32, size=(num_perm, 1), dtype=np.uint64)
+        self._buckets: List[Dict[bytes, List[int]]] = [defaultdict(list) for _ in range(self.bands)]
+        self._signatures: List[np.ndarray] = []
+        self._kept: List[Tuple[str, str]] = []
+        self.seen = 0
+        self.merges: List[dict] = []
+
+    def signature(self, text: str) -> Optional[np.ndarray]:
+        """
+        Computes the MinHash signature of a text, None if it has no words.
+        """
+        text_shingles = shingles(text, self.shingle_size)
+        if not text_shingles:
+            return None
+        hashes = np.fromiter((zlib.crc32(shingle.encode('utf-8')) for shingle in set(text_shingles)),
+                             dtype=np.uint64)
+        return ((self._a * hashes + self._b) % MERSENNE_PRIME).min(axis=1).astype(np.uint32)
+
+    def _band_keys(self, signature: np.ndarray) -> List[bytes]:
+        return [signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+
+    def is_duplicate(self, text: str, title: str = '') -> bool:
+        """
+        Checks a chunk against the chunks kept so far and keeps it if it is not a near duplicate.
+
+        Args:
+            text (str): The chunk.
+            title (str, optional): The title of its page, for the report.
+
+        Returns:
+            bool: True if the chunk is a near duplicate of a kept chunk and should be dropped.
+        """
+        self.seen += 1
+        signature = self.signature(text)
+        if signature is None:
+            return False
+        keys = self._band_keys(signature)
+        candidates = {index for band, key in enumerate(keys) for index in self._buckets[band].get(key, ())}
+        best, best_similarity = None, 0.0
+        for index in candidates:
+            similarity = float(np.count_nonzero(self._signatures[index] == signature)) / self.num_perm
+            if similarity > best_similarity:
+                best, best_similarity = index, similarity
+        if best is not None and best_similarity >= self.threshold:
+            kept_title, kept_preview = self._kept[best]
+            self.merges.append({'kept_title': kept_title, 'kept_text': kept_preview, 'dropped_title': title,
+                                'dropped_text': text[:self.preview_chars], 'similarity': round(best_similarity, 3)})
+            return True
+        index = len(self._signatures)
+        self._signatures.append(signature)
+        self._kept.append((title, text[:self.preview_chars]))
+        for band, key in enumerate(keys):
+            self._buckets[band][key].append(index)
+        return False
+
+    def report(self) -> dict:
+        """
+        Summarises the chunks seen and dropped, with the most frequently repeated chunks first.
+
+        Returns:
+            dict: The settings, the counts and the merges grouped by the chunk that was kept.
+        """
+        groups = defaultdict(list)
+        for merge in self.merges:
+            groups[(merge['kept_title'], merge['kept_text'])].append(
+                {'title': merge['dropped_title'], 'text': merge['dropped_text'], 'similarity': merge['similarity']})
+        merged = [{'kept_title': title, 'kept_text': text, 'duplicates': duplicates}
+                  for (title, text), duplicates in sorted(groups.items(), key=lambda group: -len(group[1]))]
+        return {
+            'threshold': self.threshold,
+            'num_perm': self.num_perm,
+            'bands': self.bands,
+            'rows': self.rows,
+            'shingle_size': self.shingle_size,
+            'chunks_seen': self.seen,
+            'chunks_dropped': len(self.merges),
+            'merged': merged,
+        }
+
+    def write_report(self, path: str):
+        """
+        Writes `report` as JSON to `path`.
+        """
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2, ensure_ascii=False)
+        print(f"near-duplicate report written to {path}")
+
+
+if __name__ == '__main__':
+    from utils import iter_preprocessed_records
+    parser = argparse.ArgumentParser(description="Report the near-duplicate chunks of a scraped data file.")
+    parser.add_argument('data_file', help="The .csv, .jsonl or .parquet file of the scraped pages.")
+    parser.add_argument('--threshold', type=float, default=0.8)
+    parser.add_argument('--num-perm', type=int, default=128)
+    parser.add_argument('--shingle-size', type=int, default=5)
+    parser.add_argument('--report', default='near_duplicates.json')
+    args = parser.parse_args()
+
+    near_dedup = NearDuplicateFilter(args.threshold, args.num_perm, args.shingle_size)
+    kept = sum(1 for _ in iter_preprocessed_records(args.data_file, near_dedup=near_dedup))
+    print(f"{near_dedup.seen} chunks, {len(near_dedup.merges)} near duplicates, {kept} kept "
+          f"(threshold {near_dedup.threshold}, {near_dedup.bands} bands x {near_dedup.rows} rows)")
+    near_dedup.write_report(args.report)
@@ -0,0 +1,204 @@
+import csv
+import json
+import math
+import os
+from datetime import datetime, timezone
+from typing import Dict, Iterable, Iterator, List
+
+RECORD_FIELDS = ['title', 'content', 'url', 'crawled_at']
+
+
+def _format(path: str, format: str = None) -> str:
+    format = format or os.path.splitext(path)[1].lstrip('.').lower()
+    if format not in ('jsonl', 'parquet', 'csv'):
+        raise ValueError(f"Unsupported record format: {format}. Use 'jsonl', 'parquet' or 'csv'")
+    return format
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+        return pyarrow
+    except ImportError:
+        raise ValueError(
+            "The pyarrow python package is not installed. Please install it with `pip install pyarrow`"
+        )
+
+
+def make_records(data: Dict[str, str], url: str = '', crawled_at: str = None) -> List[Dict[str, str]]:
+    """
+    Turns the title to content mapping of one page into records.
+
+    Args:
+        data (Dict[str, str]): The parsed data of the page.
+        url (str, optional): The URL of the page. Defaults to ''.
+        crawled_at (str, optional): The ISO 8601 crawl time. Defaults to now.
+
+    Returns:
+        List[Dict[str, str]]: One record per title.
+    """
+    crawled_at = crawled_at or datetime.now(timezone.utc).isoformat(timespec='seconds')
+    return [{'title': title, 'content': content, 'url': url, 'crawled_at': crawled_at}
+            for title, content in data.items()]
+
+
+class JsonlRecordWriter:
+    """
+    Appends records to a JSON lines file, flushing after every page so a crash loses at most one page.
+    """
+    def __init__(self, path: str, append: bool = False):
+        self.path = path
+        self._file = open(path, 'a' if append else 'w', encoding='utf-8')
+
+    def write(self, records: Iterable[Dict[str, str]]):
+        """
+        Writes the records of one page.
+
+        Args:
+            records (Iterable[Dict[str, str]]): The records, see `make_records`.
+        """
+        for record in records:
+            self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class CsvRecordWriter:
+    """
+    Appends records to a CSV file with the `RECORD_FIELDS` columns.
+    """
+    def __init__(self, path: str, append: bool = False):
+        self.path = path
+        write_header = not (append and os.path.exists(path) and os.path.getsize(path) > 0)
+        self._file = open(path, 'a' if append else 'w', newline='', encoding='utf-8')
+        self._writer = csv.DictWriter(self._file, fieldnames=RECORD_FIELDS, extrasaction='ignore')
+        if write_header:
+            self._writer.writeheader()
+
+    def write(self, records: Iterable[Dict[str, str]]):
+        """
+        Writes the records of one page.
+
+        Args:
+            records (Iterable[Dict[str, str]]): The records, see `make_records`.
+        """
+        self._writer.writerows(records)
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetRecordWriter:
+    """
+    Writes records to a Parquet file, one row group every `row_group_size` records.
+    """
+    def __init__(self, path: str, append: bool = False, row_group_size: int = 1024):
+        if append:
+            raise ValueError("Parquet files cannot be appended to, write a new file or use JSON lines")
+        pyarrow = _import_pyarrow()
+        self.path = path
+        self.row_group_size = row_group_size
+        self._schema = pyarrow.schema([(field, pyarrow.string()) for field in RECORD_FIELDS])
+        self._writer = pyarrow.parquet.ParquetWriter(path, self._schema)
+        self._buffer = []
+
+    def _flush(self):
+        if self._buffer:
+            pyarrow = _import_pyarrow()
+            self._writer.write_table(pyarrow.Table.from_pylist(self._buffer, schema=self._schema))
+            self._buffer = []
+
+    def write(self, records: Iterable[Dict[str, str]]):
+        """
+        Writes the records of one page.
+
+        Args:
+            records (Iterable[Dict[str, str]]): The records, see `make_records`.
+        """
+        self._buffer.extend(records)
+        if len(self._buffer) >= self.row_group_size:
+            self._flush()
+
+    def close(self):
+        self._flush()
+        self._writer.close()
+
+
+def open_record_writer(path: str, format: str = None, append: bool = False):
+    """
+    Opens a streaming record writer, choosing the format from the file extension.
+
+    Args:
+        path (str): The output file, ending in .jsonl, .parquet or .csv.
+        format (str, optional): Overrides the format inferred from the extension.
+        append (bool, optional): Append to an existing file, e.g. when resuming a crawl. Defaults to False.
+
+    Returns:
+        The writer, with `write(records)` and `close()` methods.
+    """
+    writers = {'jsonl': JsonlRecordWriter, 'csv': CsvRecordWriter, 'parquet': ParquetRecordWriter}
+    return writers[_format(path, format)](path, append=append)
+
+
+def _clean(record: Dict) -> Dict[str, str]:
+    # pandas and pyarrow return NaN/None for empty cells
+    return {field: '' if value is None or (isinstance(value, float) and math.isnan(value)) else value
+            for field, value in record.items()}
+
+
+def iter_record_batches(path: str, batch_size: int = 256, format: str = None) -> Iterator[List[Dict[str, str]]]:
+    """
+    Reads records in batches of at most `batch_size`, holding only one batch in memory.
+
+    Args:
+        path (str): A .jsonl, .parquet or .csv file. CSV files from `save_to_csv` only have title and content.
+        batch_size (int, optional): The number of records per batch. Defaults to 256.
+        format (str, optional): Overrides the format inferred from the extension.
+
+    Yields:
+        List[Dict[str, str]]: A batch of records.
+    """
+    format = _format(path, format)
+    if format == 'parquet':
+        _import_pyarrow()
+        import pyarrow.parquet
+        for batch in pyarrow.parquet.ParquetFile(path).iter_batches(batch_size=batch_size):
+            yield [_clean(record) for record in batch.to_pylist()]
+    elif format == 'csv':
+        import pandas as pd
+        for df in pd.read_csv(path, chunksize=batch_size):
+            yield [_clean(record) for record in df.to_dict('records')]
+    else:
+        batch = []
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                batch.append(_clean(json.loads(line)))
+                if len(batch) == batch_size:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
+
+
+def export_csv(source_path: str, csv_path: str, batch_size: int = 1024):
+    """
+    Streams the records of a JSON lines or Parquet file into a CSV file.
+
+    Args:
+        source_path (str): The .jsonl or .parquet file.
+        csv_path (str): The CSV file to write.
+        batch_size (int, optional): The number of records read at a time. Defaults to 1024.
+    """
+    writer = CsvRecordWriter(csv_path)
+    try:
+        for batch in iter_record_batches(source_path, batch_size):
+            writer.write(batch)
+    finally:
+        writer.close()
+    print(f'Data written to {csv_path}')
@@ -0,0 +1,236 @@
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+import chromadb
+from chromadb_upload import (COLLECTION_NAME, CHROMADB_STORAGE_PATH, NEAR_DUPLICATE_THRESHOLD,
+                             TITLES_COLLECTION_SUFFIX, ingest_to_chromadb)
+
+# Read by the backend, see backend_service/index_versions.py
+INDEX_POINTER_FILE = 'index_version.json'
+CRAWL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scrapped_data', 'reindex')
+
+
+def lower_priority(niceness: int = 10, threads: int = 2):
+    """
+    Lets the crawl and the embedding run next to the service without taking its CPU.
+
+    Args:
+        niceness (int, optional): Added to the niceness of the process. Defaults to 10.
+        threads (int, optional): The number of threads torch embeds with. Defaults to 2.
+    """
+    if hasattr(os, 'nice'):
+        os.nice(niceness)
+    import torch
+    torch.set_num_threads(threads)
+
+
+def versioned_name(base: str, version: str) -> str:
+    return f"{base}-v{version}"
+
+
+def read_pointer(pointer_path: str, base: str):
+    """
+    Returns the published version of `base`, or None if there is none.
+    """
+    try:
+        with open(pointer_path) as f:
+            pointer = json.load(f)
+    except FileNotFoundError:
+        return None
+    return pointer if pointer.get('base') == base else None
+
+
+def write_pointer(pointer: dict, pointer_path: str):
+    """
+    Publishes a version by replacing the pointer file atomically, so that the backend never reads a partial file.
+    """
+    temporary_path = f"{pointer_path}.{os.getpid()}.tmp"
+    with open(temporary_path, 'w') as f:
+        json.dump(pointer, f, indent=2)
+    os.replace(temporary_path, pointer_path)
+
+
+def crawl(output_path: str, cache_dir: str):
+    """
+    Runs the crawler in a child process, which inherits the lowered priority.
+
+    Args:
+        output_path (str): The .jsonl file the pages are streamed to.
+        cache_dir (str): The page cache, so that unchanged pages are revalidated instead of downloaded.
+    """
+    scrapper = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data_scrapper.py')
+    subprocess.run([sys.executable, scrapper, '--output', output_path, '--cache-dir', cache_dir], check=True)
+
+
+def smoke_test(client, collection_name: str, previous_count: int = None, min_count_ratio: float = 0.9,
+               samples: int = 50, k: int = 5, golden_queries: str = None, embedding_function=None) -> dict:
+    """
+    Checks a new version before it is published.
+
+    The version must hold at least `min_count_ratio` of the chunks of the version it replaces, find its
+    own stored chunks among their top k neighbours (a broken index or a failed write returns other
+    chunks), and, if `golden_queries` is given, return the expected page of every golden query in its top k.
+
+    Args:
+        client (chromadb.ClientAPI): The ChromaDB client.
+        collection_name (str): The new version.
+        previous_count (int, optional): The number of chunks of the published version.
+        min_count_ratio (float, optional): Defaults to 0.9.
+        samples (int, optional): The number of stored chunks queried by their own embedding. Defaults to 50.
+        k (int, optional): The number of results checked. Defaults to 5.
+        golden_queries (str, optional): A .jsonl file of {"query": ..., "title": ...} lines.
+        embedding_function (CustomEmbeddingFunction, optional): Embeds the golden queries.
+
+    Returns:
+        dict: The measurements and whether the version `passed`.
+    """
+    collection = client.get_collection(collection_name)
+    count = collection.count()
+    report = {'count': count, 'previous_count': previous_count}
+    passed = count > 0 and (not previous_count or count >= min_count_ratio * previous_count)
+
+    ids = collection.get(include=[])['ids']
+    sample = random.sample(ids, min(samples, len(ids)))
+    if sample:
+        records = collection.get(ids=sample, include=['embeddings'])
+        results = collection.query(query_embeddings=records['embeddings'], n_results=k, include=[])
+        hits = sum(record_id in found for record_id, found in zip(records['ids'], results['ids']))
+        report['self_recall'] = hits / len(sample)
+        passed = passed and report['self_recall'] >= 0.9
+
+    if golden_queries:
+        with open(golden_queries) as f:
+            golden = [json.loads(line) for line in f if line.strip()]
+        if golden:
+            results = collection.query(query_embeddings=embedding_function([item['query'] for item in golden]),
+                                       n_results=k, include=['metadatas'])
+            hits = sum(item['title'] in {metadata.get('title') for metadata in metadatas}
+                       for item, metadatas in zip(golden, results['metadatas']))
+            report['golden_recall'] = hits / len(golden)
+            passed = passed and hits == len(golden)
+
+    report['passed'] = passed
+    return report
+
+
+def drop_version(client, collection_name: str):
+    """
+    Deletes a version and its title index.
+    """
+    for name in (collection_name, collection_name + TITLES_COLLECTION_SUFFIX):
+        try:
+            client.delete_collection(name)
+        except ValueError:
+            pass  # Never created
+
+
+def prune_versions(client, base: str, keep: set):
+    """
+    Deletes the versions of `base` other than `keep`, the served and the rollback version.
+    """
+    prefix = f"{base}-v"
+    for collection in client.list_collections():
+        name = collection.name
+        if name.startswith(prefix) and not name.endswith(TITLES_COLLECTION_SUFFIX) and name not in keep:
+            drop_version(client, name)
+            print(f"deleted old version {name}")
+
+
+def reindex(base: str, storage_path: str, data_file: str = None, cache_dir: str = None,
+            embedding_model: str = None, dedup_threshold: float = NEAR_DUPLICATE_THRESHOLD,
+            golden_queries: str = None, min_count_ratio: float = 0.9) -> dict:
+    """
+    Builds, checks and publishes a new version of an index.
+
+    The pages are crawled (or read from `data_file`) into a new collection `<base>-v<version>`, which the
+    backend does not see until it passes `smoke_test` and the pointer file names it. The published
+    version before it is kept for rollback; older versions are deleted.
+
+    Args:
+        base (str): The name of the unversioned collection.
+        storage_path (str): The ChromaDB storage path of the backend.
+        data_file (str, optional): Index this file instead of crawling.
+        cache_dir (str, optional): The page cache of the crawl. Defaults to `CRAWL_DIR`/cache.
+        embedding_model (str, optional): The embedding model, see `ingest_to_chromadb`.
+        dedup_threshold (float, optional): See `ingest_to_chromadb`.
+        golden_queries (str, optional): See `smoke_test`.
+        min_count_ratio (float, optional): See `smoke_test`.
+
+    Returns:
+        dict: The new pointer, or the failed smoke test report.
+    """
+    from embedding_func import CustomEmbeddingFunction
+    version = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S')
+    collection_name = versioned_name(base, version)
+    pointer_path = os.path.join(storage_path, INDEX_POINTER_FILE)
+    if data_file is None:
+        os.makedirs(CRAWL_DIR, exist_ok=True)
+        data_file = os.path.join(CRAWL_DIR, f"pages-{version}.jsonl")
+        crawl(data_file, cache_dir or os.path.join(CRAWL_DIR, 'cache'))
+
+    client = chromadb.PersistentClient(path=storage_path)
+    try:
+        ingest_to_chromadb(data_file_path=data_file, collection_name=collection_name, chromadb_storage_path=storage_path,
+                           dedup_threshold=dedup_threshold, embedding_model=embedding_model)
+    except BaseException:
+        drop_version(client, collection_name)  # Never leave a half-built version behind
+        raise
+    published = read_pointer(pointer_path, base)
+    previous = {'collection': published['collection'], 'version': published['version']} if published \
+        else {'collection': base, 'version': None}
+    try:
+        previous_count = client.get_collection(previous['collection']).count()
+    except ValueError:
+        previous_count = None
+    embedding_function = CustomEmbeddingFunction(model_name=embedding_model) if embedding_model else CustomEmbeddingFunction()
+    report = smoke_test(client, collection_name, previous_count, min_count_ratio,
+                        golden_queries=golden_queries, embedding_function=embedding_function)
+    print(f"smoke test of {collection_name}: {report}")
+    if not report['passed']:
+        drop_version(client, collection_name)
+        print(f"{collection_name} failed the smoke test and was deleted; {previous['collection']} is still served")
+        return report
+
+    pointer = {'base': base, 'collection': collection_name, 'version': version, 'previous': previous,
+               'published_at': time.time(), 'smoke_test': report}
+    write_pointer(pointer, pointer_path)
+    print(f"published {collection_name}")
+    prune_versions(client, base, keep={collection_name, previous['collection']})
+    return pointer
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Periodically rebuild the index into a new version and publish it to the backend.")
+    parser.add_argument('--collection', default=COLLECTION_NAME, help="the unversioned collection name")
+    parser.add_argument('--storage-path', default=CHROMADB_STORAGE_PATH)
+    parser.add_argument('--data-file', default=None, help="index this file instead of crawling")
+    parser.add_argument('--cache-dir', default=None)
+    parser.add_argument('--embedding-model', default=None)
+    parser.add_argument('--dedup-threshold', type=float, default=NEAR_DUPLICATE_THRESHOLD)
+    parser.add_argument('--golden-queries', default=None, help=".jsonl file of {\"query\", \"title\"} the new version must answer")
+    parser.add_argument('--min-count-ratio', type=float, default=0.9)
+    parser.add_argument('--interval-hours', type=float, default=24)
+    parser.add_argument('--once', action='store_true', help="reindex once and exit")
+    parser.add_argument('--niceness', type=int, default=10)
+    parser.add_argument('--threads', type=int, default=2)
+    args = parser.parse_args()
+
+    lower_priority(args.niceness, args.threads)
+    while True:
+        started = time.time()
+        try:
+            reindex(args.collection, args.storage_path, args.data_file, args.cache_dir, args.embedding_model,
+                    args.dedup_threshold or None, args.golden_queries, args.min_count_ratio)
+        except Exception as e:
+            # The published version keeps being served; try again at the next interval
+            print(f"reindex failed: {e}")
+            if args.once:
+                raise
+        if args.once:
+            break
+        time.sleep(max(0.0, args.interval_hours * 3600 - (time.time() - started)))
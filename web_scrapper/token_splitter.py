@@ -0,0 +1,117 @@
+from typing import Iterable, Iterator, List, Sequence, Tuple
+
+
+class TokenTextSplitter:
+    """
+    Token-aware text splitter that tokenizes every document exactly once.
+
+    The document is encoded with a fast (Rust) tokenizer that returns the character offsets of every
+    token. Chunks are then cut directly on token boundaries, so no fragment is ever re-tokenized to
+    measure its length. Within the last `snap_window` fraction of a chunk the cut is moved back to the
+    strongest separator available, in the same priority order as `RecursiveCharacterTextSplitter`.
+
+    Attributes:
+        tokenizer (transformers.PreTrainedTokenizerFast): The tokenizer of the embedding model.
+        chunk_size (int): The maximum length of a chunk in tokens, including the model's special tokens.
+        chunk_overlap (int): The number of tokens shared by two consecutive chunks.
+        separators (Sequence[str]): Preferred cut points, strongest first.
+        snap_window (float): The fraction of a chunk that may be given up to cut on a separator.
+        batch_size (int): The number of documents encoded per tokenizer call in `split_texts`.
+    """
+    def __init__(self, tokenizer, chunk_size: int = 500, chunk_overlap: int = 30,
+                 separators: Sequence[str] = ("\n\n", ".", " "), snap_window: float = 0.2, batch_size: int = 64):
+        if not getattr(tokenizer, 'is_fast', False):
+            raise ValueError("TokenTextSplitter needs a fast tokenizer to get offset mappings")
+        if chunk_overlap >= chunk_size:
+            raise ValueError("chunk_overlap must be smaller than chunk_size")
+        self.tokenizer = tokenizer
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.separators = tuple(separators)
+        self.snap_window = snap_window
+        self.batch_size = batch_size
+        # `token_length` counts [CLS] and [SEP], keep the same budget for the chunk text itself
+        self._budget = chunk_size - tokenizer.num_special_tokens_to_add()
+
+    def _encode(self, texts: List[str]) -> List[List[Tuple[int, int]]]:
+        # A batched call on a fast tokenizer is encoded in parallel by the Rust backend
+        encodings = self.tokenizer(
+            texts, add_special_tokens=False, return_offsets_mapping=True,
+            return_attention_mask=False, return_token_type_ids=False, verbose=False
+        )
+        return encodings['offset_mapping']
+
+    def _boundary_rank(self, text: str, offsets: List[Tuple[int, int]], index: int) -> int:
+        """
+        Ranks the boundary between token `index - 1` and token `index` by the separator it falls on.
+        """
+        previous_start, previous_end = offsets[index - 1]
+        gap = text[previous_end:offsets[index][0]]
+        previous_token = text[previous_start:previous_end]
+        for rank, separator in enumerate(self.separators):
+            if separator in gap or (separator.strip() and previous_token.endswith(separator)):
+                return rank
+        return len(self.separators)
+
+    def _snap(self, text: str, offsets: List[Tuple[int, int]], start: int, end: int) -> int:
+        lowest = max(start + 1, end - max(1, int(self._budget * self.snap_window)))
+        best_index, best_rank = end, len(self.separators)
+        for index in range(end, lowest - 1, -1):
+            rank = self._boundary_rank(text, offsets, index)
+            if rank < best_rank:
+                best_index, best_rank = index, rank
+                if rank == 0:
+                    break
+        return best_index
+
+    def _split_encoded(self, text: str, offsets: List[Tuple[int, int]]) -> List[str]:
+        if len(offsets) <= self._budget:
+            return [text.strip()] if text.strip() else []
+        chunks = []
+        start = 0
+        while start < len(offsets):
+            end = min(start + self._budget, len(offsets))
+            if end < len(offsets):
+                end = self._snap(text, offsets, start, end)
+            chunk = text[offsets[start][0]:offsets[end - 1][1]].strip()
+            if chunk:
+                chunks.append(chunk)
+            if end >= len(offsets):
+                break
+            start = max(end - self.chunk_overlap, start + 1)
+        return chunks
+
+    def split_text(self, text: str) -> List[str]:
+        """
+        Splits a single document into chunks.
+
+        Args:
+            text (str): The document.
+
+        Returns:
+            List[str]: The chunks, each at most `chunk_size` tokens long.
+        """
+        return self._split_encoded(text, self._encode([text])[0])
+
+    def split_texts(self, texts: Iterable[str]) -> Iterator[List[str]]:
+        """
+        Splits a stream of documents, encoding `batch_size` of them per tokenizer call.
+
+        Args:
+            texts (Iterable[str]): The documents.
+
+        Yields:
+            List[str]: The chunks of each document, in input order.
+        """
+        batch = []
+        for text in texts:
+            batch.append(text)
+            if len(batch) == self.batch_size:
+                yield from self._split_batch(batch)
+                batch = []
+        if batch:
+            yield from self._split_batch(batch)
+
+    def _split_batch(self, texts: List[str]) -> Iterator[List[str]]:
+        for text, offsets in zip(texts, self._encode(texts)):
+            yield self._split_encoded(text, offsets)
@@ -1,13 +1,21 @@
-import pandas as pd
+import os
 from collections import OrderedDict
 from transformers import AutoTokenizer
 import torch
 import csv
-from typing import Dict
+import hashlib
+from typing import Dict, Iterable, Iterator, List
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from bs4 import BeautifulSoup
+from bs4.builder import builder_registry
+from token_splitter import TokenTextSplitter
+from record_store import iter_record_batches
 
 tokenizer = AutoTokenizer.from_pretrained("Alibaba-NLP/gte-base-en-v1.5")
+# lxml is C-accelerated and several times faster than the pure-Python 'html.parser'
+HTML_PARSER = os.environ.get('SCRAPER_HTML_PARSER', 'lxml')
+# The parsers whose fallback was already reported, so that a crawl warns once rather than once per page
+_REPORTED_FALLBACKS = set()
 
 def ordered_set(iterable):
     """
@@ -39,17 +47,76 @@ def combine_result(parsed_data):
             combined_data[data['title']] = data['content']
     return combined_data
 
+def resolve_html_parser(parser: str = None):
+    """
+    Resolves the BeautifulSoup parser backend, falling back to 'html.parser' when it is not installed.
+
+    Args:
+        parser (str, optional): The requested backend, e.g. 'lxml' or 'html.parser'. Defaults to `HTML_PARSER`.
+
+    Returns:
+        str: The name of an available backend.
+    """
+    parser = parser or HTML_PARSER
+    if builder_registry.lookup(parser) is None:
+        if parser not in _REPORTED_FALLBACKS:
+            _REPORTED_FALLBACKS.add(parser)
+            print(f"HTML parser '{parser}' is not available, falling back to 'html.parser'")
+        return 'html.parser'
+    return parser
+
+class ParsedPage:
+    """
+    A fetched page whose HTML is parsed at most once and shared by all parsers.
+
+    Attributes:
+        url (str): The URL of the page.
+        status_code (int): The HTTP status code.
+        content (bytes): The raw HTML.
+        parser (str): The BeautifulSoup parser backend.
+    """
+    def __init__(self, response, parser: str = None):
+        self.url = getattr(response, 'url', '')
+        self.status_code = getattr(response, 'status_code', 200)
+        self.content = response.content
+        self.parser = resolve_html_parser(parser)
+        self._soup = None
+
+    @property
+    def soup(self) -> BeautifulSoup:
+        """
+        The parsed document, built on first access.
+        """
+        if self._soup is None:
+            self._soup = BeautifulSoup(self.content, self.parser)
+        return self._soup
+
+def as_page(response, parser: str = None) -> ParsedPage:
+    """
+    Wraps an HTTP response in a `ParsedPage`, or returns it unchanged if it already is one.
+
+    Args:
+        response (requests.Response | ParsedPage): The HTTP response object.
+        parser (str, optional): The BeautifulSoup parser backend. Defaults to `HTML_PARSER`.
+
+    Returns:
+        ParsedPage: The page.
+    """
+    if isinstance(response, ParsedPage):
+        return response
+    return ParsedPage(response, parser)
+
 def check_nested_categories(response):
     """
     Checks if the response contains nested categories.
 
     Args:
-        response (requests.Response): The HTTP response object.
+        response (requests.Response | ParsedPage): The HTTP response object.
 
     Returns:
         bool: True if nested categories are found, False otherwise.
     """
-    soup = BeautifulSoup(response.content, 'html.parser')
+    soup = as_page(response).soup
     qa_divs = soup.find_all('div', class_='child-tab-container')
     content_outer_div = soup.find_all('div', class_='row list-content-page')
     if len(qa_divs) < 1 and len(content_outer_div) < 1:
@@ -70,6 +137,26 @@ def batch_generator(array, batch_size):
     for i in range(0, len(array), batch_size):
         yield array[i:i + batch_size]
 
+def iter_batches(iterable: Iterable, batch_size: int) -> Iterator[List]:
+    """
+    Generates batches from any iterable without materialising it.
+
+    Args:
+        iterable (Iterable): The input iterable, e.g. a generator.
+        batch_size (int): The size of each batch.
+
+    Yields:
+        list: A batch of at most `batch_size` items.
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
 def save_to_csv(data: Dict, filename: str = 'scrapped_data_v2.csv'):
     """
     Saves data to a CSV file.
@@ -119,24 +206,102 @@ def convert_dict_to_list(dict_data: Dict):
         list_data.append({'title': key, 'content': value})
     return list_data
 
-def preprocess_data(filepath: str = 'data.csv'):
+def get_text_splitter(splitter: str = 'token'):
+    """
+    Creates the text splitter used to chunk the scraped content.
+
+    Args:
+        splitter (str, optional): 'token' for the single-pass `TokenTextSplitter`, or 'recursive' for
+            langchain's `RecursiveCharacterTextSplitter` measured with `token_length`. Defaults to 'token'.
+
+    Returns:
+        The text splitter. Both variants produce chunks of at most 500 tokens with 30 tokens of overlap.
+    """
+    if splitter == 'token':
+        return TokenTextSplitter(tokenizer, chunk_size=500, chunk_overlap=30, separators=["\n\n", ".", ' '])
+    if splitter == 'recursive':
+        return RecursiveCharacterTextSplitter(separators=["\n\n", ".", ' ', ""], chunk_size=500,
+                                              chunk_overlap=30, length_function=token_length)
+    raise ValueError(f"Unknown text splitter: {splitter}")
+
+def split_texts(text_splitter, texts: Iterable[str]) -> Iterator[List[str]]:
+    """
+    Splits a stream of documents with either kind of text splitter.
+
+    Args:
+        text_splitter: A splitter returned by `get_text_splitter`.
+        texts (Iterable[str]): The documents.
+
+    Yields:
+        List[str]: The chunks of each document, in input order.
+    """
+    if isinstance(text_splitter, TokenTextSplitter):
+        yield from text_splitter.split_texts(texts)
+    else:
+        for text in texts:
+            yield text_splitter.split_text(text)
+
+def iter_preprocessed_records(filepath: str = 'data.csv', read_chunksize: int = 256, splitter: str = 'token',
+                              near_dedup=None):
+    """
+    Streams preprocessed chunks together with the title of the page they come from.
+
+    Args:
+        filepath (str, optional): The path to the .csv, .jsonl or .parquet file. Defaults to 'data.csv'.
+        read_chunksize (int, optional): The number of records read per step. Defaults to 256.
+        splitter (str, optional): The text splitter, see `get_text_splitter`. Defaults to 'token'.
+        near_dedup (NearDuplicateFilter, optional): Also drops the chunks it finds to be near duplicates of
+            an earlier chunk, e.g. boilerplate repeated with small variations across pages. Defaults to None.
+
+    Yields:
+        Tuple[str, str]: The page title and a preprocessed chunk of the form "<title> <chunk>".
+    """
+    text_splitter = get_text_splitter(splitter)
+    seen = set()
+    for records in iter_record_batches(filepath, batch_size=read_chunksize):
+        titles = [record['title'] for record in records]
+        contents = [record['content'] for record in records]
+        for title, chunks in zip(titles, split_texts(text_splitter, contents)):
+            for chunk in chunks:
+                document = title + " " + chunk
+                digest = hashlib.blake2b(document.encode('utf-8'), digest_size=8).digest()
+                if digest in seen:
+                    continue
+                seen.add(digest)
+                if near_dedup is not None and near_dedup.is_duplicate(chunk, title):
+                    continue
+                yield title, document
+
+def iter_preprocessed_data(filepath: str = 'data.csv', read_chunksize: int = 256, splitter: str = 'token',
+                           near_dedup=None):
+    """
+    Streams preprocessed chunks from a CSV, JSON lines or Parquet file, reading `read_chunksize` records at a time.
+
+    Exact duplicates are dropped as in `preprocess_data`, but only an 8 byte digest of every
+    chunk already emitted is remembered, so memory does not grow with the size of the text.
+
+    Args:
+        filepath (str, optional): The path to the .csv, .jsonl or .parquet file. Defaults to 'data.csv'.
+        read_chunksize (int, optional): The number of records read per step. Defaults to 256.
+        splitter (str, optional): The text splitter, see `get_text_splitter`. Defaults to 'token'.
+        near_dedup (NearDuplicateFilter, optional): See `iter_preprocessed_records`. Defaults to None.
+
+    Yields:
+        str: A preprocessed chunk of the form "<title> <chunk>".
+    """
+    for _, document in iter_preprocessed_records(filepath, read_chunksize, splitter, near_dedup):
+        yield document
+
+def preprocess_data(filepath: str = 'data.csv', splitter: str = 'token', near_dedup=None):
     """
-    Preprocesses data from a CSV file.
+    Preprocesses data from a CSV, JSON lines or Parquet file.
 
     Args:
-        filepath (str, optional): The path to the CSV file. Defaults to 'data.csv'.
+        filepath (str, optional): The path to the .csv, .jsonl or .parquet file. Defaults to 'data.csv'.
+        splitter (str, optional): The text splitter, see `get_text_splitter`. Defaults to 'token'.
+        near_dedup (NearDuplicateFilter, optional): See `iter_preprocessed_records`. Defaults to None.
 
     Returns:
         List[str]: A list of preprocessed data.
     """
-    df = pd.read_csv(filepath)
-    preprocessed_data = []
-    text_splitter = RecursiveCharacterTextSplitter(separators=["\n\n", ".", ' ', ""], chunk_size=500,
-                                                   chunk_overlap=30, length_function=token_length)
-    for index, row in df.iterrows():
-        title = row['title'] if not pd.isna(row['title']) else ''
-        content = row['content']
-        chunks = text_splitter.split_text(content)
-        for chunk in chunks:
-            preprocessed_data.append(title + " " + chunk)
-    return list(OrderedDict.fromkeys(preprocessed_data))
\ No newline at end of file
+    return list(iter_preprocessed_data(filepath, splitter=splitter, near_dedup=near_dedup))